@@ -1,24 +1,102 @@
 import os
+import re
+import copy
+import json
+import math
+import hashlib
+import sqlite3
+import unicodedata
+from collections import Counter, OrderedDict
+import queue
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import torch
-from transformers import pipeline
+from transformers.generation.streamers import BaseStreamer
+from transformers import pipeline, AutoTokenizer, DynamicCache, TextStreamer, StoppingCriteria, StoppingCriteriaList
 import time
 import traceback
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, List
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from pydantic import BaseModel, Field
+from typing import Optional, List, Union, Literal, Annotated
 import uvicorn
 import nest_asyncio
 from pyngrok import ngrok
-import requests
-from bs4 import BeautifulSoup
+import httpx
+from bs4 import BeautifulSoup, SoupStrainer
+
+# 高速な HTML パーサー（インストールされていれば使う）
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    import lxml  # noqa: F401
+    BS4_PARSER = "lxml"
+except ImportError:
+    BS4_PARSER = "html.parser"
 
 # モデル設定
 MODEL_NAME = "google/gemma-2-2b-jpn-it"
 
+PRECISIONS = ("auto", "fp32", "bf16", "fp16", "int8")
+
 class Config:
     def __init__(self, model_name=MODEL_NAME):
         self.MODEL_NAME = model_name
+        # 推論精度（auto / fp32 / bf16 / fp16 / int8）
+        # auto は GPU なら bf16、CPU なら fp32。int8 は CPU で線形層を動的量子化する
+        self.PRECISION = os.environ.get("PRECISION", "auto").lower()
+        if self.PRECISION not in PRECISIONS:
+            # 設定の誤りは読み込みの再試行では直らないため起動時に止める
+            raise ValueError(f"未対応の精度です: {self.PRECISION}（{' / '.join(PRECISIONS)}）")
+        # モデル読み込み（バックグラウンド読み込みの再試行とウォームアップ）
+        self.USE_SAFETENSORS = os.environ.get("USE_SAFETENSORS", "1") == "1"
+        self.LOAD_MAX_ATTEMPTS = int(os.environ.get("LOAD_MAX_ATTEMPTS", "5"))
+        self.LOAD_RETRY_DELAY = float(os.environ.get("LOAD_RETRY_DELAY", "10"))
+        self.WARMUP_TOKENS = int(os.environ.get("WARMUP_TOKENS", "4"))
+        # プロセスモードのウォームアップで全プロセスがそろうのを待つ秒数
+        self.WARMUP_BARRIER_TIMEOUT = float(os.environ.get("WARMUP_BARRIER_TIMEOUT", "300"))
+        # バッチ推論の設定
+        self.BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "8"))
+        self.BATCH_WAIT_MS = float(os.environ.get("BATCH_WAIT_MS", "20"))
+        self.TEMPERATURE_BUCKET = float(os.environ.get("TEMPERATURE_BUCKET", "0.05"))
+        # /batch で一度に受け付ける件数
+        self.BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "64"))
+        # 固定プレフィックスの KV キャッシュを再利用するか
+        self.PREFIX_CACHE = os.environ.get("PREFIX_CACHE", "1") == "1"
+        # 投機的デコーディング（小さなドラフトモデルが候補を出し、本体が検証する）
+        # 空なら無効。DRAFT_NUM_TOKENS は1回に提案させる候補トークン数の初期値
+        self.DRAFT_MODEL_NAME = os.environ.get("DRAFT_MODEL_NAME", "")
+        self.DRAFT_NUM_TOKENS = int(os.environ.get("DRAFT_NUM_TOKENS", "8"))
+        # 推論ワーカープールの設定（thread / process）
+        self.INFERENCE_MODE = os.environ.get("INFERENCE_MODE", "thread")
+        self.INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "1"))
+        self.INFERENCE_SHARE_MODEL = os.environ.get("INFERENCE_SHARE_MODEL", "0") == "1"
+        self.INFERENCE_CORES = os.environ.get("INFERENCE_CORES", "")
+        self.INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", "64"))
+        # レスポンスキャッシュの設定（SQLite のパスを指定するとディスク層も使う）
+        self.RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "0") == "1"
+        self.RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+        self.RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+        self.RESPONSE_CACHE_SQLITE_PATH = os.environ.get("RESPONSE_CACHE_SQLITE_PATH", "")
+        self.RESPONSE_CACHE_SQLITE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_SQLITE_MAX_ENTRIES", "100000"))
+        # SQLite 層の期限切れ・件数超過の削除を行う書き込み間隔
+        self.RESPONSE_CACHE_PRUNE_INTERVAL = max(1, int(os.environ.get("RESPONSE_CACHE_PRUNE_INTERVAL", "100")))
+        # Webページ取得の設定
+        self.FETCH_TIMEOUT = float(os.environ.get("FETCH_TIMEOUT", "10"))
+        self.FETCH_MAX_BYTES = int(os.environ.get("FETCH_MAX_BYTES", str(2 * 1024 * 1024)))
+        self.FETCH_MAX_CONNECTIONS = int(os.environ.get("FETCH_MAX_CONNECTIONS", "20"))
+        self.PAGE_CACHE_MAX_ENTRIES = int(os.environ.get("PAGE_CACHE_MAX_ENTRIES", "256"))
+        self.PAGE_CACHE_FRESH_SECONDS = float(os.environ.get("PAGE_CACHE_FRESH_SECONDS", "300"))
+        # 記事本文をプロンプトに入れるときのトークン予算
+        self.ARTICLE_TOKEN_BUDGET = int(os.environ.get("ARTICLE_TOKEN_BUDGET", "768"))
+        self.PASSAGE_MAX_CHARS = int(os.environ.get("PASSAGE_MAX_CHARS", "400"))
 
 config = Config(MODEL_NAME)
 
@@ -45,74 +123,1572 @@ class DebateArgument(BaseModel):
     context: Optional[str] = None
     max_tokens: Optional[int] = 512
     temperature: Optional[float] = 0.7
+    seed: Optional[int] = None
 
 class EvidenceAnalysis(BaseModel):
     evidence: str
     perspective: Optional[str] = None
     max_tokens: Optional[int] = 512
     temperature: Optional[float] = 0.7
+    seed: Optional[int] = None
 
 class CounterArgument(BaseModel):
     argument: str
     max_tokens: Optional[int] = 512
     temperature: Optional[float] = 0.7
+    seed: Optional[int] = None
 
 class DebateResponse(BaseModel):
     generated_text: str
     response_time: float
+    cache: Optional[dict] = None
+    timings: Optional[dict] = None
+
+# /batch の項目。endpoint でどの生成かを明示する（項目が複数の型に当てはまっても取り違えない）
+class BatchArgumentItem(DebateArgument):
+    endpoint: Literal["generate_argument"]
+
+class BatchEvidenceItem(EvidenceAnalysis):
+    endpoint: Literal["analyze_evidence"]
+
+class BatchCounterItem(CounterArgument):
+    endpoint: Literal["generate_counter"]
+
+class BatchRequest(BaseModel):
+    items: List[Annotated[
+        Union[BatchArgumentItem, BatchEvidenceItem, BatchCounterItem],
+        Field(discriminator="endpoint")
+    ]]
 
 class EvidenceFromUrl(BaseModel):
     url: str
     topic: Optional[str] = None
     max_tokens: Optional[int] = 512
     temperature: Optional[float] = 0.7
+    seed: Optional[int] = None
 
 # グローバル変数
+# スレッドモードでは最初のレプリカのパイプライン（プロセスモードでは親プロセスに持たない）
 model = None
 
-def load_model():
-    """モデルの読み込み"""
-    global model
+PRECISION_DTYPES = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+    "int8": torch.float32,
+}
+
+def resolve_precision():
+    """設定とデバイスから (デバイス, 精度) を決める"""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    precision = config.PRECISION
+    if precision == "auto":
+        precision = "bf16" if device == "cuda" else "fp32"
+    if precision not in PRECISION_DTYPES:
+        raise ValueError(f"未対応の精度です: {precision}")
+    if precision == "int8":
+        # 動的量子化は CPU のみ対応
+        device = "cpu"
+    elif precision == "fp16" and device == "cpu":
+        precision = "fp32"
+    return device, precision
+
+# 起動時に決めた (デバイス, 精度)。/health はこの値を返す
+inference_device, inference_precision = resolve_precision()
+
+def load_model(model_name=None):
+    """モデルの読み込み（省略時は MODEL_NAME）"""
+    device, precision = resolve_precision()
+    print(f"使用デバイス: {device} / 精度: {precision}")
+    pipe = pipeline(
+        "text-generation",
+        model=model_name or config.MODEL_NAME,
+        model_kwargs={
+            "torch_dtype": PRECISION_DTYPES[precision],
+            # safetensors はメモリマップで読み込まれるため起動が速い
+            "use_safetensors": config.USE_SAFETENSORS or None,
+            "low_cpu_mem_usage": True
+        },
+        device=device
+    )
+    if precision == "int8":
+        # 線形層の重みを int8 に量子化する（活性は実行時に量子化）
+        pipe.model = torch.ao.quantization.quantize_dynamic(
+            pipe.model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    # バッチ生成用にパディングを左詰めにする
+    if pipe.tokenizer.pad_token is None:
+        pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
+    pipe.tokenizer.padding_side = "left"
+    return pipe
+
+def match_prefix(prompt):
+    """プロンプトが始まる固定プレフィックスの名前を返す"""
+    for name, prefix in PROMPT_PREFIXES.items():
+        if prompt.startswith(prefix):
+            return name
+    return None
+
+class PromptCache:
+    """テンプレートの固定プレフィックスを事前に prefill し、KV キャッシュを保持する"""
+
+    def __init__(self):
+        self.entries = {}
+
+    def build(self, pipe, prefixes):
+        self.entries = {}
+        for name, prefix in prefixes.items():
+            try:
+                inputs = pipe.tokenizer(prefix, return_tensors="pt").to(pipe.model.device)
+                cache = DynamicCache()
+                with torch.no_grad():
+                    pipe.model(**inputs, past_key_values=cache, use_cache=True)
+                self.entries[name] = (prefix, inputs["input_ids"], cache)
+                print(f"プレフィックスキャッシュ作成: {name} ({inputs['input_ids'].shape[1]} tokens)")
+            except Exception as e:
+                print(f"プレフィックスキャッシュ作成エラー ({name}): {e}")
+
+    def clear(self):
+        self.entries = {}
+
+    def prepare(self, tokenizer, prompts):
+        """共通プレフィックスのキャッシュを使った generate 用の入力を作る
+
+        プレフィックスの後ろに左詰めでパディングした可変部分を連結する。
+        すべてのプロンプトが同じプレフィックスで始まらない場合は None を返す。
+        """
+        name = match_prefix(prompts[0])
+        if name not in self.entries or any(match_prefix(prompt) != name for prompt in prompts):
+            return None
+        prefix, prefix_ids, prefix_cache = self.entries[name]
+        batch_size = len(prompts)
+        suffixes = tokenizer(
+            [prompt[len(prefix):] for prompt in prompts],
+            return_tensors="pt",
+            padding=True,
+            add_special_tokens=False
+        ).to(prefix_ids.device)
+        input_ids = torch.cat([prefix_ids.expand(batch_size, -1), suffixes["input_ids"]], dim=1)
+        attention_mask = torch.cat([
+            torch.ones((batch_size, prefix_ids.shape[1]), dtype=suffixes["attention_mask"].dtype, device=prefix_ids.device),
+            suffixes["attention_mask"]
+        ], dim=1)
+        # 元のキャッシュは共有するため、リクエストごとに複製して使う
+        cache = copy.deepcopy(prefix_cache)
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "past_key_values": cache}
+
+class TimingStreamer(BaseStreamer):
+    """generate() の進行時刻を記録する（最初の put はプロンプト、次が最初の生成トークン）"""
+
+    def __init__(self):
+        self.prompt_time = None
+        self.first_token_time = None
+        self.end_time = None
+
+    def put(self, value):
+        now = time.perf_counter()
+        if self.prompt_time is None:
+            self.prompt_time = now
+        elif self.first_token_time is None:
+            self.first_token_time = now
+
+    def end(self):
+        self.end_time = time.perf_counter()
+
+    def durations(self, start_time):
+        """(prefill, decode) の秒数"""
+        first_token_time = self.first_token_time or self.end_time or start_time
+        return first_token_time - (self.prompt_time or start_time), (self.end_time or first_token_time) - first_token_time
+
+class QueueTextStreamer(TextStreamer):
+    """確定したテキストを sink.put() で渡すストリーマー（終端は None）"""
+
+    def __init__(self, tokenizer, sink):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.sink = sink
+        self.finished = False
+        self.timing = TimingStreamer()
+
+    def put(self, value):
+        self.timing.put(value)
+        super().put(value)
+
+    def end(self):
+        self.timing.end()
+        super().end()
+
+    def on_finalized_text(self, text, stream_end=False):
+        if text:
+            self.sink.put(text)
+        if stream_end and not self.finished:
+            self.finished = True
+            self.sink.put(None)
+
+class LoopQueueSink:
+    """推論スレッドからイベントループの asyncio.Queue へテキストを渡す"""
+
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+class CancelCriteria(StoppingCriteria):
+    """クライアント切断時に生成を打ち切る"""
+
+    def __init__(self, cancel_event):
+        self.cancel_event = cancel_event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.cancel_event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+class ForwardCounter:
+    """モデルの forward 呼び出し回数をスレッドごとに数える（投機的デコーディングの採択率用）"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def attach(self, module, name):
+        module.register_forward_hook(lambda *_: self._increment(name))
+
+    def _increment(self, name):
+        counts = getattr(self._local, "counts", None)
+        if counts is not None:
+            counts[name] += 1
+
+    def start(self):
+        self._local.counts = Counter()
+        return self._local.counts
+
+    def stop(self):
+        self._local.counts = None
+
+forward_counter = ForwardCounter()
+
+class SeedGate:
+    """シード付きの生成を他の生成と重ならないように実行させる
+
+    torch の乱数状態はプロセス全体（全ワーカースレッド）で共有されるため、シード付きの生成は
+    実行中の生成がすべて終わるのを待ち、単独でシードを設定して生成する。シードなしの生成どうしは並行に動く。
+    シード付きのリクエストがある間は INFERENCE_WORKERS > 1 でも生成が1件ずつになる。
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._running = 0
+        self._seeded = False
+        self._waiting_seeded = 0
+
+    def acquire(self, seed):
+        with self._condition:
+            if seed is None:
+                while self._seeded or self._waiting_seeded:
+                    self._condition.wait()
+                self._running += 1
+                return
+            self._waiting_seeded += 1
+            while self._seeded or self._running:
+                self._condition.wait()
+            self._waiting_seeded -= 1
+            self._seeded = True
+        torch.manual_seed(seed)
+
+    def release(self, seed):
+        with self._condition:
+            if seed is None:
+                self._running -= 1
+            else:
+                self._seeded = False
+            self._condition.notify_all()
+
+seed_gate = SeedGate()
+
+class ModelReplica:
+    """推論ワーカーが使うモデルのレプリカ"""
+
+    def __init__(self, index, cores=None, pipe=None, prompt_cache=None, draft=None):
+        self.index = index
+        self.cores = cores
+        self.pipe = pipe
+        self.prompt_cache = prompt_cache if prompt_cache is not None else PromptCache()
+        # ドラフトモデルのパイプライン（投機的デコーディングを使わない場合は None）
+        self.draft = draft
+        # generate() に渡す投機的デコーディングの引数（ドラフトを設定したときに1回だけ作る）
+        self.draft_kwargs = self.build_draft_kwargs() if draft is not None else None
+        self.status = "loading"
+        self.error = None
+        self.requests = 0
+
+    def load(self):
+        """パイプラインを読み込み、プレフィックスキャッシュを作る（共有レプリカでは何もしない）"""
+        try:
+            if self.pipe is None:
+                self.pipe = load_model()
+                if config.PREFIX_CACHE:
+                    self.prompt_cache.build(self.pipe, PROMPT_PREFIXES)
+                if config.DRAFT_MODEL_NAME:
+                    self.draft = self.load_draft()
+                    if self.draft is not None:
+                        self.draft_kwargs = self.build_draft_kwargs()
+            self.status = "idle"
+        except Exception as e:
+            print(f"モデル読み込みエラー (replica {self.index}): {e}")
+            traceback.print_exc()
+            self.status = "failed"
+            self.error = str(e)
+        return self.status == "idle"
+
+    def load_draft(self):
+        """ドラフトモデルを読み込む（失敗した場合は通常のデコードで続行する）"""
+        try:
+            draft = load_model(config.DRAFT_MODEL_NAME)
+            # 1回に提案させる候補数（以降は採択状況に応じて自動で増減する）
+            draft.model.generation_config.num_assistant_tokens = config.DRAFT_NUM_TOKENS
+            forward_counter.attach(self.pipe.model, "target")
+            forward_counter.attach(draft.model, "draft")
+            print(f"ドラフトモデル: {config.DRAFT_MODEL_NAME}")
+            return draft
+        except Exception as e:
+            print(f"ドラフトモデルを読み込めないため通常のデコードを使います: {e}")
+            traceback.print_exc()
+            return None
+
+    def build_draft_kwargs(self):
+        """generate() に渡す投機的デコーディングの引数を作る（語彙の比較はここで1回だけ行う）"""
+        kwargs = {"assistant_model": self.draft.model}
+        if self.draft.tokenizer.get_vocab() != self.pipe.tokenizer.get_vocab():
+            # 語彙が異なる場合はテキストを介して候補を変換する
+            kwargs.update(tokenizer=self.pipe.tokenizer, assistant_tokenizer=self.draft.tokenizer)
+        return kwargs
+
+    def info(self):
+        return {
+            "index": self.index,
+            "status": self.status,
+            "cores": self.cores,
+            "speculative": self.draft is not None,
+            "requests": self.requests,
+            "error": self.error
+        }
+
+    def prepare_inputs(self, prompts, use_prefix_cache=True):
+        """プロンプトを generate 用の入力に変換する"""
+        if config.PREFIX_CACHE and use_prefix_cache:
+            try:
+                inputs = self.prompt_cache.prepare(self.pipe.tokenizer, prompts)
+                if inputs is not None:
+                    return inputs
+            except Exception as e:
+                print(f"プレフィックスキャッシュを無効化します: {e}")
+                self.prompt_cache.clear()
+        return dict(self.pipe.tokenizer(prompts, return_tensors="pt", padding=True).to(self.pipe.model.device))
+
+    def count_generated_tokens(self, generated_ids):
+        """各行の生成トークン数（最初の EOS まで）"""
+        eos_token_id = self.pipe.model.generation_config.eos_token_id
+        eos_ids = set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id])
+        counts = []
+        for row in generated_ids.tolist():
+            count = len(row)
+            for position, token_id in enumerate(row):
+                if token_id in eos_ids:
+                    count = position + 1
+                    break
+            counts.append(count)
+        return counts
+
+    def generation_metrics(self, inputs, generated_ids, tokenize_time, timing, start_time):
+        """1回の generate() の計測値を行ごとに作る"""
+        prefill, decode = timing.durations(start_time)
+        prompt_tokens = inputs["attention_mask"].sum(dim=1).tolist()
+        metrics = []
+        for prompt_count, generated_count in zip(prompt_tokens, self.count_generated_tokens(generated_ids)):
+            metrics.append({
+                "batch_size": len(prompt_tokens),
+                "tokenize": tokenize_time,
+                "prefill": prefill,
+                "decode": decode,
+                "prompt_tokens": int(prompt_count),
+                "generated_tokens": generated_count,
+                "tokens_per_second": (generated_count - 1) / decode if decode > 0 and generated_count > 1 else 0.0
+            })
+        return metrics
+
+    def acceptance_metrics(self, counts, generated_tokens):
+        """forward 回数から投機的デコーディングの採択率を求める
+
+        本体の forward 1回ごとに「採択された候補 + 1トークン」が確定し、
+        ドラフトの forward 1回ごとに候補が1トークン提案される。
+        """
+        proposed = counts["draft"]
+        accepted = max(0, min(generated_tokens - counts["target"], proposed))
+        return {
+            "draft_tokens": proposed,
+            "accepted_tokens": accepted,
+            "acceptance_rate": accepted / proposed if proposed else 0.0
+        }
+
+    def run_generate(self, inputs, tokenize_time, max_new_tokens, temperature, seed, timing, streamer=None, **kwargs):
+        """generate() を実行し、生成部分のトークン列と行ごとの計測値を返す"""
+        assisted = self.draft is not None
+        if assisted:
+            kwargs.update(self.draft_kwargs)
+            counts = forward_counter.start()
+        seed_gate.acquire(seed)
+        generate_start = time.perf_counter()
+        try:
+            with torch.no_grad():
+                output_ids = self.pipe.model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    do_sample=True,
+                    streamer=streamer or timing,
+                    **kwargs
+                )
+        finally:
+            seed_gate.release(seed)
+            if assisted:
+                forward_counter.stop()
+        generated_ids = output_ids[:, inputs["input_ids"].shape[1]:]
+        metrics = self.generation_metrics(inputs, generated_ids, tokenize_time, timing, generate_start)
+        if assisted:
+            metrics[0].update(self.acceptance_metrics(counts, metrics[0]["generated_tokens"]))
+        return generated_ids, metrics
+
+    def generate_batch(self, prompts, max_new_tokens, temperature, seed=None):
+        """同じ生成パラメータのプロンプトをまとめて生成する（パイプラインと同じ形式に計測値を添えて返す）"""
+        if self.draft is not None and len(prompts) > 1:
+            # 投機的デコーディングはバッチサイズ1でしか使えないため1件ずつ生成する
+            return [self.generate_batch([prompt], max_new_tokens, temperature, seed)[0] for prompt in prompts]
+        tokenize_start = time.perf_counter()
+        # ドラフトモデル側にはプレフィックスの KV キャッシュがないため、投機的デコーディングでは使わない
+        inputs = self.prepare_inputs(prompts, use_prefix_cache=self.draft is None)
+        tokenize_time = time.perf_counter() - tokenize_start
+        generated_ids, metrics = self.run_generate(
+            inputs, tokenize_time, max_new_tokens, temperature, seed, TimingStreamer()
+        )
+        texts = self.pipe.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+        return [
+            [{"generated_text": prompt + text, "metrics": item_metrics}]
+            for prompt, text, item_metrics in zip(prompts, texts, metrics)
+        ]
+
+    def warmup(self, prompts, max_new_tokens):
+        """テンプレートごとに短い生成を行い、初回実行のコストを先に払う"""
+        for prompt in prompts:
+            self.generate_batch([prompt], max_new_tokens, 0.7)
+        return self.index
+
+    def generate_stream(self, prompt, max_new_tokens, temperature, sink, cancel_event, seed=None):
+        """1件のプロンプトを生成し、確定したテキストを sink に逐次渡す（計測値を返す）"""
+        streamer = QueueTextStreamer(self.pipe.tokenizer, sink)
+        try:
+            tokenize_start = time.perf_counter()
+            inputs = self.prepare_inputs([prompt], use_prefix_cache=self.draft is None)
+            tokenize_time = time.perf_counter() - tokenize_start
+            _, metrics = self.run_generate(
+                inputs, tokenize_time, max_new_tokens, temperature, seed, streamer.timing,
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([CancelCriteria(cancel_event)])
+            )
+            return metrics[0]
+        finally:
+            # 例外時もストリームの終端を通知する
+            streamer.on_finalized_text("", stream_end=True)
+
+def parse_core_sets(spec, workers):
+    """INFERENCE_CORES をワーカーごとの CPU コア集合に変換する
+
+    "auto" は利用可能なコアを均等に分割し、"0-3;4-7" のような指定は
+    セミコロン区切りの集合を順に割り当てる。空の場合はピン留めしない。
+    """
+    spec = (spec or "").strip()
+    if not spec or not hasattr(os, "sched_setaffinity"):
+        return [None] * workers
+    if spec == "auto":
+        available = sorted(os.sched_getaffinity(0))
+        size = max(1, len(available) // workers)
+        return [available[i * size:(i + 1) * size] or available for i in range(workers)]
+    core_sets = []
+    for group in spec.split(";"):
+        cores = []
+        for part in group.split(","):
+            part = part.strip()
+            if "-" in part:
+                first, last = part.split("-")
+                cores.extend(range(int(first), int(last) + 1))
+            elif part:
+                cores.append(int(part))
+        core_sets.append(cores)
+    return [core_sets[i % len(core_sets)] for i in range(workers)]
+
+def pin_current_thread(cores):
+    """呼び出し元のスレッド（プロセス）を指定コアに固定する"""
+    if cores:
+        os.sched_setaffinity(0, cores)
+
+# プロセスモードのワーカー側で保持するレプリカ
+_process_replica = None
+
+def _init_process_worker(parent_config, counter, core_sets, statuses, replica_factory=ModelReplica):
+    global config, _process_replica
+    # 親プロセスの設定をそのまま使う
+    config = parent_config
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    cores = core_sets[index % len(core_sets)]
+    if cores:
+        pin_current_thread(cores)
+        torch.set_num_threads(len(cores))
+    _process_replica = replica_factory(index, cores)
+    statuses[index] = _process_replica.info()
+    _process_replica.load()
+    statuses[index] = _process_replica.info()
+
+def _ping_process_worker():
+    return _process_replica.info()
+
+def _warmup_process_worker(barrier, prompts, max_new_tokens, statuses):
+    # 全プロセスが1件ずつ受け取るまで待つ（同じプロセスが2件処理しないようにする）
+    barrier.wait(config.WARMUP_BARRIER_TIMEOUT)
+    if _process_replica.status == "failed":
+        return _process_replica.index
+    return _call_process_worker("warmup", (prompts, max_new_tokens), statuses)
+
+def _call_process_worker(method, args, statuses):
+    replica = _process_replica
+    if replica.status == "failed":
+        raise RuntimeError(f"レプリカ {replica.index} は利用できません: {replica.error}")
+    replica.status = "busy"
+    statuses[replica.index] = replica.info()
     try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"使用デバイス: {device}")
-        pipe = pipeline(
-            "text-generation",
-            model=config.MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device=device
+        return getattr(replica, method)(*args)
+    finally:
+        replica.requests += 1
+        replica.status = "idle"
+        statuses[replica.index] = replica.info()
+
+class WorkerPool:
+    """推論ワーカープール
+
+    スレッドモードでは各スレッドがレプリカを1つ借りて推論する（INFERENCE_SHARE_MODEL=1
+    なら全スレッドで同じ重みを共有する）。プロセスモードではプロセスごとにレプリカを
+    読み込み、割り当てたコアに固定する。イベントループはブロックしない。
+    replica_factory を差し替えるとモデル以外のバックエンド（ベンチマーク用の
+    疑似モデルなど）で動かせる。プロセスモードでは pickle できる必要がある。
+    """
+
+    def __init__(self, mode="thread", workers=1, share_model=False, core_sets=None, replica_factory=ModelReplica):
+        self.mode = mode
+        self.workers = max(1, workers)
+        self.share_model = share_model
+        self.core_sets = core_sets or [None] * self.workers
+        self.replica_factory = replica_factory
+        self.replicas = []
+        self._executor = None
+        self._idle = queue.Queue()
+        self._local = threading.local()
+        self._manager = None
+        self._statuses = None
+        # ワーカープロセスが落ちてプールが使えなくなったときに呼ぶ（引数は理由の文字列）
+        self.on_broken = None
+
+    @property
+    def size(self):
+        """推論を受け付けられるワーカー数"""
+        return max(1, sum(1 for info in self.replica_status() if info["status"] in ("idle", "busy")))
+
+    @property
+    def ready(self):
+        return any(info["status"] in ("idle", "busy") for info in self.replica_status())
+
+    def replica_status(self):
+        if self.mode == "process":
+            if self._statuses is None:
+                return []
+            return [self._statuses[index] for index in sorted(self._statuses.keys())]
+        return [replica.info() for replica in self.replicas]
+
+    def start(self):
+        """レプリカを読み込み、ワーカーを起動する"""
+        if self.mode == "process":
+            self._start_processes()
+        else:
+            self._start_threads()
+
+    def _start_threads(self):
+        global model
+        self.replicas = []
+        self._idle = queue.Queue()
+        for index in range(self.workers):
+            cores = self.core_sets[index]
+            if self.share_model and self.replicas:
+                first = self.replicas[0]
+                if first.status == "failed":
+                    break
+                replica = self.replica_factory(
+                    index, cores, pipe=first.pipe, prompt_cache=first.prompt_cache, draft=first.draft
+                )
+            else:
+                replica = self.replica_factory(index, cores)
+            self.replicas.append(replica)
+            if replica.load():
+                self._idle.put(replica)
+        loaded = [replica for replica in self.replicas if replica.status == "idle"]
+        if loaded:
+            model = loaded[0].pipe
+            self._executor = ThreadPoolExecutor(max_workers=len(loaded), thread_name_prefix="inference")
+
+    def _start_processes(self):
+        ctx = multiprocessing.get_context("spawn")
+        self._manager = ctx.Manager()
+        self._statuses = self._manager.dict()
+        counter = ctx.Value("i", 0)
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=ctx,
+            initializer=_init_process_worker,
+            initargs=(config, counter, self.core_sets, self._statuses, self.replica_factory)
         )
-        model = pipe
-        return pipe
-    except Exception as e:
-        print(f"モデル読み込みエラー: {e}")
-        traceback.print_exc()
-        return None
+        # 全ワーカープロセスを起動してモデルを読み込ませる
+        futures = [self._executor.submit(_ping_process_worker) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
 
-# 起動時の初期化
-@app.on_event("startup")
-async def startup_event():
-    load_model()
+    def submit(self, method, *args):
+        """レプリカのメソッドをワーカーで実行する（concurrent.futures.Future を返す）"""
+        if self._executor is None:
+            raise RuntimeError("推論ワーカーが起動していません")
+        if self.mode == "process":
+            try:
+                future = self._executor.submit(_call_process_worker, method, args, self._statuses)
+            except BrokenProcessPool as e:
+                self._broken(e)
+                raise
+            future.add_done_callback(self._check_broken)
+            return future
+        return self._executor.submit(self._call_thread, method, args)
 
-# ヘルスチェック
-@app.get("/health")
-async def health_check():
-    if model is None:
-        return {"status": "error", "message": "モデルが読み込まれていません"}
-    return {"status": "ok", "model": config.MODEL_NAME}
+    def _check_broken(self, future):
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self._broken(future.exception())
 
-# 議論生成エンドポイント
-@app.post("/generate_argument", response_model=DebateResponse)
-async def generate_argument(request: DebateArgument):
-    if model is None:
-        raise HTTPException(status_code=503, detail="モデルが利用できません")
+    def _broken(self, error):
+        # 壊れたプロセスプールは元に戻らないため、作り直してもらう
+        if self.on_broken is not None:
+            self.on_broken(str(error) or type(error).__name__)
+
+    def warmup(self, prompts, max_new_tokens):
+        """読み込めたレプリカ（プロセス）をそれぞれ1回ずつ温める（Future のリストを返す）"""
+        if self._executor is None:
+            raise RuntimeError("推論ワーカーが起動していません")
+        if self.mode == "process":
+            barrier = self._manager.Barrier(self.workers)
+            return [
+                self._executor.submit(_warmup_process_worker, barrier, prompts, max_new_tokens, self._statuses)
+                for _ in range(self.workers)
+            ]
+        # スレッドモードはレプリカを直接指定する（待ち行列から借りると同じレプリカに偏る）
+        return [
+            self._executor.submit(self._warmup_thread, replica, prompts, max_new_tokens)
+            for replica in self.replicas if replica.status == "idle"
+        ]
+
+    def _warmup_thread(self, replica, prompts, max_new_tokens):
+        if replica.cores and getattr(self._local, "cores", None) != replica.cores:
+            pin_current_thread(replica.cores)
+            self._local.cores = replica.cores
+        try:
+            return replica.warmup(prompts, max_new_tokens)
+        finally:
+            replica.requests += 1
+
+    def _call_thread(self, method, args):
+        replica = self._idle.get()
+        try:
+            if replica.cores and getattr(self._local, "cores", None) != replica.cores:
+                pin_current_thread(replica.cores)
+                self._local.cores = replica.cores
+            replica.status = "busy"
+            return getattr(replica, method)(*args)
+        finally:
+            replica.requests += 1
+            replica.status = "idle"
+            self._idle.put(replica)
+
+    def open_stream(self, loop):
+        """ストリーミング用の (sink, cancel_event, asyncio.Queue, 終了処理) を作る"""
+        output = asyncio.Queue()
+        if self.mode != "process":
+            return LoopQueueSink(loop, output), threading.Event(), output, lambda: None
+
+        # プロセスからの出力をマネージャーのキュー経由で中継する
+        sink = self._manager.Queue()
+        cancel_event = self._manager.Event()
+
+        async def relay():
+            while True:
+                item = await loop.run_in_executor(None, sink.get)
+                await output.put(item)
+                if item is None:
+                    break
+
+        task = loop.create_task(relay())
+        return sink, cancel_event, output, task.cancel
+
+    def errors(self):
+        return [info["error"] for info in self.replica_status() if info.get("error")]
+
+    def shutdown(self):
+        global model
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+            self._statuses = None
+        model = None
+
+class QueueFullError(Exception):
+    """推論キューが上限に達している"""
+
+class BatchScheduler:
+    """リクエストをキューに溜め、互換性のあるプロンプトをまとめて生成するスケジューラ
+
+    待機時間（BATCH_WAIT_MS）内に到着したリクエストを max_tokens と
+    temperature のバケットごとにグループ化し、パディングしたバッチとして
+    ワーカープールで実行する。結果は各リクエストの Future に返す。
+    受け付け中のリクエストが max_pending に達すると QueueFullError を送出する。
+    """
+
+    def __init__(self, pool, max_batch_size=8, wait_ms=20, temperature_bucket=0.05, max_pending=64):
+        self.pool = pool
+        self.max_batch_size = max(1, max_batch_size)
+        self.wait_ms = wait_ms
+        self.temperature_bucket = temperature_bucket
+        self.max_pending = max_pending
+        self.pending = 0
+        self.running = 0
+        self.rejected = 0
+        self._queue = None
+        self._slots = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.pool.size)
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # キューに残ったリクエストは待たせたままにしない
+        while self._queue is not None and not self._queue.empty():
+            _, _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("推論ワーカーが停止しました"))
+
+    def stats(self):
+        return {
+            "queue_depth": self.pending - self.running,
+            "running": self.running,
+            "max_queue": self.max_pending,
+            "rejected": self.rejected
+        }
+
+    def is_full(self):
+        return self.pending >= self.max_pending
+
+    def _admit(self):
+        if self._task is None:
+            raise RuntimeError("バッチスケジューラが起動していません")
+        if self.is_full():
+            self.rejected += 1
+            raise QueueFullError("推論キューが混み合っています")
+        self.pending += 1
+
+    def batch_key(self, prompt, max_new_tokens, temperature, seed=None):
+        """同じバッチにまとめられるリクエストのキー（同じプレフィックスのものをまとめる。シード付きはまとめない）"""
+        if self.temperature_bucket > 0:
+            temperature = round(temperature / self.temperature_bucket) * self.temperature_bucket
+        return (max_new_tokens, round(temperature, 4), match_prefix(prompt), seed)
+
+    async def generate(self, prompt, max_new_tokens, temperature, seed=None):
+        """プロンプトをキューに入れ、生成結果（パイプラインと同じ形式）を待つ"""
+        self._admit()
+        try:
+            future = asyncio.get_running_loop().create_future()
+            future.enqueued_at = time.perf_counter()
+            await self._queue.put((self.batch_key(prompt, max_new_tokens, temperature, seed), prompt, future))
+            return await future
+        finally:
+            self.pending -= 1
+
+    async def run(self, method, *args):
+        """バッチ化しない推論（ストリーミング等）をワーカーで実行する"""
+        self._admit()
+        try:
+            enqueued_at = time.perf_counter()
+            await self._slots.acquire()
+            queue_wait = time.perf_counter() - enqueued_at
+            self.running += 1
+            try:
+                result = await asyncio.wrap_future(self.pool.submit(method, *args))
+                if isinstance(result, dict):
+                    result["queue_wait"] = queue_wait
+                return result
+            finally:
+                self.running -= 1
+                self._slots.release()
+        finally:
+            self.pending -= 1
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            key, prompt, future = await self._queue.get()
+            groups = {key: [(prompt, future)]}
+            deadline = loop.time() + self.wait_ms / 1000
+
+            # 待機時間内に到着したリクエストを集める
+            while max(len(items) for items in groups.values()) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    key, prompt, future = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                groups.setdefault(key, []).append((prompt, future))
+
+            for key, items in groups.items():
+                # シード付きは結果がバッチの構成に左右されないよう1件ずつ生成する
+                size = 1 if key[3] is not None else self.max_batch_size
+                for i in range(0, len(items), size):
+                    await self._slots.acquire()
+                    loop.create_task(self._dispatch(key, items[i:i + size]))
+
+    async def _dispatch(self, key, items):
+        try:
+            # キャンセル済みのリクエストは生成しない
+            items = [(prompt, future) for prompt, future in items if not future.done()]
+            if not items:
+                return
+            max_new_tokens, temperature, _, seed = key
+            prompts = [prompt for prompt, _ in items]
+            dispatched_at = time.perf_counter()
+            self.running += len(items)
+            try:
+                outputs = await asyncio.wrap_future(
+                    self.pool.submit("generate_batch", prompts, max_new_tokens, temperature, seed)
+                )
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            finally:
+                self.running -= len(items)
+            for (_, future), output in zip(items, outputs):
+                output[0].setdefault("metrics", {})["queue_wait"] = dispatched_at - future.enqueued_at
+                if not future.done():
+                    future.set_result(output)
+        finally:
+            self._slots.release()
+
+worker_pool = WorkerPool(
+    mode=config.INFERENCE_MODE,
+    workers=config.INFERENCE_WORKERS,
+    share_model=config.INFERENCE_SHARE_MODEL,
+    core_sets=parse_core_sets(config.INFERENCE_CORES, config.INFERENCE_WORKERS)
+)
+
+scheduler = BatchScheduler(
+    worker_pool,
+    # 投機的デコーディングは1件ずつ生成するため、まとめずに個別に投げる
+    max_batch_size=1 if config.DRAFT_MODEL_NAME else config.BATCH_MAX_SIZE,
+    wait_ms=config.BATCH_WAIT_MS,
+    temperature_bucket=config.TEMPERATURE_BUCKET,
+    max_pending=config.INFERENCE_QUEUE_SIZE
+)
+
+class ResponseCache:
+    """生成結果のキャッシュ
+
+    エンドポイントと正規化したリクエスト項目をキーに、メモリ上の LRU と
+    任意の SQLite 層に TTL 付きで保存する。ヒット・ミスの回数を数える。
+    """
+
+    KEY_FIELDS = (
+        "topic", "stance", "context", "evidence", "perspective", "argument", "url",
+        "max_tokens", "temperature", "seed"
+    )
+
+    def __init__(self, enabled=False, max_entries=1024, ttl=3600, sqlite_path="", sqlite_max_entries=100000,
+                 prune_interval=100):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sqlite_max_entries = sqlite_max_entries
+        self.prune_interval = prune_interval
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if enabled and sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires_at)")
+            self._db.commit()
+
+    @staticmethod
+    def normalize(value):
+        if isinstance(value, str):
+            value = " ".join(unicodedata.normalize("NFKC", value).split())
+            return value or None
+        if isinstance(value, float):
+            return round(value, 4)
+        return value
+
+    def make_key(self, endpoint, request):
+        fields = {
+            name: self.normalize(getattr(request, name))
+            for name in self.KEY_FIELDS if hasattr(request, name)
+        }
+        payload = json.dumps([endpoint, fields], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """キャッシュを引き、(値, 層) を返す（ミス時は (None, None)）"""
+        if not self.enabled:
+            return None, None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value, "memory"
+                del self._entries[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] > now:
+                    self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    self._store_memory(key, row[0], row[1])
+                    self.hits += 1
+                    return row[0], "disk"
+            self.misses += 1
+            return None, None
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._store_memory(key, value, expires_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, value, expires_at, time.time())
+                )
+                # 期限切れと件数超過の削除は prune_interval 回の書き込みごとにまとめて行う
+                self._writes += 1
+                if self._writes >= self.prune_interval:
+                    self._writes = 0
+                    self._prune_disk()
+                self._db.commit()
+
+    async def aget(self, key):
+        """get の非同期版（SQLite 層がある場合はイベントループを止めないようスレッドで引く）"""
+        if self._db is None:
+            return self.get(key)
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key)
+
+    async def aset(self, key, value):
+        if self._db is None:
+            return self.set(key, value)
+        await asyncio.get_running_loop().run_in_executor(None, self.set, key, value)
+
+    def _store_memory(self, key, value, expires_at):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _prune_disk(self):
+        self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+        count = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.sqlite_max_entries:
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                (count - self.sqlite_max_entries,)
+            )
+
+    def info(self, tier=None):
+        """レスポンスに含めるキャッシュ情報"""
+        if not self.enabled:
+            return None
+        return {"hit": tier is not None, "tier": tier, "hits": self.hits, "misses": self.misses}
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "sqlite": self._db is not None
+        }
+
+response_cache = ResponseCache(
+    enabled=config.RESPONSE_CACHE,
+    max_entries=config.RESPONSE_CACHE_MAX_ENTRIES,
+    ttl=config.RESPONSE_CACHE_TTL,
+    sqlite_path=config.RESPONSE_CACHE_SQLITE_PATH,
+    sqlite_max_entries=config.RESPONSE_CACHE_SQLITE_MAX_ENTRIES,
+    prune_interval=config.RESPONSE_CACHE_PRUNE_INTERVAL
+)
+
+# Webページの取得と本文抽出
+META_CHARSET_PATTERN = re.compile(rb"""<meta[^>]+charset=["']?([A-Za-z0-9_\-]+)""", re.IGNORECASE)
 
+def decode_html(body, charset=None):
+    """HTTP ヘッダーまたは meta タグの文字コードで本文をデコードする"""
+    if not charset:
+        match = META_CHARSET_PATTERN.search(body[:4096])
+        if match:
+            charset = match.group(1).decode("ascii")
     try:
+        return body.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
+def extract_article(html):
+    """HTML からタイトルと段落のリストを取り出す"""
+    if LexborHTMLParser is not None:
+        tree = LexborHTMLParser(html)
+        title_node = tree.css_first("title")
+        title = title_node.text(strip=True) if title_node is not None else ""
+        paragraphs = [node.text() for node in tree.css("p")]
+    else:
+        # title と p だけを解析して高速化する
+        soup = BeautifulSoup(html, BS4_PARSER, parse_only=SoupStrainer(["title", "p"]))
+        title = soup.title.get_text().strip() if soup.title else ""
+        paragraphs = [p.get_text() for p in soup.find_all("p")]
+    return title or "No Title", [text for text in paragraphs if text.strip() != ""]
+
+class PageFetcher:
+    """記事ページを取得して本文を抽出する
+
+    コネクションプールを共有する非同期クライアントで取得し、本文は
+    max_bytes までしか読まない。抽出結果は URL ごとにキャッシュし、
+    fresh_seconds を過ぎたら ETag / Last-Modified で再検証する。
+    同じ URL への同時リクエストは1回の取得にまとめる。
+    """
+
+    def __init__(self, timeout=10, max_bytes=2 * 1024 * 1024, max_connections=20, cache_entries=256, fresh_seconds=300):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_connections = max_connections
+        self.cache_entries = cache_entries
+        self.fresh_seconds = fresh_seconds
+        self._client = None
+        self._cache = OrderedDict()
+        self._inflight = {}
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections
+                ),
+                headers={"User-Agent": "DebateAssistantAPI/1.0"}
+            )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def fetch(self, url):
+        """(タイトル, 段落のリスト, 取得情報) を返す"""
+        if url in self._inflight:
+            return await asyncio.shield(self._inflight[url])
+        task = asyncio.get_running_loop().create_task(self._fetch(url))
+        self._inflight[url] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if task.done():
+                self._inflight.pop(url, None)
+            else:
+                task.add_done_callback(lambda _: self._inflight.pop(url, None))
+
+    async def _fetch(self, url):
         start_time = time.time()
-        
-        prompt = f"""Given the topic: {request.topic}, and taking the {request.stance} stance, please construct a persuasive argument for a debate round, keeping the judge as your primary audience.
+        cached = self._cache.get(url)
+        if cached is not None and time.time() - cached["fetched_at"] < self.fresh_seconds:
+            self._cache.move_to_end(url)
+            return cached["title"], cached["paragraphs"], {"source": "cache", "fetch_time": 0.0, "parse_time": 0.0}
 
-{f'Context: {request.context}' if request.context else ''}
+        headers = {}
+        if cached is not None:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        async with self._client.stream("GET", url, headers=headers) as response:
+            if response.status_code == 304 and cached is not None:
+                cached["fetched_at"] = time.time()
+                self._cache.move_to_end(url)
+                return cached["title"], cached["paragraphs"], {
+                    "source": "revalidated", "fetch_time": time.time() - start_time, "parse_time": 0.0
+                }
+            response.raise_for_status()
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes():
+                chunks.append(chunk)
+                size += len(chunk)
+                # 上限を超えた分は読まない
+                if size >= self.max_bytes:
+                    break
+            body = b"".join(chunks)[:self.max_bytes]
+            charset = response.charset_encoding
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+        fetch_time = time.time() - start_time
+
+        # 解析は CPU を使うのでイベントループの外で行う
+        parse_start = time.time()
+        title, paragraphs = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: extract_article(decode_html(body, charset))
+        )
+        parse_time = time.time() - parse_start
+
+        if etag or last_modified or self.fresh_seconds > 0:
+            self._cache[url] = {
+                "title": title,
+                "paragraphs": paragraphs,
+                "etag": etag,
+                "last_modified": last_modified,
+                "fetched_at": time.time()
+            }
+            self._cache.move_to_end(url)
+            while len(self._cache) > self.cache_entries:
+                self._cache.popitem(last=False)
+        return title, paragraphs, {
+            "source": "network", "bytes": len(body), "fetch_time": fetch_time, "parse_time": parse_time
+        }
+
+# 記事本文の圧縮（トピックとの関連度順にトークン予算まで詰める）
+TERM_PATTERN = re.compile(r"[0-9a-z]+|[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff]+")
+SENTENCE_PATTERN = re.compile(r"[^。．！？!?.]+[。．！？!?.]*\s*|[。．！？!?.]+\s*")
+
+def lexical_terms(text):
+    """BM25 用の語に分割する（英数字は単語、日本語は文字バイグラム）"""
+    terms = []
+    for token in TERM_PATTERN.findall(unicodedata.normalize("NFKC", text).lower()):
+        if token.isascii() or len(token) == 1:
+            terms.append(token)
+        else:
+            terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+    return terms
+
+def split_passages(paragraphs, max_chars):
+    """段落を max_chars 以内のパッセージに分割する（長い段落は文単位でまとめる）"""
+    passages = []
+    for paragraph in paragraphs:
+        paragraph = paragraph.strip()
+        if len(paragraph) <= max_chars:
+            passages.append(paragraph)
+            continue
+        current = ""
+        for sentence in SENTENCE_PATTERN.findall(paragraph):
+            while len(sentence) > max_chars:
+                if current.strip():
+                    passages.append(current.strip())
+                    current = ""
+                passages.append(sentence[:max_chars].strip())
+                sentence = sentence[max_chars:]
+            if current and len(current) + len(sentence) > max_chars:
+                passages.append(current.strip())
+                current = ""
+            current += sentence
+        if current.strip():
+            passages.append(current.strip())
+    return [passage for passage in passages if passage]
+
+def bm25_scores(query_terms, documents, k1=1.5, b=0.75):
+    """各文書（語のリスト）のクエリに対する BM25 スコア"""
+    if not documents:
+        return []
+    average_length = sum(len(document) for document in documents) / len(documents) or 1
+    document_frequency = Counter()
+    for document in documents:
+        document_frequency.update(set(document))
+    query = set(query_terms)
+    scores = []
+    for document in documents:
+        frequencies = Counter(document)
+        score = 0.0
+        for term in query:
+            tf = frequencies.get(term)
+            if not tf:
+                continue
+            df = document_frequency[term]
+            idf = math.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(document) / average_length))
+        scores.append(score)
+    return scores
+
+def condense_article(paragraphs, topic, tokenizer, token_budget, max_chars):
+    """記事をパッセージに分け、トピックとの関連度が高い順にトークン予算まで選ぶ
+
+    選んだパッセージは元の文書順に並べ直して返す。トピックがない場合や
+    どのパッセージも一致しない場合は先頭から順に詰める。
+    """
+    passages = split_passages(paragraphs, max_chars)
+    if not passages:
+        return "", {"passages": 0, "selected": 0, "tokens": 0}
+    scores = bm25_scores(lexical_terms(topic), [lexical_terms(p) for p in passages]) if topic else [0.0] * len(passages)
+    token_counts = [len(ids) + 1 for ids in tokenizer(passages, add_special_tokens=False)["input_ids"]]
+
+    selected = []
+    used = 0
+    for index in sorted(range(len(passages)), key=lambda i: (-scores[i], i)):
+        if used + token_counts[index] > token_budget:
+            continue
+        selected.append(index)
+        used += token_counts[index]
+    selected.sort()
+    return "\n".join(passages[i] for i in selected), {
+        "passages": len(passages), "selected": len(selected), "tokens": used
+    }
+
+_budget_tokenizer = None
+
+def get_budget_tokenizer():
+    """トークン予算の計測に使うトークナイザー（推論ワーカーとは別インスタンス）"""
+    global _budget_tokenizer
+    if _budget_tokenizer is None:
+        _budget_tokenizer = AutoTokenizer.from_pretrained(config.MODEL_NAME)
+    return _budget_tokenizer
+
+page_fetcher = PageFetcher(
+    timeout=config.FETCH_TIMEOUT,
+    max_bytes=config.FETCH_MAX_BYTES,
+    max_connections=config.FETCH_MAX_CONNECTIONS,
+    cache_entries=config.PAGE_CACHE_MAX_ENTRIES,
+    fresh_seconds=config.PAGE_CACHE_FRESH_SECONDS
+)
+
+class ModelLoader:
+    """モデルをバックグラウンドで読み込み、準備状態を管理する
+
+    状態は loading → warming → ready の順に進む。レプリカが1つも読み込めない
+    場合やウォームアップに失敗した場合は間隔を倍にしながら再試行し、
+    max_attempts 回失敗すると failed になる。
+    準備完了後にワーカープロセスが落ちた場合は loading に戻し、プールを作り直す。
+    """
+
+    def __init__(self, max_attempts=5, retry_delay=10, warmup_tokens=4):
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self.warmup_tokens = warmup_tokens
+        self.state = "loading"
+        self.attempts = 0
+        self.error = None
+        self.started_at = None
+        self.timings = {}
+        self._task = None
+        self._loop = None
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def start(self):
+        if self._task is None:
+            self.started_at = time.time()
+            self._loop = asyncio.get_running_loop()
+            self._task = self._loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def restart(self, reason):
+        """ワーカーが使えなくなったとき、準備状態を戻してプールを作り直す（どのスレッドからでも呼べる）"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._restart, reason)
+
+    def _restart(self, reason):
+        # 読み込み中・ウォームアップ中の失敗は _run の再試行に任せる
+        if self.state != "ready":
+            return
+        print(f"推論ワーカーが停止したため再読み込みします: {reason}")
+        self.state = "loading"
+        self.error = reason
+        self._task = self._loop.create_task(self._reload())
+
+    async def _reload(self):
+        await scheduler.stop()
+        worker_pool.shutdown()
+        await self._run()
+
+    def info(self):
+        return {
+            "state": self.state,
+            "attempts": self.attempts,
+            "error": self.error,
+            "uptime": time.time() - self.started_at if self.started_at else 0.0,
+            "timings": self.timings
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        delay = self.retry_delay
+        for attempt in range(1, self.max_attempts + 1):
+            self.attempts = attempt
+            self.state = "loading"
+            load_start = time.time()
+            # レプリカの読み込みはイベントループの外で行う
+            try:
+                await loop.run_in_executor(None, worker_pool.start)
+                started = True
+            except Exception as e:
+                # 読み込み中にワーカープロセスが落ちた場合など（BrokenProcessPool）
+                print(f"ワーカー起動エラー: {e}")
+                traceback.print_exc()
+                self.error = str(e) or type(e).__name__
+                started = False
+            self.timings["load"] = time.time() - load_start
+            if started and worker_pool.ready:
+                if config.DRAFT_MODEL_NAME and not any(info.get("speculative") for info in worker_pool.replica_status()):
+                    # ドラフトモデルを読み込めなかった場合は通常のバッチ推論に戻す
+                    scheduler.max_batch_size = max(1, config.BATCH_MAX_SIZE)
+                scheduler.start()
+                self.state = "warming"
+                warmup_start = time.time()
+                try:
+                    await self._warmup()
+                    self.timings["warmup"] = time.time() - warmup_start
+                    self.timings["total"] = time.time() - self.started_at
+                    self.state = "ready"
+                    self.error = None
+                    print(f"モデルの準備完了: {self.timings}")
+                    return
+                except Exception as e:
+                    print(f"ウォームアップエラー: {e}")
+                    traceback.print_exc()
+                    self.error = str(e)
+                    await scheduler.stop()
+            elif started:
+                self.error = "; ".join(worker_pool.errors()) or "レプリカを読み込めませんでした"
+            worker_pool.shutdown()
+            if attempt < self.max_attempts:
+                print(f"{delay:g}秒後にモデルの読み込みを再試行します ({attempt}/{self.max_attempts})")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 300)
+        self.state = "failed"
+
+    async def _warmup(self):
+        prompts = [
+            build_argument_prompt(DebateArgument(topic="warmup", stance="肯定")),
+            build_evidence_prompt(EvidenceAnalysis(evidence="warmup")),
+            build_counter_prompt(CounterArgument(argument="warmup")),
+            build_pass_card_prompt("Warmup", "https://example.com", "warmup")
+        ]
+        # 各レプリカ（プロセス）を1回ずつ温める
+        await asyncio.gather(*[
+            asyncio.wrap_future(future) for future in worker_pool.warmup(prompts, self.warmup_tokens)
+        ])
+
+model_loader = ModelLoader(
+    max_attempts=config.LOAD_MAX_ATTEMPTS,
+    retry_delay=config.LOAD_RETRY_DELAY,
+    warmup_tokens=config.WARMUP_TOKENS
+)
+worker_pool.on_broken = model_loader.restart
+
+# 推論メトリクス（Prometheus テキスト形式で /metrics に出す）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+RATE_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+# timings のキー -> (メトリクス名, 説明, バケット)
+TIMING_METRICS = {
+    "total": ("debate_api_request_seconds", "リクエスト全体の処理時間", LATENCY_BUCKETS),
+    "queue_wait": ("debate_api_queue_wait_seconds", "推論キューでの待ち時間", LATENCY_BUCKETS),
+    "fetch": ("debate_api_fetch_seconds", "Webページの取得時間", LATENCY_BUCKETS),
+    "parse": ("debate_api_parse_seconds", "Webページの解析時間", LATENCY_BUCKETS),
+    "condense": ("debate_api_condense_seconds", "記事の要約（パッセージ選択）時間", LATENCY_BUCKETS),
+    "tokenize": ("debate_api_tokenize_seconds", "プロンプトのトークン化時間", LATENCY_BUCKETS),
+    "prefill": ("debate_api_prefill_seconds", "プロンプト処理（最初のトークンまで）の時間", LATENCY_BUCKETS),
+    "decode": ("debate_api_decode_seconds", "2トークン目以降の生成時間", LATENCY_BUCKETS),
+    "ttft": ("debate_api_time_to_first_token_seconds", "受付から最初のトークンまでの時間", LATENCY_BUCKETS),
+    "prompt_tokens": ("debate_api_prompt_tokens", "プロンプトのトークン数", TOKEN_BUCKETS),
+    "generated_tokens": ("debate_api_generated_tokens", "生成したトークン数", TOKEN_BUCKETS),
+    "tokens_per_second": ("debate_api_tokens_per_second", "デコード時の生成速度", RATE_BUCKETS),
+    "acceptance_rate": ("debate_api_draft_acceptance_rate", "ドラフトモデルの候補の採択率", RATIO_BUCKETS),
+}
+
+class Histogram:
+    """endpoint ラベルごとの累積ヒストグラム"""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, endpoint, value):
+        counts, total = self.series.get(endpoint, ([0] * (len(self.buckets) + 1), 0.0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        self.series[endpoint] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for endpoint, (counts, total) in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{endpoint="{endpoint}",le="{bound:g}"}} {count}')
+            lines.append(f'{self.name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {counts[-1]}')
+            lines.append(f'{self.name}_sum{{endpoint="{endpoint}"}} {total:g}')
+            lines.append(f'{self.name}_count{{endpoint="{endpoint}"}} {counts[-1]}')
+        return lines
+
+class MetricsRegistry:
+    """リクエストごとの timings をヒストグラムとカウンターに集計する"""
+
+    def __init__(self):
+        self.histograms = {key: Histogram(*spec) for key, spec in TIMING_METRICS.items()}
+        self.requests = Counter()
+        self.cache = Counter()
+
+    def record(self, endpoint, timings):
+        for key, value in timings.items():
+            if key in self.histograms and value is not None:
+                self.histograms[key].observe(endpoint, value)
+
+    def record_request(self, path, method, status):
+        self.requests[(path, method, status)] += 1
+
+    def record_cache(self, endpoint, tier):
+        self.cache[(endpoint, tier or "miss")] += 1
+
+    def render(self):
+        lines = []
+        for histogram in self.histograms.values():
+            lines.extend(histogram.render())
+
+        lines += ["# HELP debate_api_requests_total HTTP リクエスト数", "# TYPE debate_api_requests_total counter"]
+        for (path, method, status), count in sorted(self.requests.items()):
+            lines.append(f'debate_api_requests_total{{path="{path}",method="{method}",status="{status}"}} {count}')
+
+        lines += ["# HELP debate_api_cache_lookups_total レスポンスキャッシュの参照結果", "# TYPE debate_api_cache_lookups_total counter"]
+        for (endpoint, result), count in sorted(self.cache.items()):
+            lines.append(f'debate_api_cache_lookups_total{{endpoint="{endpoint}",result="{result}"}} {count}')
+
+        queue_stats = scheduler.stats()
+        ready_replicas = sum(1 for replica in worker_pool.replica_status() if replica["status"] in ("idle", "busy"))
+        gauges = [
+            ("debate_api_queue_depth", "gauge", "推論キューで待っているリクエスト数", queue_stats["queue_depth"]),
+            ("debate_api_running", "gauge", "推論中のリクエスト数", queue_stats["running"]),
+            ("debate_api_rejected_total", "counter", "キュー満杯で拒否したリクエスト数", queue_stats["rejected"]),
+            ("debate_api_ready_replicas", "gauge", "推論可能なレプリカ数", ready_replicas),
+            ("debate_api_model_ready", "gauge", "モデルの準備が完了していれば 1", int(model_loader.ready)),
+        ]
+        for name, kind, help_text, value in gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+def inference_timings(output_metrics, **extra):
+    """ワーカーの計測値をレスポンス用の timings にまとめる（TTFT はサーバー側の推定値）"""
+    timings = dict(extra)
+    for key in (
+        "queue_wait", "tokenize", "prefill", "decode", "prompt_tokens", "generated_tokens", "tokens_per_second",
+        "batch_size", "draft_tokens", "accepted_tokens", "acceptance_rate"
+    ):
+        if key in output_metrics:
+            timings[key] = output_metrics[key]
+    if "ttft" not in timings and "prefill" in timings:
+        timings["ttft"] = sum(timings.get(key) or 0.0 for key in ("fetch", "parse", "condense", "queue_wait", "tokenize", "prefill"))
+    return timings
+
+metrics = MetricsRegistry()
+
+# 起動時の初期化（モデルはバックグラウンドで読み込み、すぐに接続を受け付ける）
+@app.on_event("startup")
+async def startup_event():
+    await page_fetcher.start()
+    model_loader.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await model_loader.stop()
+    await scheduler.stop()
+    await page_fetcher.close()
+    worker_pool.shutdown()
+
+@app.middleware("http")
+async def count_requests(request: Request, call_next):
+    response = await call_next(request)
+    # パスはルートのテンプレートで集計する（未定義のパスは一つにまとめる）
+    route = request.scope.get("route")
+    metrics.record_request(getattr(route, "path", "unmatched"), request.method, response.status_code)
+    return response
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request, exc):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
+# プロンプトテンプレート
+# 固定の指示ブロックを先頭（プレフィックス）に置き、リクエストごとに変わる
+# フィールドは末尾に回す。プレフィックスの KV キャッシュを起動時に作成して再利用する。
+
+# 生成結果から回答部分を切り出すためのマーカー
+ARGUMENT_MARKER = "議論："
+EVIDENCE_MARKER = "分析："
+COUNTER_MARKER = "反論："
+PASS_CARD_MARKER = "パスカード："
+
+ARGUMENT_PREFIX = """You will be given a debate topic and a stance. Construct a persuasive argument for that stance in a debate round, keeping the judge as your primary audience.
 
 Structure your argument clearly using **Labeling** and **Numbering** for the judge. Include the following elements:
 
@@ -125,38 +1701,10 @@ Structure your argument clearly using **Labeling** and **Numbering** for the jud
 If this argument is a main Affirmative Advantage (AD), also ensure it clearly demonstrates **Inherency** (the problem exists in the status quo) and **Solvency** (the plan resolves the problem) [12, 13].
 
 If this argument is a main Negative Disadvantage (DA), also ensure it clearly demonstrates **Uniqueness** (the problem does not happen in the status quo) and **Linkage** (the plan causes the problem) [14].
-""
-議論："""
 
-        outputs = model(
-            prompt,
-            max_new_tokens=request.max_tokens,
-            temperature=request.temperature,
-            do_sample=True
-        )
-
-        response = outputs[0]["generated_text"].split("議論：")[-1].strip()
-        
-        return DebateResponse(
-            generated_text=response,
-            response_time=time.time() - start_time
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-# 証拠分析エンドポイント
-@app.post("/analyze_evidence", response_model=DebateResponse)
-async def analyze_evidence(request: EvidenceAnalysis):
-    if model is None:
-        raise HTTPException(status_code=503, detail="モデルが利用できません")
+"""
 
-    try:
-        start_time = time.time()
-        
-        prompt = f"""Analyze the following evidence for potential use in a debate round, considering the judge's perspective.
-
-Evidence: {request.evidence}
-{f'Perspective: {request.perspective}' if request.perspective else ''}
+EVIDENCE_PREFIX = """Analyze the evidence given below for potential use in a debate round, considering the judge's perspective.
 
 Evaluate the evidence from the following perspectives:
 
@@ -166,119 +1714,448 @@ Evaluate the evidence from the following perspectives:
 4.  **Anticipated Rebuttals:** What attacks could the opponent make against this evidence? (e.g., challenging the source's authority, questioning its recency, pointing out limiting assumptions or context) [19].
 5.  **Utilization Strategy:** How and where in a debate round would this evidence be most effectively used? (e.g., to support a specific sub-point within an AD or DA during a Constructive speech, cited verbally as per debate norms) [18, 21-23].
 
+"""
+
+COUNTER_PREFIX = """Generate an effective refutation against the argument given below for a debate round, structured for clarity for the judge.
+
+Structure your refutation as follows, using **Labeling** and **Numbering** if necessary:
+
+1.  **Sign Posting:** Clearly indicate which specific argument you are responding to (e.g., "Going to their first Advantage, Solvency...") [17].
+2.  **Confirmation:** Briefly restate the opponent's claim or the specific point you are refuting (e.g., "...they said their plan solves the problem.") [17].
+3.  **Conclusion/Label:** State your refutation point clearly and concisely, potentially using a standard debate label if applicable (e.g., "However, No Solvency.") [17, 25].
+4.  **Reasoning:** Provide the logical explanation and evidence (if any) why your conclusion is true and why their argument is flawed. Focus on attacking the **Reasoning** or **Warrant** that connects their claim to their support [9, 26].
+    *   Consider presenting alternative interpretations or evidence that contradict their point [21].
+5.  **Evaluation:** Explain the consequence of your refutation for the opponent's argument and the debate round (e.g., "Therefore, their Solvency is zero," or "This means their Advantage is completely defeated," or "Their DA has no Uniqueness") [17, 25].
+6.  **Identify Type (Optional but helpful):** Briefly explain if this refutation is a "crushing" argument (completely defeats the point) or a "partial" argument (weakens the point) [27].
+
+"""
+
+PASS_CARD_PREFIX = """Extract usable evidence from the article given below for an academic debate. Format it as a Pass Card.
+
+Please extract one strong quote and structure the output as follows:
+
+[Claim/Assertion: (a concise summary of what the quote supports)]
+"(Direct Quote from the source)"
+Author: (If available)
+Title/Position: (If available)
+Year: (Try to infer from metadata or content, approximate if needed)
+Source/Publisher: (Use website title or organization name)
+URL: (The article URL)
+
+"""
+
+# KV キャッシュを事前計算するプレフィックス
+PROMPT_PREFIXES = {
+    "argument": ARGUMENT_PREFIX,
+    "evidence": EVIDENCE_PREFIX,
+    "counter": COUNTER_PREFIX,
+    "pass_card": PASS_CARD_PREFIX,
+}
+
+def build_argument_prompt(request):
+    """議論生成用のプロンプトを組み立てる"""
+    return ARGUMENT_PREFIX + f"""Topic: {request.topic}
+Stance: {request.stance}
+{f'Context: {request.context}' if request.context else ''}
+
+議論："""
+
+def build_evidence_prompt(request):
+    """証拠分析用のプロンプトを組み立てる"""
+    return EVIDENCE_PREFIX + f"""Evidence: {request.evidence}
+{f'Perspective: {request.perspective}' if request.perspective else ''}
+
 分析："""
 
-        outputs = model(
-            prompt,
-            max_new_tokens=request.max_tokens,
-            temperature=request.temperature,
-            do_sample=True
-        )
+def build_counter_prompt(request):
+    """反論生成用のプロンプトを組み立てる"""
+    return COUNTER_PREFIX + f"""Original Argument: {request.argument}
 
-        response = outputs[0]["generated_text"].split("分析：")[-1].strip()
-        
+反論："""
+
+def build_pass_card_prompt(title, url, full_text):
+    """記事からパスカードを作るプロンプトを組み立てる"""
+    return PASS_CARD_PREFIX + f"""Article Title: {title}
+URL: {url}
+
+Article Text:
+\"\"\"
+{full_text}
+\"\"\"
+
+パスカード："""
+
+# ヘルスチェック
+@app.get("/health")
+async def health_check():
+    inference = {
+        "device": inference_device,
+        "precision": inference_precision,
+        "draft_model": config.DRAFT_MODEL_NAME or None,
+        "mode": worker_pool.mode,
+        "workers": worker_pool.workers,
+        "queue": scheduler.stats(),
+        "replicas": worker_pool.replica_status(),
+        "cache": response_cache.stats()
+    }
+    health = {
+        "live": True,
+        "ready": model_loader.ready,
+        "model": config.MODEL_NAME,
+        "loader": model_loader.info(),
+        "inference": inference
+    }
+    if model_loader.state == "failed":
+        return {"status": "error", "message": "モデルが読み込まれていません", **health}
+    if not model_loader.ready:
+        return {"status": "starting", "message": "モデルを準備中です", **health}
+    return {"status": "ok", **health}
+
+# 生存確認（プロセスが応答できれば 200）
+@app.get("/health/live")
+async def liveness_check():
+    return {"live": True}
+
+# Prometheus 形式のメトリクス
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# 準備完了確認（推論を受け付けられるときだけ 200）
+@app.get("/health/ready")
+async def readiness_check():
+    if not model_loader.ready:
+        return JSONResponse(status_code=503, content={"ready": False, "state": model_loader.state})
+    return {"ready": True, "state": model_loader.state}
+
+async def generate_response(endpoint, request, prompt, marker):
+    """キャッシュを確認してから生成し、マーカー以降を DebateResponse として返す"""
+    start_time = time.time()
+
+    cache_key = response_cache.make_key(endpoint, request)
+    cached, tier = await response_cache.aget(cache_key)
+    metrics.record_cache(endpoint, tier)
+    if cached is not None:
         return DebateResponse(
-            generated_text=response,
-            response_time=time.time() - start_time
+            generated_text=cached,
+            response_time=time.time() - start_time,
+            cache=response_cache.info(tier)
         )
+
+    outputs = await scheduler.generate(
+        prompt,
+        max_new_tokens=request.max_tokens,
+        temperature=request.temperature,
+        seed=request.seed
+    )
+
+    response = outputs[0]["generated_text"].split(marker)[-1].strip()
+
+    await response_cache.aset(cache_key, response)
+
+    timings = inference_timings(outputs[0].get("metrics", {}))
+    timings["total"] = time.time() - start_time
+    metrics.record(endpoint, timings)
+
+    return DebateResponse(
+        generated_text=response,
+        response_time=timings["total"],
+        cache=response_cache.info(),
+        timings=timings
+    )
+
+# 議論生成エンドポイント
+@app.post("/generate_argument", response_model=DebateResponse)
+async def generate_argument(request: DebateArgument):
+    if not model_loader.ready:
+        raise HTTPException(status_code=503, detail="モデルが利用できません")
+
+    try:
+        return await generate_response(
+            "generate_argument", request, build_argument_prompt(request), ARGUMENT_MARKER
+        )
+    except QueueFullError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 証拠分析エンドポイント
+@app.post("/analyze_evidence", response_model=DebateResponse)
+async def analyze_evidence(request: EvidenceAnalysis):
+    if not model_loader.ready:
+        raise HTTPException(status_code=503, detail="モデルが利用できません")
+
+    try:
+        return await generate_response(
+            "analyze_evidence", request, build_evidence_prompt(request), EVIDENCE_MARKER
+        )
+    except QueueFullError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # 反論生成エンドポイント
 @app.post("/generate_counter", response_model=DebateResponse)
 async def generate_counter(request: CounterArgument):
-    if model is None:
+    if not model_loader.ready:
         raise HTTPException(status_code=503, detail="モデルが利用できません")
 
     try:
+        return await generate_response(
+            "generate_counter", request, build_counter_prompt(request), COUNTER_MARKER
+        )
+    except QueueFullError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# まとめて生成するエンドポイント
+BATCH_ITEM_TYPES = {
+    "generate_argument": (build_argument_prompt, ARGUMENT_MARKER),
+    "analyze_evidence": (build_evidence_prompt, EVIDENCE_MARKER),
+    "generate_counter": (build_counter_prompt, COUNTER_MARKER),
+}
+
+@app.post("/batch")
+async def generate_batch_items(request: BatchRequest):
+    """複数の議論・証拠分析・反論をまとめて生成し、終わった順に NDJSON で返す"""
+    if not model_loader.ready:
+        raise HTTPException(status_code=503, detail="モデルが利用できません")
+    if len(request.items) > config.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"一度に生成できるのは {config.BATCH_MAX_ITEMS} 件までです")
+    if scheduler.pending + len(request.items) > scheduler.max_pending:
+        raise QueueFullError("推論キューが混み合っています")
+
+    async def run_item(index, item):
+        endpoint = item.endpoint
+        build_prompt, marker = BATCH_ITEM_TYPES[endpoint]
+        try:
+            result = await generate_response(endpoint, item, build_prompt(item), marker)
+            return {"index": index, "endpoint": endpoint, **result.model_dump()}
+        except Exception as e:
+            return {"index": index, "endpoint": endpoint, "error": str(e)}
+
+    async def ndjson_stream():
         start_time = time.time()
-        
-        prompt = f"""Generate an effective refutation against the following argument for a debate round, structured for clarity for the judge:
+        # 全件を同時にキューへ入れ、スケジューラにバッチ化させる
+        tasks = [asyncio.ensure_future(run_item(i, item)) for i, item in enumerate(request.items)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                result["elapsed"] = time.time() - start_time
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            # クライアントが切断した場合は残りを取り消す
+            for task in tasks:
+                task.cancel()
 
-Original Argument: {request.argument}
+    return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
 
-Structure your refutation as follows, using **Labeling** and **Numbering** if necessary:
+# ストリーミング（Server-Sent Events）
+class StreamPostProcessor:
+    """split(marker)[-1].strip() と同じ後処理を逐次的に適用する
 
-1.  **Sign Posting:** Clearly indicate which specific argument you are responding to (e.g., "Going to their first Advantage, Solvency...") [17].
-2.  **Confirmation:** Briefly restate the opponent's claim or the specific point you are refuting (e.g., "...they said their plan solves the problem.") [17].
-3.  **Conclusion/Label:** State your refutation point clearly and concisely, potentially using a standard debate label if applicable (e.g., "However, No Solvency.") [17, 25].
-4.  **Reasoning:** Provide the logical explanation and evidence (if any) why your conclusion is true and why their argument is flawed. Focus on attacking the **Reasoning** or **Warrant** that connects their claim to their support [9, 26].
-    *   Consider presenting alternative interpretations or evidence that contradict their point [21].
-5.  **Evaluation:** Explain the consequence of your refutation for the opponent's argument and the debate round (e.g., "Therefore, their Solvency is zero," or "This means their Advantage is completely defeated," or "Their DA has no Uniqueness") [17, 25].
-6.  **Identify Type (Optional but helpful):** Briefly explain if this refutation is a "crushing" argument (completely defeats the point) or a "partial" argument (weakens the point) [27].
+    マーカーの途中や末尾の空白はまだ確定しないため送信を保留する。
+    生成途中でマーカーが現れて出力が切り替わった場合は reset を返す。
+    """
 
-反論："""
+    def __init__(self, marker):
+        self.marker = marker
+        self.raw = ""
+        self.sent = ""
 
-        outputs = model(
-            prompt,
-            max_new_tokens=request.max_tokens,
-            temperature=request.temperature,
-            do_sample=True
-        )
+    def _segment(self):
+        return self.raw.split(self.marker)[-1].lstrip()
 
-        response = outputs[0]["generated_text"].split("反論：")[-1].strip()
-        
-        return DebateResponse(
-            generated_text=response,
-            response_time=time.time() - start_time
+    def _pending_marker_length(self, text):
+        for length in range(len(self.marker) - 1, 0, -1):
+            if text.endswith(self.marker[:length]):
+                return length
+        return 0
+
+    def _diff(self, text):
+        events = []
+        if text.startswith(self.sent):
+            if len(text) > len(self.sent):
+                events.append(("token", {"text": text[len(self.sent):]}))
+        else:
+            events.append(("reset", {"text": text}))
+        self.sent = text
+        return events
+
+    def feed(self, text):
+        self.raw += text
+        segment = self._segment()
+        stable = segment[:len(segment) - self._pending_marker_length(segment)].rstrip()
+        return self._diff(stable)
+
+    def finish(self):
+        return self._diff(self._segment().strip())
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def stream_generation(endpoint, prompt, marker, request, cache_key):
+    """生成中のトークンを SSE として返すレスポンスを作る（キャッシュにあれば一度に返す）"""
+    async def cached_stream(text, tier, start_time):
+        yield sse_event("token", {"text": text})
+        yield sse_event("done", {
+            "generated_text": text,
+            "response_time": time.time() - start_time,
+            "cache": response_cache.info(tier)
+        })
+
+    async def event_stream():
+        start_time = time.time()
+        first_token_time = None
+        loop = asyncio.get_running_loop()
+        sink, cancel_event, output, close_stream = worker_pool.open_stream(loop)
+        processor = StreamPostProcessor(marker)
+        task = loop.create_task(scheduler.run(
+            "generate_stream", prompt, request.max_tokens, request.temperature, sink, cancel_event, request.seed
+        ))
+        # ワーカーに渡る前に失敗した場合もストリームを終わらせる
+        task.add_done_callback(
+            lambda t: (t.cancelled() or t.exception() is not None) and output.put_nowait(None)
         )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        try:
+            while True:
+                text = await output.get()
+                if text is None:
+                    break
+                if first_token_time is None:
+                    first_token_time = time.time()
+                for event, data in processor.feed(text):
+                    yield sse_event(event, data)
+            output_metrics = await task
+            for event, data in processor.finish():
+                yield sse_event(event, data)
+            await response_cache.aset(cache_key, processor.sent)
+            # ストリーミングでは最初のトークンを受け取った時刻を TTFT とする
+            timings = inference_timings(
+                output_metrics or {},
+                ttft=first_token_time - start_time if first_token_time is not None else None
+            )
+            timings["total"] = time.time() - start_time
+            metrics.record(f"{endpoint}/stream", timings)
+            yield sse_event("done", {
+                "generated_text": processor.sent,
+                "response_time": timings["total"],
+                "cache": response_cache.info(),
+                "timings": timings
+            })
+        except Exception as e:
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            # クライアントが切断した場合は生成を止める
+            cancel_event.set()
+            close_stream()
+
+    cached, tier = await response_cache.aget(cache_key)
+    metrics.record_cache(f"{endpoint}/stream", tier)
+    if cached is not None:
+        stream = cached_stream(cached, tier, time.time())
+    else:
+        stream = event_stream()
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/generate_argument/stream")
+async def generate_argument_stream(request: DebateArgument):
+    if not model_loader.ready:
+        raise HTTPException(status_code=503, detail="モデルが利用できません")
+    if scheduler.is_full():
+        raise QueueFullError("推論キューが混み合っています")
+    cache_key = response_cache.make_key("generate_argument", request)
+    return await stream_generation("generate_argument", build_argument_prompt(request), ARGUMENT_MARKER, request, cache_key)
+
+@app.post("/analyze_evidence/stream")
+async def analyze_evidence_stream(request: EvidenceAnalysis):
+    if not model_loader.ready:
+        raise HTTPException(status_code=503, detail="モデルが利用できません")
+    if scheduler.is_full():
+        raise QueueFullError("推論キューが混み合っています")
+    cache_key = response_cache.make_key("analyze_evidence", request)
+    return await stream_generation("analyze_evidence", build_evidence_prompt(request), EVIDENCE_MARKER, request, cache_key)
+
+@app.post("/generate_counter/stream")
+async def generate_counter_stream(request: CounterArgument):
+    if not model_loader.ready:
+        raise HTTPException(status_code=503, detail="モデルが利用できません")
+    if scheduler.is_full():
+        raise QueueFullError("推論キューが混み合っています")
+    cache_key = response_cache.make_key("generate_counter", request)
+    return await stream_generation("generate_counter", build_counter_prompt(request), COUNTER_MARKER, request, cache_key)
 
 # --- FastAPIルーティング部に追加（他の @app.post の後）---
 @app.post("/generate_evidence_from_url", response_model=DebateResponse)
 async def generate_evidence_from_url(request: EvidenceFromUrl):
-    if model is None:
+    if not model_loader.ready:
         raise HTTPException(status_code=503, detail="モデルが利用できません")
 
     try:
         start_time = time.time()
 
-        # Webページ取得
-        response = requests.get(request.url, timeout=10)
-        response.raise_for_status()
-
-        soup = BeautifulSoup(response.text, "html.parser")
-        title = soup.title.string.strip() if soup.title else "No Title"
-        paragraphs = soup.find_all("p")
-        full_text = "\n".join([p.get_text() for p in paragraphs if p.get_text().strip() != ""])[:3000]
-
-        # モデルプロンプト
-        prompt = f"""
-Extract usable evidence from the following article for an academic debate. Format it as a Pass Card:
+        cache_key = response_cache.make_key("generate_evidence_from_url", request)
+        cached, tier = await response_cache.aget(cache_key)
+        metrics.record_cache("generate_evidence_from_url", tier)
+        if cached is not None:
+            return DebateResponse(
+                generated_text=cached,
+                response_time=time.time() - start_time,
+                cache=response_cache.info(tier)
+            )
 
-Article Title: {title}
-URL: {request.url}
+        # Webページ取得
+        title, paragraphs, fetch_info = await page_fetcher.fetch(request.url)
 
-Article Text:
-\"\"\"
-{full_text}
-\"\"\"
+        # トピックに関連するパッセージをトークン予算内で選ぶ
+        condense_start = time.time()
+        full_text, _ = await asyncio.get_running_loop().run_in_executor(
+            None,
+            lambda: condense_article(
+                paragraphs, request.topic, get_budget_tokenizer(),
+                config.ARTICLE_TOKEN_BUDGET, config.PASSAGE_MAX_CHARS
+            )
+        )
 
-Please extract one strong quote and structure the output as follows:
+        condense_time = time.time() - condense_start
 
-[Claim/Assertion: (a concise summary of what the quote supports)]
-"(Direct Quote from the source)"
-Author: (If available)
-Title/Position: (If available)
-Year: (Try to infer from metadata or content, approximate if needed)
-Source/Publisher: (Use website title or organization name)
-URL: {request.url}
-"""
+        # モデルプロンプト
+        prompt = build_pass_card_prompt(title, request.url, full_text)
 
-        outputs = model(
+        outputs = await scheduler.generate(
             prompt,
             max_new_tokens=request.max_tokens,
             temperature=request.temperature,
-            do_sample=True
+            seed=request.seed
         )
 
-        generated_pass_card = outputs[0]["generated_text"].strip()
+        generated_pass_card = outputs[0]["generated_text"].split(PASS_CARD_MARKER)[-1].strip()
+
+        await response_cache.aset(cache_key, generated_pass_card)
+
+        timings = inference_timings(
+            outputs[0].get("metrics", {}),
+            fetch=fetch_info["fetch_time"],
+            parse=fetch_info["parse_time"],
+            condense=condense_time,
+            page_source=fetch_info["source"]
+        )
+        timings["total"] = time.time() - start_time
+        metrics.record("generate_evidence_from_url", timings)
 
         return DebateResponse(
             generated_text=generated_pass_card,
-            response_time=time.time() - start_time
+            response_time=timings["total"],
+            cache=response_cache.info(),
+            timings=timings
         )
+    except QueueFullError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"エビデンス生成中にエラーが発生しました: {str(e)}")
 
@@ -0,0 +1,338 @@
+"""debate_api の負荷試験・ベンチマーク
+
+app を uvicorn で起動し、4つの POST エンドポイントに指定した同時実行数で
+リクエストを送り、レイテンシ（p50/p95/p99）・スループット・エラー率を JSON で出力する。
+
+バックエンドは2種類:
+  fake  トークンごとの待ち時間と出力長を指定できる疑似モデル（GPU やモデルのダウンロード不要）
+  real  ローカルの小さなモデル（--model で指定）
+
+バッチ処理・キャッシュ・精度などの設定は app と同じ環境変数で切り替える。例:
+  BATCH_MAX_SIZE=1 python benchmark.py --backend fake --concurrency 1,8,32 --output before.json
+  RESPONSE_CACHE=1 python benchmark.py --backend real --model sshleifer/tiny-gpt2 --distinct 8
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import socket
+import hashlib
+import platform
+import threading
+import subprocess
+from functools import partial
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import httpx
+import uvicorn
+
+import app as debate_app
+
+ENDPOINTS = ["generate_argument", "analyze_evidence", "generate_counter", "generate_evidence_from_url"]
+
+# 疑似モデル
+FAKE_WORDS = ["論点", "根拠", "証拠", "影響", "反論", "結論", "したがって", "まず", "次に", "最後に", "重要", "である"]
+
+class FakeReplica(debate_app.ModelReplica):
+    """一定の待ち時間でトークンを返す疑似モデル
+
+    1回の generate はバッチサイズに関係なく prefill_latency + 生成トークン数 × token_latency
+    かかるものとする（メモリ帯域律速のデコードを近似）。
+    """
+
+    def __init__(self, index, cores=None, pipe=None, prompt_cache=None, draft=None,
+                 token_latency=0.02, prefill_latency=0.05, output_tokens=64):
+        super().__init__(index, cores, pipe, prompt_cache, draft)
+        self.token_latency = token_latency
+        self.prefill_latency = prefill_latency
+        self.output_tokens = output_tokens
+
+    def load(self):
+        self.status = "idle"
+        return True
+
+    def fake_tokens(self, prompt, count, seed=None):
+        digest = hashlib.sha256(f"{seed}:{prompt}".encode("utf-8")).digest()
+        return [FAKE_WORDS[digest[i % len(digest)] % len(FAKE_WORDS)] for i in range(count)]
+
+    def fake_metrics(self, prompt, count, batch_size):
+        decode = self.token_latency * max(count - 1, 0)
+        return {
+            "batch_size": batch_size,
+            "tokenize": 0.0,
+            "prefill": self.prefill_latency + self.token_latency,
+            "decode": decode,
+            "prompt_tokens": len(prompt) // 2,
+            "generated_tokens": count,
+            "tokens_per_second": (count - 1) / decode if decode > 0 else 0.0
+        }
+
+    def generate_batch(self, prompts, max_new_tokens, temperature, seed=None):
+        count = min(max_new_tokens, self.output_tokens)
+        time.sleep(self.prefill_latency + self.token_latency * count)
+        return [
+            [{
+                "generated_text": prompt + " ".join(self.fake_tokens(prompt, count, seed)),
+                "metrics": self.fake_metrics(prompt, count, len(prompts))
+            }]
+            for prompt in prompts
+        ]
+
+    def generate_stream(self, prompt, max_new_tokens, temperature, sink, cancel_event, seed=None):
+        count = min(max_new_tokens, self.output_tokens)
+        try:
+            time.sleep(self.prefill_latency)
+            for token in self.fake_tokens(prompt, count, seed):
+                if cancel_event.is_set():
+                    break
+                time.sleep(self.token_latency)
+                sink.put(token + " ")
+            return self.fake_metrics(prompt, count, 1)
+        finally:
+            sink.put(None)
+
+class FakeTokenizer:
+    """トークン予算の計測用（空白区切り・CJK は1文字1トークンとみなす）"""
+
+    def __call__(self, texts, add_special_tokens=False):
+        return {"input_ids": [[0] * len(debate_app.lexical_terms(text)) for text in texts]}
+
+# 記事ページ（/generate_evidence_from_url 用）
+ARTICLE_PARAGRAPHS = [
+    "再生可能エネルギーの導入は電力価格の長期的な安定に寄与するという研究がある。",
+    "一方で、送電網の整備には多額の初期投資が必要であり、地方自治体の負担が課題となっている。",
+    "2023年の調査では、回答者の62%が再生可能エネルギーへの補助金の拡大を支持した。",
+    "蓄電池の価格は過去10年で約80%低下し、太陽光発電の出力変動を吸収しやすくなった。",
+    "Critics argue that intermittency still requires fossil fuel backup during peak demand.",
+]
+
+class ArticleHandler(BaseHTTPRequestHandler):
+    """段落の多い記事ページを返すローカルサーバー"""
+
+    def do_GET(self):
+        paragraphs = "".join(
+            f"<p>{ARTICLE_PARAGRAPHS[i % len(ARTICLE_PARAGRAPHS)]} ({self.path} #{i})</p>" for i in range(40)
+        )
+        body = f"<html><head><title>Article {self.path}</title></head><body>{paragraphs}</body></html>".encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_article_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ArticleHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+# API サーバー
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_api_server(port):
+    server = uvicorn.Server(uvicorn.Config(debate_app.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    return server, thread
+
+def wait_until_ready(base_url, api_thread, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if not api_thread.is_alive():
+            raise RuntimeError("API サーバーを起動できませんでした")
+        try:
+            health = httpx.get(f"{base_url}/health", timeout=5).json()
+            if health["ready"]:
+                return health
+            if health["loader"]["state"] == "failed":
+                raise RuntimeError(f"モデルを読み込めませんでした: {health['loader']['error']}")
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{timeout}秒以内にサーバーの準備が完了しませんでした")
+
+# 負荷生成
+def build_payload(endpoint, key, args, article_url):
+    common = {"max_tokens": args.max_tokens, "temperature": args.temperature}
+    if endpoint == "generate_argument":
+        return {"topic": f"再生可能エネルギーへの補助金を拡大すべきか ({key})", "stance": "肯定", **common}
+    if endpoint == "analyze_evidence":
+        return {"evidence": f"{ARTICLE_PARAGRAPHS[key % len(ARTICLE_PARAGRAPHS)]} ({key})", **common}
+    if endpoint == "generate_counter":
+        return {"argument": f"補助金の拡大は財政を圧迫するため反対である ({key})", **common}
+    return {"url": f"{article_url}/article/{key}", "topic": "再生可能エネルギー 補助金", **common}
+
+def percentile(sorted_values, q):
+    """最近傍順位法のパーセンタイル"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+async def run_level(base_url, endpoint, concurrency, args, article_url):
+    """1つのエンドポイントを指定の同時実行数で叩き、結果を集計する"""
+    latencies = []
+    errors = {}
+    server_timings = {}
+    counter = iter(range(args.requests))
+
+    async def worker(client):
+        for i in counter:
+            payload = build_payload(endpoint, i % args.distinct, args, article_url)
+            start = time.perf_counter()
+            try:
+                response = await client.post(f"{base_url}/{endpoint}", json=payload)
+                elapsed = time.perf_counter() - start
+                if response.status_code != 200:
+                    errors[str(response.status_code)] = errors.get(str(response.status_code), 0) + 1
+                    continue
+                latencies.append(elapsed)
+                for key, value in (response.json().get("timings") or {}).items():
+                    if isinstance(value, (int, float)):
+                        server_timings.setdefault(key, []).append(value)
+            except httpx.HTTPError as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        duration = time.perf_counter() - start
+
+    latencies.sort()
+    error_count = sum(errors.values())
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": args.requests,
+        "succeeded": len(latencies),
+        "errors": errors,
+        "error_rate": error_count / args.requests if args.requests else 0.0,
+        "duration": duration,
+        "throughput": len(latencies) / duration if duration > 0 else 0.0,
+        "latency": {
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None
+        },
+        # サーバーが返した timings の平均（キャッシュヒットでは含まれない）
+        "server_timings": {key: sum(values) / len(values) for key, values in sorted(server_timings.items())}
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+def settings_snapshot():
+    """比較用に結果へ残す設定"""
+    config = debate_app.config
+    keys = [
+        "MODEL_NAME", "PRECISION", "BATCH_MAX_SIZE", "BATCH_WAIT_MS", "PREFIX_CACHE",
+        "INFERENCE_MODE", "INFERENCE_WORKERS", "INFERENCE_QUEUE_SIZE", "RESPONSE_CACHE", "ARTICLE_TOKEN_BUDGET"
+    ]
+    return {key: getattr(config, key) for key in keys if hasattr(config, key)}
+
+def configure_backend(args):
+    """app のワーカープールをベンチマーク用のバックエンドに差し替える"""
+    if args.backend == "fake":
+        debate_app.worker_pool.replica_factory = partial(
+            FakeReplica,
+            token_latency=args.token_latency_ms / 1000,
+            prefill_latency=args.prefill_latency_ms / 1000,
+            output_tokens=args.output_tokens
+        )
+        debate_app.config.PREFIX_CACHE = False
+        debate_app._budget_tokenizer = FakeTokenizer()
+    elif args.model:
+        debate_app.config.MODEL_NAME = args.model
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="debate_api のベンチマーク")
+    parser.add_argument("--backend", choices=["fake", "real"], default="fake")
+    parser.add_argument("--model", help="real バックエンドで使うモデル（省略時は MODEL_NAME）")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="カンマ区切りのエンドポイント名")
+    parser.add_argument("--concurrency", default="1,4,16", help="カンマ区切りの同時実行数")
+    parser.add_argument("--requests", type=int, default=32, help="同時実行数ごとのリクエスト数")
+    parser.add_argument("--distinct", type=int, default=None, help="異なるペイロードの数（小さくするとキャッシュが効く）")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--token-latency-ms", type=float, default=20.0, help="fake: 1トークンあたりの生成時間")
+    parser.add_argument("--prefill-latency-ms", type=float, default=50.0, help="fake: プロンプト処理時間")
+    parser.add_argument("--output-tokens", type=int, default=64, help="fake: 生成するトークン数の上限")
+    parser.add_argument("--port", type=int, default=None, help="API サーバーのポート（省略時は空いているポート）")
+    parser.add_argument("--timeout", type=float, default=300.0, help="1リクエストのタイムアウト秒数")
+    parser.add_argument("--ready-timeout", type=float, default=600.0)
+    parser.add_argument("--output", help="結果の JSON を書き出すファイル（省略時は標準出力）")
+    args = parser.parse_args()
+    if args.distinct is None:
+        args.distinct = args.requests
+    args.distinct = max(1, args.distinct)
+    return args
+
+def main():
+    args = parse_args()
+    configure_backend(args)
+
+    article_server, article_url = start_article_server()
+    port = args.port or free_port()
+    api_server, api_thread = start_api_server(port)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        health = wait_until_ready(base_url, api_thread, args.ready_timeout)
+        results = []
+        for endpoint in [name.strip() for name in args.endpoints.split(",") if name.strip()]:
+            for concurrency in [int(value) for value in args.concurrency.split(",")]:
+                result = asyncio.run(run_level(base_url, endpoint, concurrency, args, article_url))
+                latency = result["latency"]
+                print(
+                    f"{endpoint} c={concurrency}: p50={latency['p50'] or 0:.3f}s p95={latency['p95'] or 0:.3f}s "
+                    f"p99={latency['p99'] or 0:.3f}s {result['throughput']:.2f} req/s errors={result['error_rate']:.1%}",
+                    file=sys.stderr
+                )
+                results.append(result)
+        report = {
+            "backend": args.backend,
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "settings": settings_snapshot(),
+            "inference": health["inference"],
+            "load": {
+                "max_tokens": args.max_tokens,
+                "requests": args.requests,
+                "distinct": args.distinct,
+                "fake": {
+                    "token_latency_ms": args.token_latency_ms,
+                    "prefill_latency_ms": args.prefill_latency_ms,
+                    "output_tokens": args.output_tokens
+                } if args.backend == "fake" else None
+            },
+            "results": results
+        }
+    finally:
+        api_server.should_exit = True
+        api_thread.join(timeout=30)
+        article_server.shutdown()
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ import '@aws-amplify/ui-react/styles.css';
 import axios from 'axios';
 import mermaid from 'mermaid';
 import { io } from 'socket.io-client';
+import WebSocketService from './services/websocket';
 import './App.css';
 
 // 設定を読み込む関数
@@ -17,6 +18,7 @@ const loadConfig = () => {
       userPoolId: window.REACT_APP_CONFIG.userPoolId,
       userPoolClientId: window.REACT_APP_CONFIG.userPoolClientId,
       region: window.REACT_APP_CONFIG.region,
+      webSocketEndpoint: window.REACT_APP_CONFIG.webSocketEndpoint || '',
     };
   }
   
@@ -26,6 +28,7 @@ const loadConfig = () => {
     userPoolId: process.env.REACT_APP_USER_POOL_ID || 'YOUR_USER_POOL_ID',
     userPoolClientId: process.env.REACT_APP_USER_POOL_CLIENT_ID || 'YOUR_USER_POOL_CLIENT_ID',
     region: process.env.REACT_APP_REGION || 'us-east-1',
+    webSocketEndpoint: process.env.REACT_APP_WEBSOCKET_ENDPOINT || '',
   };
 };
 
@@ -44,6 +47,9 @@ Amplify.configure({
 // ChatInterfaceコンポーネントの定義
 function ChatInterface({ signOut, user }) {
   const [messages, setMessages] = useState([]);
+  // サーバー側に保存された会話のIDとバージョン（新しいメッセージだけを送る）
+  const [conversationId, setConversationId] = useState(null);
+  const [conversationVersion, setConversationVersion] = useState(0);
   const [input, setInput] = useState('');
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState(null);
@@ -84,6 +90,11 @@ function ChatInterface({ signOut, user }) {
   const [comments, setComments] = useState({});
   const [evidencePriority, setEvidencePriority] = useState({});
   const socketRef = useRef(null);
+  // チャットの応答を逐次受け取る WebSocket（webSocketEndpoint が未設定なら REST を使う）
+  const chatSocketRef = useRef(null);
+  const chatSocketReady = useRef(false);
+  const pendingChatId = useRef(null);
+  const [streaming, setStreaming] = useState(false);
 
   // Mermaidの初期化
   useEffect(() => {
@@ -124,6 +135,91 @@ function ChatInterface({ signOut, user }) {
     }
   };
 
+  // チャットのストリーミング用 WebSocket の接続
+  useEffect(() => {
+    if (!config.webSocketEndpoint) return;
+    let ws = null;
+    let closed = false;
+
+    const finishChat = () => {
+      pendingChatId.current = null;
+      setStreaming(false);
+      setLoading(false);
+    };
+
+    const connect = async () => {
+      // 接続時のオーソライザーが ID トークンを検証し、ユーザーの会話履歴を使えるようにする
+      const session = await Auth.currentSession();
+      const idToken = session.getIdToken().getJwtToken();
+      if (closed) return;
+      ws = new WebSocketService(`${config.webSocketEndpoint}?token=${encodeURIComponent(idToken)}`);
+
+      ws.on('connected', () => {
+        chatSocketReady.current = true;
+      });
+      ws.on('disconnected', () => {
+        chatSocketReady.current = false;
+        if (pendingChatId.current) {
+          setError('接続が切断されました。もう一度送信してください');
+          finishChat();
+        }
+      });
+
+      // 差分は同じリクエストの応答に追記していく
+      ws.on('chatDelta', (data) => {
+        if (data.requestId !== pendingChatId.current) return;
+        setStreaming(true);
+        setMessages(prev => {
+          const last = prev[prev.length - 1];
+          if (last && last.requestId === data.requestId) {
+            return [...prev.slice(0, -1), { ...last, content: last.content + data.text }];
+          }
+          return [...prev, { role: 'assistant', content: data.text, requestId: data.requestId }];
+        });
+      });
+
+      ws.on('chatDone', (data) => {
+        if (data.requestId !== pendingChatId.current) return;
+        setMessages(prev => [
+          ...prev.filter(msg => msg.requestId !== data.requestId),
+          { role: 'assistant', content: data.response }
+        ]);
+        if (data.conversationId) {
+          setConversationId(data.conversationId);
+          setConversationVersion(data.version);
+        }
+        finishChat();
+      });
+
+      ws.on('chatError', (data) => {
+        if (data.requestId !== pendingChatId.current) return;
+        if (data.conflict) {
+          // 別の画面で会話が更新されていた場合は最新の履歴に合わせる
+          setMessages(data.conversationHistory);
+          setConversationId(data.conversationId);
+          setConversationVersion(data.version);
+          setError('会話が別の画面で更新されました。もう一度送信してください');
+        } else {
+          setMessages(prev => prev.filter(msg => msg.requestId !== data.requestId));
+          setError(`エラーが発生しました: ${data.error}`);
+        }
+        finishChat();
+      });
+
+      ws.connect();
+      chatSocketRef.current = ws;
+    };
+
+    connect().catch(err => console.error('チャット用 WebSocket の接続に失敗しました:', err));
+
+    return () => {
+      closed = true;
+      chatSocketReady.current = false;
+      chatSocketRef.current = null;
+      if (ws) ws.disconnect();
+    };
+  }, []);
+
   // メッセージが追加されたら自動スクロール
   useEffect(() => {
     scrollToBottom();
@@ -144,6 +240,14 @@ function ChatInterface({ signOut, user }) {
     setLoading(true);
     setError(null);
 
+    if (chatSocketRef.current && chatSocketReady.current) {
+      // 応答は chatDelta で少しずつ届き、chatDone で会話のバージョンが返る
+      const requestId = `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+      pendingChatId.current = requestId;
+      chatSocketRef.current.sendChat(requestId, userMessage, { conversationId, version: conversationVersion });
+      return;
+    }
+
     try {
       // 認証トークンを取得
       const session = await Auth.currentSession();
@@ -151,7 +255,8 @@ function ChatInterface({ signOut, user }) {
 
       const response = await axios.post(config.apiEndpoint, {
         message: userMessage,
-        conversationHistory: messages
+        conversationId,
+        version: conversationVersion
       }, {
         headers: {
           'Authorization': idToken,
@@ -161,12 +266,24 @@ function ChatInterface({ signOut, user }) {
 
       if (response.data.success) {
         setMessages(prev => [...prev, { role: 'assistant', content: response.data.response }]);
+        if (response.data.conversationId) {
+          setConversationId(response.data.conversationId);
+          setConversationVersion(response.data.version);
+        }
       } else {
         setError('応答の取得に失敗しました');
       }
     } catch (err) {
       console.error("API Error:", err);
-      setError(`エラーが発生しました: ${err.message}`);
+      if (err.response?.status === 409) {
+        // 別の画面で会話が更新されていた場合は最新の履歴に合わせる
+        setMessages(err.response.data.conversationHistory);
+        setConversationId(err.response.data.conversationId);
+        setConversationVersion(err.response.data.version);
+        setError('会話が別の画面で更新されました。もう一度送信してください');
+      } else {
+        setError(`エラーが発生しました: ${err.message}`);
+      }
     } finally {
       setLoading(false);
     }
@@ -175,6 +292,8 @@ function ChatInterface({ signOut, user }) {
   // 会話をクリア
   const clearConversation = () => {
     setMessages([]);
+    setConversationId(null);
+    setConversationVersion(0);
   };
 
   // エビデンス要件の更新
@@ -1107,7 +1226,7 @@ function ChatInterface({ signOut, user }) {
                 ))
               )}
               
-              {loading && (
+              {loading && !streaming && (
                 <div className="message assistant loading">
                   <div className="typing-indicator">
                     <span></span>
@@ -1,6 +1,7 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import WebSocketService from './services/websocket';
-import { AuthUser } from '@aws-amplify/auth';
+import { FlowchartPatch, FlowchartSync, applyOps, applySync, diffFlowchart } from './services/flowchartPatch';
+import { AuthUser, fetchAuthSession } from '@aws-amplify/auth';
 
 interface ChatInterfaceProps {
   signOut: () => void;
@@ -51,65 +52,148 @@ function ChatInterface({ signOut, user }: ChatInterfaceProps) {
   const [comments, setComments] = useState<Record<string, Comment[]>>({});
   const [teamMembers, setTeamMembers] = useState<TeamMember[]>([]);
   const [selectedFlowchart, setSelectedFlowchart] = useState<FlowchartData | null>(null);
+  // 開いているフロー図のID と、サーバーで確定したそのバージョン（パッチの基準）
+  const flowchartId = useRef<string | undefined>(undefined);
+  const flowchartVersion = useRef(0);
   const config = {
     webSocketEndpoint: process.env.REACT_APP_WEBSOCKET_ENDPOINT || '',
   };
 
   // WebSocket接続の初期化
   useEffect(() => {
-    const ws = new WebSocketService(config.webSocketEndpoint);
-    
-    ws.on('connected', () => {
-      console.log('WebSocket接続が確立されました');
-    });
+    let socket: WebSocketService | null = null;
+    let closed = false;
+
+    const connect = async () => {
+      // 接続時のオーソライザーが ID トークンを検証し、接続をユーザーの所属チームに結びつける
+      const session = await fetchAuthSession();
+      const idToken = session.tokens?.idToken?.toString() || '';
+      if (closed) return;
+      const ws = new WebSocketService(`${config.webSocketEndpoint}?token=${encodeURIComponent(idToken)}`);
+      socket = ws;
+
+      ws.on('connected', () => {
+        console.log('WebSocket接続が確立されました');
+        // 開いているフロー図があれば、切断中の変更に追いつく
+        if (flowchartId.current) {
+          ws.requestFlowchartSync(flowchartId.current, flowchartVersion.current);
+        }
+      });
 
-    ws.on('disconnected', () => {
-      console.log('WebSocket接続が切断されました');
-    });
+      ws.on('disconnected', () => {
+        console.log('WebSocket接続が切断されました');
+      });
 
-    ws.on('error', (error: Error) => {
-      console.error('WebSocketエラー:', error);
-      setError('WebSocket接続エラーが発生しました');
-    });
+      ws.on('error', (error: Error) => {
+        console.error('WebSocketエラー:', error);
+        setError('WebSocket接続エラーが発生しました');
+      });
 
-    ws.on('flowchartUpdate', (data: { userId: string; flowchart: LogicFlowData }) => {
-      if (data.userId !== user.username) {
-        setLogicFlow(data.flowchart);
-      }
-    });
+      ws.on('flowchartUpdate', (data: { userId: string; flowchart: LogicFlowData }) => {
+        if (data.userId !== user.username) {
+          setLogicFlow(data.flowchart);
+        }
+      });
 
-    ws.on('newComment', (data: { nodeId: string; comment: Comment }) => {
-      setComments((prev: Record<string, Comment[]>) => ({
-        ...prev,
-        [data.nodeId]: [...(prev[data.nodeId] || []), data.comment]
-      }));
-    });
+      // 他のメンバーの変更はパッチで届く。バージョンが飛んだ場合は足りない分を取り寄せる
+      ws.on('flowchartPatch', (data: FlowchartPatch & { flowchartId: string }) => {
+        if (data.flowchartId !== flowchartId.current) {
+          return;
+        }
+        if (data.version === flowchartVersion.current + 1) {
+          flowchartVersion.current = data.version;
+          setLogicFlow((prev: LogicFlowData | null) => applyOps(prev || { nodes: [], edges: [] }, data.ops));
+        } else if (data.version > flowchartVersion.current) {
+          ws.requestFlowchartSync(data.flowchartId, flowchartVersion.current);
+        }
+      });
 
-    ws.on('teamUpdate', (data: { actionType: string; user: TeamMember; userId: string }) => {
-      if (data.actionType === 'join_team') {
-        setTeamMembers((prev: TeamMember[]) => [...prev, data.user]);
-      } else if (data.actionType === 'leave_team') {
-        setTeamMembers((prev: TeamMember[]) => prev.filter((member: TeamMember) => member.id !== data.userId));
-      }
-    });
+      // 自分のパッチが他のメンバーのパッチの上に積み直された場合、ack のバージョンは飛ぶ。
+      // 間のパッチを取り込むまではバージョンを進めず、足りない分を取り寄せる
+      ws.on('flowchartAck', (data: { flowchartId: string; version: number }) => {
+        if (data.flowchartId !== flowchartId.current) {
+          return;
+        }
+        if (data.version === flowchartVersion.current + 1) {
+          flowchartVersion.current = data.version;
+        } else if (data.version > flowchartVersion.current + 1) {
+          ws.requestFlowchartSync(data.flowchartId, flowchartVersion.current);
+        }
+      });
 
-    ws.connect();
-    setWebSocket(ws);
+      ws.on('flowchartSync', (data: FlowchartSync) => {
+        if (data.flowchartId === flowchartId.current && data.version >= flowchartVersion.current) {
+          setLogicFlow((prev: LogicFlowData | null) => applySync(prev || { nodes: [], edges: [] }, data));
+          flowchartVersion.current = data.version;
+        }
+      });
+
+      // 競合した場合、こちらの変更は保存されていない（重ならない操作も含めて）。
+      // 競合の応答はバージョン 0 からの同期なので、画面のフロー図をサーバーの状態で作り直す
+      ws.on('flowchartConflict', (data: FlowchartSync) => {
+        if (data.flowchartId !== flowchartId.current) {
+          return;
+        }
+        setLogicFlow(applySync({ nodes: [], edges: [] }, data));
+        if (data.version < flowchartVersion.current) {
+          // 応答より新しいパッチをすでに適用していた場合は、その分を取り寄せ直す
+          ws.requestFlowchartSync(data.flowchartId, data.version);
+        }
+        flowchartVersion.current = data.version;
+      });
+
+      ws.on('newComment', (data: { nodeId: string; comment: Comment }) => {
+        setComments((prev: Record<string, Comment[]>) => ({
+          ...prev,
+          [data.nodeId]: [...(prev[data.nodeId] || []), data.comment]
+        }));
+      });
+
+      ws.on('teamUpdate', (data: { actionType: string; user: TeamMember; userId: string }) => {
+        if (data.actionType === 'join_team') {
+          setTeamMembers((prev: TeamMember[]) => [...prev, data.user]);
+        } else if (data.actionType === 'leave_team') {
+          setTeamMembers((prev: TeamMember[]) => prev.filter((member: TeamMember) => member.id !== data.userId));
+        }
+      });
+
+      ws.connect();
+      setWebSocket(ws);
+    };
+
+    connect().catch((error: Error) => {
+      console.error('WebSocket接続エラー:', error);
+      setError('WebSocket接続エラーが発生しました');
+    });
 
     return () => {
-      ws.disconnect();
+      closed = true;
+      socket?.disconnect();
     };
   }, [user.username]);
 
+  // フロー図を開いた・切り替えたときは、バージョン 0 から最新のスナップショットとパッチを取り寄せる
+  useEffect(() => {
+    flowchartId.current = selectedFlowchart?.id;
+    flowchartVersion.current = 0;
+    setLogicFlow(null);
+    if (webSocket && selectedFlowchart?.id) {
+      webSocket.requestFlowchartSync(selectedFlowchart.id, 0);
+    }
+  }, [webSocket, selectedFlowchart?.id]);
+
   // フロー図の更新時の処理を更新
   const updateFlowchart = (newFlowchart: LogicFlowData) => {
+    const ops = diffFlowchart(logicFlow, newFlowchart);
     setLogicFlow(newFlowchart);
-    if (webSocket) {
-      webSocket.sendFlowchartUpdate({
+    if (webSocket && ops.length > 0) {
+      // フロー図全体ではなく変更した要素だけを送る
+      webSocket.sendFlowchartPatch({
         userId: user.username,
         teamId: selectedFlowchart?.teamId,
         flowchartId: selectedFlowchart?.id,
-        flowchart: newFlowchart
+        version: flowchartVersion.current,
+        ops
       });
     }
   };
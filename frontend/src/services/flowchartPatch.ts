@@ -0,0 +1,67 @@
+// フロー図のパッチ（lambda/flowchart_store.py と同じ形式）
+// { op: 'put', collection: 'nodes', value: {...} } / { op: 'remove', collection: 'edges', id: '...' }
+
+export type FlowchartCollection = 'nodes' | 'edges';
+
+export type FlowchartOp =
+  | { op: 'put'; collection: FlowchartCollection; value: { id: string; [key: string]: any } }
+  | { op: 'remove'; collection: FlowchartCollection; id: string };
+
+export interface FlowchartPatch {
+  version: number;
+  ops: FlowchartOp[];
+  userId?: string;
+}
+
+export interface FlowchartSync {
+  flowchartId: string;
+  version: number;
+  snapshot?: { version: number; flowchart: any };
+  patches: FlowchartPatch[];
+}
+
+const COLLECTIONS: FlowchartCollection[] = ['nodes', 'edges'];
+
+// 変更前後のフロー図から、変わった要素だけの操作を作る
+export function diffFlowchart(before: any, after: any): FlowchartOp[] {
+  const ops: FlowchartOp[] = [];
+  COLLECTIONS.forEach((collection) => {
+    const previous = new Map<string, any>((before?.[collection] || []).map((element: any) => [element.id, element]));
+    const next = new Map<string, any>((after?.[collection] || []).map((element: any) => [element.id, element]));
+    next.forEach((element, id) => {
+      if (JSON.stringify(previous.get(id)) !== JSON.stringify(element)) {
+        ops.push({ op: 'put', collection, value: element });
+      }
+    });
+    previous.forEach((_, id) => {
+      if (!next.has(id)) {
+        ops.push({ op: 'remove', collection, id });
+      }
+    });
+  });
+  return ops;
+}
+
+export function applyOps<T extends { nodes: any[]; edges: any[] }>(document: T, ops: FlowchartOp[]): T {
+  const elements = {
+    nodes: new Map<string, any>(document.nodes.map((element) => [element.id, element])),
+    edges: new Map<string, any>(document.edges.map((element) => [element.id, element])),
+  };
+  ops.forEach((op) => {
+    if (op.op === 'put') {
+      elements[op.collection].set(op.value.id, op.value);
+    } else {
+      elements[op.collection].delete(op.id);
+    }
+  });
+  return { ...document, nodes: Array.from(elements.nodes.values()), edges: Array.from(elements.edges.values()) };
+}
+
+// flowchart_sync / flowchart_conflict の内容を現在のフロー図に適用する
+export function applySync<T extends { nodes: any[]; edges: any[] }>(document: T, sync: FlowchartSync): T {
+  let result = sync.snapshot ? { ...document, ...sync.snapshot.flowchart } : document;
+  sync.patches.forEach((patch) => {
+    result = applyOps(result, patch.ops);
+  });
+  return result;
+}
@@ -65,12 +65,37 @@ class WebSocketService {
       case 'flowchart_update':
         this.eventEmitter.emit('flowchartUpdate', data.data);
         break;
+      case 'flowchart_patch':
+        this.eventEmitter.emit('flowchartPatch', data.data);
+        break;
+      case 'flowchart_ack':
+        this.eventEmitter.emit('flowchartAck', data.data);
+        break;
+      case 'flowchart_conflict':
+        this.eventEmitter.emit('flowchartConflict', data.data);
+        break;
+      case 'flowchart_sync':
+        this.eventEmitter.emit('flowchartSync', data.data);
+        break;
       case 'new_comment':
         this.eventEmitter.emit('newComment', data.data);
         break;
       case 'team_update':
         this.eventEmitter.emit('teamUpdate', data.data);
         break;
+      case 'chat_delta':
+        this.eventEmitter.emit('chatDelta', data.data);
+        break;
+      case 'chat_done':
+        this.eventEmitter.emit('chatDone', data.data);
+        break;
+      case 'chat_error':
+        this.eventEmitter.emit('chatError', data.data);
+        break;
+      case 'batch':
+        // サーバーが短い間隔の更新をまとめて送ってきたもの
+        data.data.forEach((message: any) => this.handleMessage(message));
+        break;
       default:
         console.warn('未知のメッセージタイプ:', data.type);
     }
@@ -83,6 +108,23 @@ class WebSocketService {
     });
   }
 
+  // 基準バージョンに対する変更だけを送る（flowchartAck で新しいバージョン、
+  // 同じ要素が先に変更されていた場合は flowchartConflict が届く）
+  sendFlowchartPatch(patchData: { flowchartId?: string; teamId?: string; userId: string; version: number; ops: any[] }) {
+    this.send({
+      type: 'flowchart_update',
+      data: patchData
+    });
+  }
+
+  // version 以降のスナップショットとパッチを要求する（flowchartSync で届く）
+  requestFlowchartSync(flowchartId: string, version: number) {
+    this.send({
+      type: 'flowchart_sync',
+      data: { flowchartId, version }
+    });
+  }
+
   sendComment(commentData: any) {
     this.send({
       type: 'comment',
@@ -97,6 +139,19 @@ class WebSocketService {
     });
   }
 
+  // 応答は chatDelta（差分）→ chatDone（全文と会話のバージョン）の順に届く
+  // 会話履歴はサーバーに保存されるため会話IDとバージョンだけを送る（conversationHistory を送ると従来どおり）
+  sendChat(
+    requestId: string,
+    message: string,
+    conversation: { conversationId?: string | null; version?: number; conversationHistory?: any[]; contextSummary?: any }
+  ) {
+    this.send({
+      type: 'chat',
+      data: { requestId, message, ...conversation }
+    });
+  }
+
   private send(data: any) {
     if (this.socket?.readyState === WebSocket.OPEN) {
       this.socket.send(JSON.stringify(data));
@@ -0,0 +1,67 @@
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import observability
+
+# 同時に送信する数（管理 API クライアントの接続プールも同じ大きさにする）
+BROADCAST_MAX_WORKERS = int(os.environ.get("BROADCAST_MAX_WORKERS", "16"))
+
+_clients = {}
+_executor = ThreadPoolExecutor(max_workers=BROADCAST_MAX_WORKERS)
+
+def management_client(endpoint_url):
+    """エンドポイントごとの apigatewaymanagementapi クライアント（warm な Lambda 内で使い回す）"""
+    if endpoint_url not in _clients:
+        _clients[endpoint_url] = boto3.client(
+            'apigatewaymanagementapi',
+            endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=BROADCAST_MAX_WORKERS, tcp_keepalive=True)
+        )
+    return _clients[endpoint_url]
+
+def post(apigateway, connection_id, payload):
+    """1つの接続に送り、"sent" / "gone" / "failed" を返す"""
+    try:
+        apigateway.post_to_connection(ConnectionId=connection_id, Data=payload)
+        return "sent"
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'GoneException':
+            return "gone"
+        observability.warning("Failed to send message", connectionId=connection_id, error=str(e))
+        return "failed"
+    except Exception as e:
+        observability.warning("Failed to send message", connectionId=connection_id, error=str(e))
+        return "failed"
+
+def broadcast(apigateway, connection_ids, data, exclude=None, on_gone=None):
+    """接続のリストに同じメッセージを並列に送る
+
+    exclude は送らない接続ID（1つかその集合）。本文の JSON は1回だけ作る。
+    切れていた接続は集めて on_gone にまとめて渡す（1回の一括削除用）。
+    {"sent", "gone", "failed", "elapsed"} を返す。
+    """
+    start = time.perf_counter()
+    excluded = {exclude} if isinstance(exclude, str) else set(exclude or ())
+    targets = [connection_id for connection_id in dict.fromkeys(connection_ids) if connection_id not in excluded]
+    payload = json.dumps(data)
+    results = list(_executor.map(lambda connection_id: post(apigateway, connection_id, payload), targets))
+
+    gone = [connection_id for connection_id, result in zip(targets, results) if result == "gone"]
+    if gone and on_gone is not None:
+        try:
+            on_gone(gone)
+        except Exception as e:
+            observability.error("Failed to delete gone connections", count=len(gone), error=str(e))
+
+    stats = {
+        "sent": results.count("sent"),
+        "gone": len(gone),
+        "failed": results.count("failed"),
+        "elapsed": round(time.perf_counter() - start, 4)
+    }
+    observability.info("Broadcast", type=data.get('type'), **stats)
+    return stats
@@ -0,0 +1,161 @@
+"""チャット Lambda のコールドスタート計測（オフライン）
+
+新しいプロセスごとに index の import（初期化フェーズ）と最初の呼び出し、2回目の呼び出しに
+かかる時間を測り、中央値などを JSON で出力する。Bedrock は botocore の Stubber で
+置き換えるため、ネットワークや認証情報は不要。
+
+  python cold_start_benchmark.py --runs 20
+  python cold_start_benchmark.py --importtime   # import に時間のかかるモジュールを表示
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import contextlib
+
+LAMBDA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 子プロセスの環境（実際の認証情報や DynamoDB を使わない）
+CHILD_ENV = {
+    "AWS_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_SESSION_TOKEN": "testing",
+    "AWS_EC2_METADATA_DISABLED": "true",
+    "CONVERSATIONS_TABLE": "",
+    "CONVERSATION_TURNS_TABLE": "",
+}
+
+class FakeContext:
+    invoked_function_arn = "arn:aws:lambda:us-east-1:123456789012:function:ChatFunction"
+    function_name = "ChatFunction"
+    aws_request_id = "benchmark"
+
+def chat_event(message):
+    return {
+        "requestContext": {"authorizer": {"claims": {"sub": "benchmark-user", "email": "bench@example.com"}}},
+        "body": json.dumps({"message": message, "conversationHistory": []})
+    }
+
+def stub_invoke_model(stubber, text):
+    from botocore.response import StreamingBody
+    body = json.dumps({
+        "output": {"message": {"role": "assistant", "content": [{"text": text}]}},
+        "stopReason": "end_turn",
+        "usage": {"inputTokens": 10, "outputTokens": 10}
+    }).encode("utf-8")
+    stubber.add_response("invoke_model", {
+        "body": StreamingBody(io.BytesIO(body), len(body)),
+        "contentType": "application/json"
+    })
+
+def run_child():
+    """1回分の計測（子プロセスで実行し、結果を JSON で1行出力する）"""
+    start = time.perf_counter()
+    sys.path.insert(0, LAMBDA_DIR)
+    import index
+    imported = time.perf_counter()
+
+    from botocore.stub import Stubber
+    stubber = Stubber(index.bedrock_client)
+    stub_invoke_model(stubber, "こんにちは")
+    stub_invoke_model(stubber, "こんにちは")
+    stubber.activate()
+
+    # ハンドラーのログは計測結果と混ざらないよう捨てる
+    with contextlib.redirect_stdout(io.StringIO()):
+        first_start = time.perf_counter()
+        first = index.lambda_handler(chat_event("こんにちは"), FakeContext())
+        first_end = time.perf_counter()
+        second = index.lambda_handler(chat_event("もう一度"), FakeContext())
+        second_end = time.perf_counter()
+
+    print(json.dumps({
+        "import": imported - start,
+        "first_invoke": first_end - first_start,
+        "warm_invoke": second_end - first_end,
+        "status": [first["statusCode"], second["statusCode"]],
+        "modules": len(sys.modules)
+    }))
+
+def child_env():
+    env = dict(os.environ)
+    env.update(CHILD_ENV)
+    return env
+
+def measure_once():
+    """新しいインタープリターで1回計測する（プロセス起動を含む全体時間も測る）"""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        capture_output=True, text=True, env=child_env(), check=True
+    )
+    total = time.perf_counter() - start
+    sample = json.loads(result.stdout.strip().splitlines()[-1])
+    sample["process_total"] = total
+    return sample
+
+def summarize(values):
+    ordered = sorted(values)
+    return {
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "p90": ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))],
+        "max": ordered[-1]
+    }
+
+def import_profile(top):
+    """-X importtime で index の import に時間のかかるモジュールを調べる"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import index"],
+        capture_output=True, text=True, env=child_env(), cwd=LAMBDA_DIR, check=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line.split(":", 1)[1].split("|")]
+        rows.append({"module": name, "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+    rows.sort(key=lambda row: row["cumulative_ms"], reverse=True)
+    return rows[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description="チャット Lambda のコールドスタート計測")
+    parser.add_argument("--runs", type=int, default=10, help="計測するプロセス数")
+    parser.add_argument("--importtime", action="store_true", help="import に時間のかかるモジュールを表示する")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--output", help="結果の JSON を書き出すファイル（省略時は標準出力）")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child()
+        return
+
+    samples = [measure_once() for _ in range(args.runs)]
+    report = {
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "status": sorted({code for sample in samples for code in sample["status"]}),
+        "modules": samples[0]["modules"],
+        "timings": {
+            key: summarize([sample[key] for sample in samples])
+            for key in ("import", "first_invoke", "warm_invoke", "process_total")
+        }
+    }
+    if args.importtime:
+        report["slowest_imports"] = import_profile(args.top)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
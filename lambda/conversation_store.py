@@ -0,0 +1,168 @@
+import os
+import time
+import uuid
+import boto3
+from botocore.exceptions import ClientError
+
+class ConversationConflictError(Exception):
+    """クライアントの会話バージョンが保存済みのものと一致しない"""
+
+    def __init__(self, conversation_id, version, messages):
+        super().__init__(f"Conversation {conversation_id} has been updated (current version: {version})")
+        self.conversation_id = conversation_id
+        self.version = version
+        self.messages = messages
+
+def to_attribute(message):
+    return {'M': {'role': {'S': message['role']}, 'content': {'S': message['content']}}}
+
+def from_attribute(attribute):
+    message = attribute['M']
+    return {'role': message['role']['S'], 'content': message['content']['S']}
+
+class ConversationStore:
+    """会話履歴を DynamoDB に保存する（キーは Cognito の sub と会話ID）
+
+    会話テーブルには会話ごとのメタ情報（version、発言数 messageCount、古いやりとりの
+    要約 summary と要約済みの発言数 summarizedCount）だけを持ち、発言は発言テーブルに
+    1件1項目で持つ（キーは "sub#会話ID" と通し番号 seq）。読み込みでは要約済みより後の
+    発言だけを Query するため、会話が長くなっても項目サイズや読み込み量は増え続けない。
+    version は追記のたびに1増え、メタ情報の条件付き更新と発言の追加を1つのトランザクションで書いて
+    楽観的排他制御を行う。
+    """
+
+    def __init__(self, table_name, turns_table_name, client=None):
+        self.table_name = table_name
+        self.turns_table_name = turns_table_name
+        self.client = client or boto3.client('dynamodb')
+
+    @staticmethod
+    def new_conversation_id():
+        return uuid.uuid4().hex
+
+    def key(self, user_id, conversation_id):
+        return {
+            'userId': {'S': user_id},
+            'conversationId': {'S': conversation_id}
+        }
+
+    def turns_key(self, user_id, conversation_id):
+        return f"{user_id}#{conversation_id}"
+
+    def load_turns(self, user_id, conversation_id, start=0):
+        """通し番号 start 以降の発言を古い順に返す"""
+        messages = []
+        params = {
+            'TableName': self.turns_table_name,
+            'KeyConditionExpression': 'conversationKey = :key AND seq >= :start',
+            'ExpressionAttributeValues': {
+                ':key': {'S': self.turns_key(user_id, conversation_id)},
+                ':start': {'N': str(start)}
+            },
+            'ConsistentRead': True
+        }
+        while True:
+            response = self.client.query(**params)
+            messages.extend(from_attribute({'M': item}) for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return messages
+            params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def load(self, user_id, conversation_id):
+        """(要約済みより後のメッセージ, バージョン, 要約) を返す（未保存の会話は ([], 0, {})）
+
+        要約がある場合、メッセージは summarizedCount 番目の発言から始まる。
+        """
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key=self.key(user_id, conversation_id),
+            ConsistentRead=True
+        ).get('Item')
+        if not item:
+            return [], 0, {}
+        summary = {}
+        if 'summary' in item:
+            summary = {
+                'summary': item['summary']['S'],
+                'summarizedCount': int(item['summarizedCount']['N'])
+            }
+        messages = self.load_turns(user_id, conversation_id, summary.get('summarizedCount', 0))
+        return messages, int(item['version']['N']), summary
+
+    def load_expected(self, user_id, conversation_id, expected_version):
+        """保存済みのバージョンが expected_version のときだけ (要約済みより後のメッセージ, 要約) を返す"""
+        messages, version, summary = self.load(user_id, conversation_id)
+        if version != expected_version:
+            raise self.conflict(user_id, conversation_id, version)
+        return messages, summary
+
+    def conflict(self, user_id, conversation_id, version):
+        # クライアントが表示し直せるよう、競合時は全発言を返す
+        return ConversationConflictError(conversation_id, version, self.load_turns(user_id, conversation_id))
+
+    def append(self, user_id, conversation_id, expected_version, first_seq, new_messages, summary=None):
+        """expected_version から変わっていなければ通し番号 first_seq からメッセージを追記し、新しいバージョンを返す
+
+        summary を渡すと要約も同じ更新で書き換え、空なら保存済みの要約を消す。
+        """
+        now = str(int(time.time()))
+        update = 'SET #version = :next, messageCount = :count, updatedAt = :now'
+        values = {
+            ':next': {'N': str(expected_version + 1)},
+            ':count': {'N': str(first_seq + len(new_messages))},
+            ':now': {'N': now}
+        }
+        if summary:
+            update += ', summary = :summary, summarizedCount = :summarized'
+            values[':summary'] = {'S': summary['summary']}
+            values[':summarized'] = {'N': str(summary['summarizedCount'])}
+        else:
+            update += ' REMOVE summary, summarizedCount'
+        if expected_version == 0:
+            condition = 'attribute_not_exists(#version)'
+        else:
+            condition = '#version = :expected'
+            values[':expected'] = {'N': str(expected_version)}
+
+        turns_key = self.turns_key(user_id, conversation_id)
+        try:
+            self.client.transact_write_items(TransactItems=[
+                {'Update': {
+                    'TableName': self.table_name,
+                    'Key': self.key(user_id, conversation_id),
+                    'UpdateExpression': update,
+                    'ConditionExpression': condition,
+                    'ExpressionAttributeNames': {'#version': 'version'},
+                    'ExpressionAttributeValues': values
+                }}
+            ] + [
+                {'Put': {
+                    'TableName': self.turns_table_name,
+                    'Item': {
+                        'conversationKey': {'S': turns_key},
+                        'seq': {'N': str(first_seq + offset)},
+                        'createdAt': {'N': now},
+                        **to_attribute(message)['M']
+                    }
+                }}
+                for offset, message in enumerate(new_messages)
+            ])
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'TransactionCanceledException':
+                _, version, _ = self.load(user_id, conversation_id)
+                raise self.conflict(user_id, conversation_id, version)
+            raise
+        return expected_version + 1
+
+_store = None
+
+def get_conversation_store():
+    """CONVERSATIONS_TABLE と CONVERSATION_TURNS_TABLE が設定されていればストアを返す（未設定なら None）"""
+    global _store
+    table_name = os.environ.get('CONVERSATIONS_TABLE')
+    turns_table_name = os.environ.get('CONVERSATION_TURNS_TABLE')
+    if not table_name or not turns_table_name:
+        return None
+    if _store is None:
+        _store = ConversationStore(table_name, turns_table_name)
+    return _store
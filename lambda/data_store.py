@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from dynamodb_batch import batch_write, batch_get
+import observability
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# この大きさ（バイト）以上の JSON は圧縮して保存する。方式は zlib か zstd（zstandard が入っている場合）
+DATA_COMPRESS_THRESHOLD = int(os.environ.get("DATA_COMPRESS_THRESHOLD", "4096"))
+DATA_COMPRESSION = os.environ.get("DATA_COMPRESSION", "zlib")
+# 圧縮後もこの大きさを超える項目は S3 に置き、DynamoDB には場所だけを保存する（項目の上限は 400 KB）
+DATA_OFFLOAD_THRESHOLD = int(os.environ.get("DATA_OFFLOAD_THRESHOLD", str(350 * 1024)))
+
+class DataStoreError(Exception):
+    """保存できないデータ（S3 の設定がないのに大きすぎるなど）"""
+
+def compress(raw, method):
+    if method == "zstd":
+        return zstandard.ZstdCompressor(level=6).compress(raw)
+    return zlib.compress(raw, 6)
+
+def decompress(payload, method):
+    if method == "zstd":
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if method == "zlib":
+        return zlib.decompress(payload)
+    return payload
+
+class DataStore:
+    """会話・フローチャート・チームのデータを DynamoDB に保存する（キーは Cognito の sub と "種類#ID"）
+
+    大きな JSON は圧縮し、それでも大きいものは S3 に置いて DynamoDB にはキーだけを持つ。
+    書き込みは BatchWriteItem にまとめ、処理されなかった項目はバックオフしながら再送する。
+    """
+
+    def __init__(self, table_name, bucket_name=None, client=None, s3_client=None, compression=None):
+        self.table_name = table_name
+        self.bucket_name = bucket_name
+        self.client = client or boto3.client('dynamodb')
+        self.s3_client = s3_client or (boto3.client('s3') if bucket_name else None)
+        self.compression = compression or DATA_COMPRESSION
+        if self.compression == "zstd" and zstandard is None:
+            observability.warning("zstandard is not installed, falling back to zlib")
+            self.compression = "zlib"
+
+    @staticmethod
+    def data_key(data_type, item_id):
+        return f"{data_type}#{item_id}"
+
+    def s3_key(self, user_id, data_type, item_id):
+        # 同じ項目は同じキーに上書きする
+        return f"data/{user_id}/{data_type}/{item_id}.json"
+
+    def encode(self, user_id, data_type, item_id, data):
+        """保存する DynamoDB の項目を作る（S3 に置く場合は (項目, S3 に書く本文)）"""
+        raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        encoding, payload = "json", raw
+        if len(raw) >= DATA_COMPRESS_THRESHOLD:
+            encoding, payload = self.compression, compress(raw, self.compression)
+
+        item = {
+            'userId': {'S': user_id},
+            'dataKey': {'S': self.data_key(data_type, item_id)},
+            'dataType': {'S': data_type},
+            'itemId': {'S': item_id},
+            'encoding': {'S': encoding},
+            'size': {'N': str(len(raw))},
+            'updatedAt': {'N': str(int(time.time()))}
+        }
+        if len(payload) > DATA_OFFLOAD_THRESHOLD:
+            if not self.bucket_name:
+                raise DataStoreError(f"{data_type} {item_id} is too large ({len(payload)} bytes) and DATA_BUCKET is not set")
+            item['s3Key'] = {'S': self.s3_key(user_id, data_type, item_id)}
+            return item, payload
+        item['payload'] = {'S': payload.decode("utf-8")} if encoding == "json" else {'B': payload}
+        return item, None
+
+    def decode(self, item):
+        encoding = item['encoding']['S']
+        if 's3Key' in item:
+            payload = self.s3_client.get_object(Bucket=self.bucket_name, Key=item['s3Key']['S'])['Body'].read()
+        elif encoding == "json":
+            return json.loads(item['payload']['S'])
+        else:
+            payload = item['payload']['B']
+        return json.loads(decompress(payload, encoding))
+
+    def save_many(self, user_id, data_type, items):
+        """データのリストを保存し、保存した ID のリストを返す（id がないものには新しい ID を振る）"""
+        encoded = {}
+        offloads = []
+        for data in items:
+            item_id = str(data.get('id') or uuid.uuid4().hex)
+            item, offload = self.encode(user_id, data_type, item_id, data)
+            # 同じバッチに同じキーを入れるとエラーになるので後のものを残す
+            encoded[item_id] = item
+            if offload is not None:
+                offloads.append((item['s3Key']['S'], offload))
+
+        # DynamoDB が存在しない S3 オブジェクトを指さないよう、先に S3 に書く
+        if offloads:
+            with ThreadPoolExecutor(max_workers=min(8, len(offloads))) as executor:
+                list(executor.map(lambda offload: self.s3_client.put_object(
+                    Bucket=self.bucket_name, Key=offload[0], Body=offload[1]
+                ), offloads))
+
+        batch_write(self.client, self.table_name, [{'PutRequest': {'Item': item}} for item in encoded.values()])
+        return list(encoded)
+
+    def load_many(self, user_id, data_type, item_ids):
+        """ID のリストに対応するデータを {ID: データ} で返す（見つからない ID は含めない）"""
+        keys = [
+            {'userId': {'S': user_id}, 'dataKey': {'S': self.data_key(data_type, item_id)}}
+            for item_id in dict.fromkeys(str(item_id) for item_id in item_ids)
+        ]
+        return self.decode_items(batch_get(self.client, self.table_name, keys))
+
+    def load_all(self, user_id, data_type):
+        """ユーザーのある種類のデータをすべて {ID: データ} で返す"""
+        items = []
+        params = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': 'userId = :user AND begins_with(dataKey, :prefix)',
+            'ExpressionAttributeValues': {':user': {'S': user_id}, ':prefix': {'S': f"{data_type}#"}}
+        }
+        while True:
+            response = self.client.query(**params)
+            items.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return self.decode_items(items)
+
+    def decode_items(self, items):
+        # S3 に置いた項目の取得は並列に行う
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            values = list(executor.map(self.decode, items))
+        return {item['itemId']['S']: value for item, value in zip(items, values)}
+
+_store = None
+
+def get_data_store():
+    """DATA_TABLE が設定されていればストアを返す（未設定なら None）"""
+    global _store
+    table_name = os.environ.get('DATA_TABLE')
+    if not table_name:
+        return None
+    if _store is None:
+        _store = DataStore(table_name, os.environ.get('DATA_BUCKET') or None)
+    return _store
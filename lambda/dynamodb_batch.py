@@ -0,0 +1,47 @@
+import os
+import time
+import random
+
+# DynamoDB の1回のバッチの上限
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+# BatchWriteItem / BatchGetItem で処理されなかった項目を再送する回数
+DYNAMODB_BATCH_MAX_ATTEMPTS = int(os.environ.get("DYNAMODB_BATCH_MAX_ATTEMPTS", "8"))
+
+class BatchError(Exception):
+    """再試行しても処理されなかった項目が残った"""
+
+def backoff(attempt):
+    """指数バックオフ（ジッター付き、最大2秒）"""
+    time.sleep(min(2.0, 0.05 * (2 ** attempt)) * random.uniform(0.5, 1.0))
+
+def batch_write(client, table_name, requests):
+    """PutRequest / DeleteRequest のリストを25件ずつ書き、処理されなかった項目はバックオフしながら再送する"""
+    for start in range(0, len(requests), BATCH_WRITE_SIZE):
+        pending = {table_name: requests[start:start + BATCH_WRITE_SIZE]}
+        for attempt in range(DYNAMODB_BATCH_MAX_ATTEMPTS):
+            pending = client.batch_write_item(RequestItems=pending).get('UnprocessedItems') or {}
+            if not pending:
+                break
+            backoff(attempt)
+        else:
+            raise BatchError(f"{len(pending[table_name])} items were not written to {table_name} after {DYNAMODB_BATCH_MAX_ATTEMPTS} attempts")
+
+def batch_get(client, table_name, keys, projection=None):
+    """キーのリストを100件ずつ読み、見つかった項目のリストを返す（処理されなかったキーは再送する）"""
+    items = []
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request = {'Keys': keys[start:start + BATCH_GET_SIZE]}
+        if projection:
+            request['ProjectionExpression'] = projection
+        pending = {table_name: request}
+        for attempt in range(DYNAMODB_BATCH_MAX_ATTEMPTS):
+            response = client.batch_get_item(RequestItems=pending)
+            items.extend(response.get('Responses', {}).get(table_name, []))
+            pending = response.get('UnprocessedKeys') or {}
+            if not pending:
+                break
+            backoff(attempt)
+        else:
+            raise BatchError(f"{len(pending[table_name]['Keys'])} items were not read from {table_name} after {DYNAMODB_BATCH_MAX_ATTEMPTS} attempts")
+    return items
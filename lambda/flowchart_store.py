@@ -0,0 +1,274 @@
+import os
+import json
+import time
+import zlib
+import boto3
+from botocore.exceptions import ClientError
+from dynamodb_batch import batch_write, BatchError
+import observability
+
+# この数のパッチがたまるたびにスナップショットへまとめる
+FLOWCHART_SNAPSHOT_INTERVAL = int(os.environ.get("FLOWCHART_SNAPSHOT_INTERVAL", "50"))
+# 古いバージョンからのリベース用に、スナップショットより前のパッチをこの数だけ残す
+FLOWCHART_PATCH_RETENTION = int(os.environ.get("FLOWCHART_PATCH_RETENTION", str(FLOWCHART_SNAPSHOT_INTERVAL)))
+# 同時に書き込まれた場合にリベースを試みる回数
+FLOWCHART_MAX_REBASE = 5
+
+# パッチで扱うフロー図の要素（どちらも id を持つ要素のリスト）
+COLLECTIONS = ('nodes', 'edges')
+
+class FlowchartConflictError(Exception):
+    """クライアントの基準バージョン以降に同じ要素が変更されていた
+
+    sync はクライアントがフロー図を作り直すためのバージョン 0 からの同期データ
+    （FlowchartStore.sync と同じ形。スナップショットとそれ以降のパッチ）。
+    クライアントの画面には保存されなかった変更が残っているため、差分ではなく全体を返す。
+    """
+
+    def __init__(self, flowchart_id, sync):
+        super().__init__(f"Flowchart {flowchart_id} has conflicting changes (current version: {sync['version']})")
+        self.flowchart_id = flowchart_id
+        self.sync = sync
+
+def empty_document():
+    return {collection: [] for collection in COLLECTIONS}
+
+def apply_ops(document, ops):
+    """パッチの操作を適用した新しいフロー図を返す
+
+    操作は {"op": "put", "collection": "nodes", "value": {...}} か
+    {"op": "remove", "collection": "edges", "id": "..."}。
+    """
+    elements = {
+        collection: {element['id']: element for element in document.get(collection, [])}
+        for collection in COLLECTIONS
+    }
+    for op in ops:
+        if op.get('collection') not in COLLECTIONS:
+            raise ValueError(f"Unknown collection: {op.get('collection')}")
+        if op['op'] == 'put':
+            elements[op['collection']][op['value']['id']] = op['value']
+        elif op['op'] == 'remove':
+            elements[op['collection']].pop(op['id'], None)
+        else:
+            raise ValueError(f"Unknown operation: {op['op']}")
+    return {collection: list(elements[collection].values()) for collection in COLLECTIONS}
+
+def diff_document(old, new):
+    """2つのフロー図の差分をパッチの操作として返す（全体を送ってくるクライアント用）"""
+    ops = []
+    for collection in COLLECTIONS:
+        before = {element['id']: element for element in (old or {}).get(collection, [])}
+        after = {element['id']: element for element in (new or {}).get(collection, [])}
+        for element_id, element in after.items():
+            if before.get(element_id) != element:
+                ops.append({'op': 'put', 'collection': collection, 'value': element})
+        for element_id in before:
+            if element_id not in after:
+                ops.append({'op': 'remove', 'collection': collection, 'id': element_id})
+    return ops
+
+def op_key(op):
+    """操作が変更する要素（(種類, id)）"""
+    return op['collection'], op['value']['id'] if op['op'] == 'put' else op['id']
+
+def touched(ops):
+    return {op_key(op) for op in ops}
+
+def merge_ops(ops):
+    """同じ要素への操作は最後のものだけを残す（順序は最後に変更した順）"""
+    latest = {}
+    for op in ops:
+        latest.pop(op_key(op), None)
+        latest[op_key(op)] = op
+    return list(latest.values())
+
+class FlowchartStore:
+    """フロー図をバージョン付きのパッチとして保存する
+
+    FLOWCHARTS_TABLE（キーは flowchartId）の項目に最新バージョン（head）とスナップショットを持ち、
+    FLOWCHART_PATCHES_TABLE（キーは flowchartId と version）にパッチを追記する。
+    head の条件付き更新とパッチの追加は1つのトランザクションで行うため、同じバージョンは1回しか書かれない。
+    """
+
+    def __init__(self, client=None, table_name=None, patches_table=None):
+        self.client = client or boto3.client('dynamodb')
+        self.table_name = table_name or os.environ['FLOWCHARTS_TABLE']
+        self.patches_table = patches_table or os.environ['FLOWCHART_PATCHES_TABLE']
+
+    def load_meta(self, flowchart_id):
+        """(head, スナップショットのバージョン, スナップショット) を返す"""
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key={'flowchartId': {'S': flowchart_id}},
+            ConsistentRead=True
+        ).get('Item')
+        if not item:
+            return 0, 0, empty_document()
+        if 'snapshot' in item:
+            document = json.loads(zlib.decompress(item['snapshot']['B']))
+        elif 'data' in item:
+            # パッチ導入前に全体を保存していた項目
+            document = json.loads(item['data']['S'])
+        else:
+            document = empty_document()
+        snapshot_version = int(item.get('snapshotVersion', {}).get('N', '0'))
+        return int(item.get('head', {}).get('N', str(snapshot_version))), snapshot_version, document
+
+    def load_patches(self, flowchart_id, after):
+        """after より新しいパッチを古い順に返す"""
+        patches = []
+        params = {
+            'TableName': self.patches_table,
+            'KeyConditionExpression': 'flowchartId = :id AND version > :after',
+            'ExpressionAttributeValues': {':id': {'S': flowchart_id}, ':after': {'N': str(after)}},
+            'ConsistentRead': True
+        }
+        while True:
+            response = self.client.query(**params)
+            patches.extend({
+                'version': int(item['version']['N']),
+                'ops': json.loads(item['ops']['S']),
+                'userId': item.get('userId', {}).get('S'),
+                'clientId': item.get('clientId', {}).get('S')
+            } for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return patches
+            params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def load(self, flowchart_id):
+        """(最新バージョン, フロー図) を返す"""
+        _, snapshot_version, document = self.load_meta(flowchart_id)
+        patches = self.load_patches(flowchart_id, snapshot_version)
+        for patch in patches:
+            document = apply_ops(document, patch['ops'])
+        return (patches[-1]['version'] if patches else snapshot_version), document
+
+    def sync(self, flowchart_id, since):
+        """since から追いつくためのデータを返す
+
+        since がスナップショットより古ければスナップショットとそれ以降のパッチ、
+        そうでなければ since より新しいパッチだけを返す。
+        """
+        _, snapshot_version, document = self.load_meta(flowchart_id)
+        result = {'flowchartId': flowchart_id}
+        if since < snapshot_version:
+            result['snapshot'] = {'version': snapshot_version, 'flowchart': document}
+            since = snapshot_version
+        # 書き込んだ接続のIDはクライアントに返さない
+        result['patches'] = [
+            {'version': patch['version'], 'ops': patch['ops'], 'userId': patch['userId']}
+            for patch in self.load_patches(flowchart_id, since)
+        ]
+        result['version'] = result['patches'][-1]['version'] if result['patches'] else since
+        return result
+
+    def append(self, flowchart_id, user_id, base_version, ops, client_id=None):
+        """base_version に対するパッチを追記し、付いたバージョンを返す
+
+        client_id は書き込んだクライアント（WebSocket の接続ID）。先に別のパッチが書かれていても、
+        変更する要素が重ならないか同じクライアントのものなら最新のバージョンの上に積み直す。
+        同じユーザーでも別のタブ・端末からのパッチとは競合を調べる。
+        重なる場合や、base_version のパッチがすでにスナップショットへまとめて消された場合は
+        FlowchartConflictError を送出する。
+        """
+        version = base_version
+        for _ in range(FLOWCHART_MAX_REBASE):
+            try:
+                self.write_patch(flowchart_id, user_id, version, ops, client_id)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'TransactionCanceledException':
+                    raise
+                head, snapshot_version, _ = self.load_meta(flowchart_id)
+                if base_version < snapshot_version - FLOWCHART_PATCH_RETENTION:
+                    raise FlowchartConflictError(flowchart_id, self.sync(flowchart_id, 0))
+                newer = self.load_patches(flowchart_id, base_version)
+                # 同じクライアントの先のパッチ（ack を待たずに続けて送った変更）とは競合とみなさない
+                if any(
+                    touched(patch['ops']) & touched(ops)
+                    for patch in newer if client_id is None or patch['clientId'] != client_id
+                ):
+                    raise FlowchartConflictError(flowchart_id, self.sync(flowchart_id, 0))
+                version = max([head] + [patch['version'] for patch in newer])
+                continue
+
+            if (version + 1) % FLOWCHART_SNAPSHOT_INTERVAL == 0:
+                self.compact(flowchart_id, version + 1)
+            return version + 1
+        raise FlowchartConflictError(flowchart_id, self.sync(flowchart_id, 0))
+
+    def write_patch(self, flowchart_id, user_id, version, ops, client_id=None):
+        if version == 0:
+            condition = 'attribute_not_exists(head)'
+            values = {':next': {'N': '1'}}
+        else:
+            condition = 'head = :expected'
+            values = {':next': {'N': str(version + 1)}, ':expected': {'N': str(version)}}
+        patch = {
+            'flowchartId': {'S': flowchart_id},
+            'version': {'N': str(version + 1)},
+            'ops': {'S': json.dumps(ops, ensure_ascii=False, separators=(",", ":"))},
+            'userId': {'S': user_id},
+            'timestamp': {'N': str(int(time.time()))}
+        }
+        if client_id:
+            patch['clientId'] = {'S': client_id}
+        self.client.transact_write_items(TransactItems=[
+            {'Update': {
+                'TableName': self.table_name,
+                'Key': {'flowchartId': {'S': flowchart_id}},
+                'UpdateExpression': 'SET head = :next',
+                'ConditionExpression': condition,
+                'ExpressionAttributeValues': values
+            }},
+            {'Put': {
+                'TableName': self.patches_table,
+                'Item': patch
+            }}
+        ])
+
+    def compact(self, flowchart_id, version):
+        """version までのパッチをスナップショットにまとめ、保持期間より古いパッチを消す"""
+        _, snapshot_version, document = self.load_meta(flowchart_id)
+        if snapshot_version >= version:
+            return
+        for patch in self.load_patches(flowchart_id, snapshot_version):
+            if patch['version'] > version:
+                break
+            document = apply_ops(document, patch['ops'])
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={'flowchartId': {'S': flowchart_id}},
+                UpdateExpression='SET snapshot = :snapshot, snapshotVersion = :version REMOVE #data',
+                ConditionExpression='attribute_not_exists(snapshotVersion) OR snapshotVersion < :version',
+                ExpressionAttributeNames={'#data': 'data'},
+                ExpressionAttributeValues={
+                    ':snapshot': {'B': zlib.compress(json.dumps(document, ensure_ascii=False).encode('utf-8'))},
+                    ':version': {'N': str(version)}
+                }
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                # 別の呼び出しが先にまとめた
+                return
+            raise
+
+        expired = range(max(1, snapshot_version - FLOWCHART_PATCH_RETENTION + 1), version - FLOWCHART_PATCH_RETENTION + 1)
+        deletes = [
+            {'DeleteRequest': {'Key': {'flowchartId': {'S': flowchart_id}, 'version': {'N': str(patch_version)}}}}
+            for patch_version in expired
+        ]
+        try:
+            batch_write(self.client, self.patches_table, deletes)
+        except BatchError as e:
+            # 消し残しは保持期間より古いパッチが残るだけで動作には影響しない
+            observability.warning("Failed to delete compacted patches", flowchartId=flowchart_id, error=str(e))
+
+_store = None
+
+def get_flowchart_store(client=None):
+    global _store
+    if _store is None:
+        _store = FlowchartStore(client)
+    return _store
@@ -1,170 +1,537 @@
 # lambda/index.py
 import json
 import os
-import boto3
 import re  # 正規表現モジュールをインポート
-from botocore.exceptions import ClientError
-import urllib.request
+import time
+import boto3
+from botocore.config import Config
+from conversation_store import ConversationConflictError, get_conversation_store
+from response_cache import get_response_cache
+from model_router import ModelRouter
+from data_store import get_data_store
+import observability
 
-def lambda_handler(event, context):
-    # 送るメッセージ（eventから取得する例）
-    message = event["messages"][-1]["content"]
+# モデルID
+MODEL_ID = os.environ.get("MODEL_ID", "us.amazon.nova-lite-v1:0")
 
-    # Colabで取得したAPIのURLに置き換えて！
-    api_url = "https://xxxx.ngrok.io/predict"
-    
-    # リクエスト用のデータ
-    data = json.dumps({"message": message}).encode("utf-8")
+# Bedrock に送る会話のトークン予算（要約 + 直近の発言）
+# 予算を超えたら古いやりとりを要約に畳み込み、直近の発言が予算 × CONTEXT_KEEP_RATIO に収まるまで減らす
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_KEEP_RATIO = float(os.environ.get("CONTEXT_KEEP_RATIO", "0.5"))
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", "400"))
+SUMMARY_MODEL_ID = os.environ.get("SUMMARY_MODEL_ID", MODEL_ID)
 
-    # リクエスト作成
-    req = urllib.request.Request(api_url, data=data, headers={'Content-Type': 'application/json'})
+# Bedrock クライアントの設定
+BEDROCK_CONNECT_TIMEOUT = float(os.environ.get("BEDROCK_CONNECT_TIMEOUT", "2"))
+BEDROCK_READ_TIMEOUT = float(os.environ.get("BEDROCK_READ_TIMEOUT", "20"))
+BEDROCK_MAX_ATTEMPTS = int(os.environ.get("BEDROCK_MAX_ATTEMPTS", "3"))
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.environ.get("BEDROCK_MAX_POOL_CONNECTIONS", "10"))
 
-    # APIを呼び出して結果を取得
-    with urllib.request.urlopen(req) as res:
-        result = json.loads(res.read().decode())
+# ストリーミング時に差分をまとめて送る間隔（秒）。最初の差分は待たずに送る
+STREAM_FLUSH_INTERVAL = float(os.environ.get("STREAM_FLUSH_INTERVAL", "0.05"))
 
-    return {
-        "statusCode": 200,
-        "body": json.dumps({
-            "response": result["response"]
-        }),
+CORS_HEADERS = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
+    "Access-Control-Allow-Methods": "OPTIONS,POST"
+}
+
+# ストリーム中にエラーとして届くイベント
+STREAM_ERROR_EVENTS = [
+    "internalServerException",
+    "modelStreamErrorException",
+    "modelTimeoutException",
+    "serviceUnavailableException",
+    "throttlingException",
+    "validationException"
+]
+
+HOME_REGION = os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION") or "us-east-1"
+
+def create_bedrock_client(region=None):
+    """Bedrock クライアントを作成する
+
+    リージョンは省略時は Lambda が設定する AWS_REGION から取る。接続は keep-alive で使い回し、
+    タイムアウトは関数のタイムアウト（30秒）より短くしてエラーとして返せるようにする。
+    スロットリング時は adaptive モードで送信レートを調整しながら再試行する。
+    """
+    region = region or HOME_REGION
+    return boto3.client('bedrock-runtime', region_name=region, config=Config(
+        connect_timeout=BEDROCK_CONNECT_TIMEOUT,
+        read_timeout=BEDROCK_READ_TIMEOUT,
+        retries={"max_attempts": BEDROCK_MAX_ATTEMPTS, "mode": "adaptive"},
+        max_pool_connections=BEDROCK_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True
+    ))
+
+# 初期化フェーズ（コールドスタート時に1回だけ）でクライアントを作り、呼び出し間で再利用する
+bedrock_client = create_bedrock_client()
+
+# 他のリージョンのクライアントはルーターが初めて使うときに作る
+regional_clients = {}
+
+def bedrock_client_for(region):
+    if region == HOME_REGION:
+        return bedrock_client
+    if region not in regional_clients:
+        regional_clients[region] = create_bedrock_client(region)
+    return regional_clients[region]
+
+# モデルとリージョンの選択（短い発言は小さいモデルへ、遅い宛先やスロットリング中の宛先は避ける）
+router = ModelRouter(bedrock_client_for, MODEL_ID, HOME_REGION)
+
+def build_messages(conversation_history, message):
+    """会話履歴にユーザーメッセージを追加した新しいリストを返す"""
+    messages = conversation_history.copy()
+    messages.append({
+        "role": "user",
+        "content": message
+    })
+    return messages
+
+def build_request_payload(messages, summary=""):
+    """Nova Liteモデル用のリクエストペイロードを構築（会話履歴を含める、古い部分は要約を system に入れる）"""
+    bedrock_messages = []
+    for msg in messages:
+        if msg["role"] in ("user", "assistant"):
+            bedrock_messages.append({
+                "role": msg["role"],
+                "content": [{"text": msg["content"]}]
+            })
+
+    request_payload = {
+        "messages": bedrock_messages,
+        "inferenceConfig": {
+            "maxTokens": 512,
+            "stopSequences": [],
+            "temperature": 0.7,
+            "topP": 0.9
+        }
     }
+    if summary:
+        request_payload["system"] = [{"text": f"これまでの会話の要約:\n{summary}"}]
+    return request_payload
 
+# 会話の文脈管理（トークン予算と要約）
+CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uff00-\uffef]')
 
-# Lambda コンテキストからリージョンを抽出する関数
-def extract_region_from_arn(arn):
-    # ARN 形式: arn:aws:lambda:region:account-id:function:function-name
-    match = re.search('arn:aws:lambda:([^:]+):', arn)
-    if match:
-        return match.group(1)
-    return "us-east-1"  # デフォルト値
+def estimate_tokens(text):
+    """トークン数の概算（CJK は1文字1トークン、それ以外は4文字1トークン、発言ごとの枠に4トークン）"""
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4 + 4
 
-# グローバル変数としてクライアントを初期化（初期値）
-bedrock_client = None
+def find_fold_point(messages, summary, summarized_count, budget, keep_ratio):
+    """要約に畳み込む範囲の終わり（この位置以降を発言のまま送る）を返す
 
-# モデルID
-MODEL_ID = os.environ.get("MODEL_ID", "us.amazon.nova-lite-v1:0")
+    予算内なら summarized_count のまま。超える場合は直近の発言が予算 × keep_ratio
+    に収まるユーザー発言の位置まで進める（最新のユーザー発言は必ず残す）。
+    """
+    tokens = [estimate_tokens(msg["content"]) for msg in messages]
+    remaining = sum(tokens[summarized_count:])
+    if remaining + estimate_tokens(summary) <= budget:
+        return summarized_count
+
+    target = budget * keep_ratio
+    for index in range(summarized_count, len(messages)):
+        if messages[index]["role"] == "user" and (remaining <= target or index == len(messages) - 1):
+            return index
+        remaining -= tokens[index]
+    return summarized_count
+
+def summarize_turns(client, summary, turns):
+    """これまでの要約に新しいやりとりを反映した要約を作る"""
+    lines = [f"{'ユーザー' if msg['role'] == 'user' else 'アシスタント'}: {msg['content']}" for msg in turns]
+    request_payload = {
+        "system": [{"text": (
+            "あなたはディベート練習の会話を要約する担当です。"
+            "論題・立場・主な主張と根拠・合意した点・未解決の論点を、後の会話で参照できるよう簡潔に日本語でまとめてください。"
+        )}],
+        "messages": [{
+            "role": "user",
+            "content": [{"text": (
+                f"これまでの要約:\n{summary or '（なし）'}\n\n"
+                "新しいやりとり:\n" + "\n".join(lines) + "\n\n"
+                "新しいやりとりを反映した要約全体を出力してください。"
+            )}]
+        }],
+        "inferenceConfig": {
+            "maxTokens": SUMMARY_MAX_TOKENS,
+            "temperature": 0.2
+        }
+    }
+
+    with observability.current().stage("summarize"):
+        response = client.invoke_model(
+            modelId=SUMMARY_MODEL_ID,
+            body=json.dumps(request_payload),
+            contentType="application/json"
+        )
+        response_body = json.loads(response['body'].read())
+    return response_body['output']['message']['content'][0]['text'].strip()
+
+def fit_context(client, messages, context=None, budget=None, keep_ratio=None):
+    """会話をトークン予算に収める
+
+    (送る発言, 要約, 新しい文脈情報) を返す。文脈情報は {"summary", "summarizedCount"}
+    で、会話と一緒に保存して次のターンで渡す。要約はあふれた分だけ差分で更新する。
+    """
+    budget = budget or CONTEXT_TOKEN_BUDGET
+    keep_ratio = keep_ratio or CONTEXT_KEEP_RATIO
+    summary = (context or {}).get("summary", "")
+    summarized_count = int((context or {}).get("summarizedCount", 0))
+    if not 0 <= summarized_count < len(messages) or messages[summarized_count]["role"] != "user":
+        # 会話と合わない文脈情報は使わない
+        summary, summarized_count = "", 0
+
+    fold_end = find_fold_point(messages, summary, summarized_count, budget, keep_ratio)
+    if fold_end > summarized_count:
+        try:
+            summary = summarize_turns(client, summary, messages[summarized_count:fold_end])
+            summarized_count = fold_end
+            observability.info("Summarized conversation", foldEnd=fold_end)
+        except Exception as error:
+            # 要約に失敗した場合は今回だけ古いやりとりを省いて送る（文脈情報は更新しない）
+            observability.error("Error summarizing conversation", error=str(error))
+            return messages[fold_end:], summary, context or {}
+
+    context = {"summary": summary, "summarizedCount": summarized_count} if summary else {}
+    return messages[summarized_count:], summary, context
+
+def estimate_prompt_tokens(messages, summary=""):
+    return estimate_tokens(summary) + sum(estimate_tokens(msg["content"]) for msg in messages)
+
+def invoke_chat(messages, summary=""):
+    """invoke_model で応答全体を取得する（呼び出し先はルーターが選ぶ）
+
+    (応答, 実際に答えたモデルのID) を返す。
+    """
+    trace = observability.current()
+    with trace.stage("payload_build"):
+        request_payload = build_request_payload(messages, summary)
+        request_body = json.dumps(request_payload)
+        prompt_tokens = estimate_prompt_tokens(messages, summary)
+    trace.size("bedrock_request_bytes", len(request_body))
+    trace.payload("bedrock_request", lambda: request_payload)
+
+    with trace.stage("bedrock_call"):
+        raw_body, target, hedged = router.invoke(request_body, prompt_tokens)
+    trace.set(model=target.model_id, region=target.region, hedged=hedged)
+
+    # レスポンスを解析
+    response_body = json.loads(raw_body)
+    trace.size("bedrock_response_bytes", len(raw_body))
+    trace.payload("bedrock_response", lambda: response_body)
+    if 'usage' in response_body:
+        trace.set(inputTokens=response_body['usage'].get('inputTokens'), outputTokens=response_body['usage'].get('outputTokens'))
+
+    # 応答の検証
+    if not response_body.get('output') or not response_body['output'].get('message') or not response_body['output']['message'].get('content'):
+        raise Exception("No response content from the model")
+
+    return response_body['output']['message']['content'][0]['text'], target.model_id
+
+def cached_chat(client, messages, summary=""):
+    """応答キャッシュを確認し、なければ invoke_chat で取得して保存する
+
+    (応答, キャッシュ情報) を返す。キャッシュ情報は {"hit", "tier", ...} で、
+    キャッシュが無効なら None。
+    """
+    cache = get_response_cache(client)
+    if cache is None:
+        return invoke_chat(messages, summary)[0], None
+
+    trace = observability.current()
+    with trace.stage("cache_lookup"):
+        request_payload = build_request_payload(messages, summary)
+        # ルーターが最初に選ぶモデルの応答を探す（小さいモデルと通常のモデルの応答は混ぜない）
+        model_id = router.route(estimate_prompt_tokens(messages, summary))[0].model_id
+        hit, lookup = cache.get(model_id, request_payload)
+    if hit is not None:
+        trace.set(cacheHit=hit["tier"])
+        return hit.pop("response"), {"hit": True, **hit}
+
+    assistant_response, answered_by = invoke_chat(messages, summary)
+    with trace.stage("cache_store"):
+        if answered_by != model_id:
+            # 失敗や待機中のため別のモデルが答えた場合は、そのモデルのキーで保存する
+            embedding = lookup.embedding
+            lookup = cache.lookup(answered_by, request_payload)
+            lookup.embedding = embedding
+        cache.put(lookup, assistant_response)
+    return assistant_response, {"hit": False}
+
+def parse_stream_delta(event):
+    """invoke_model_with_response_stream のイベントからテキストの差分を取り出す"""
+    for error_type in STREAM_ERROR_EVENTS:
+        if error_type in event:
+            raise Exception(f"{error_type}: {event[error_type].get('message', '')}")
+    chunk = event.get("chunk")
+    if not chunk:
+        return None
+    payload = json.loads(chunk["bytes"])
+    return payload.get("contentBlockDelta", {}).get("delta", {}).get("text")
+
+def stream_chat(client, messages, on_delta, summary="", flush_interval=STREAM_FLUSH_INTERVAL):
+    """invoke_model_with_response_stream で応答を受け取り、差分を on_delta に渡す（全文を返す）"""
+    trace = observability.current()
+    with trace.stage("payload_build"):
+        request_payload = build_request_payload(messages, summary)
+        request_body = json.dumps(request_payload)
+    trace.size("bedrock_request_bytes", len(request_body))
+    trace.payload("bedrock_request", lambda: request_payload)
+    observability.debug("Calling Bedrock invoke_model_with_response_stream API", model=MODEL_ID)
+
+    with trace.stage("bedrock_call"):
+        response = client.invoke_model_with_response_stream(
+            modelId=MODEL_ID,
+            body=request_body,
+            contentType="application/json"
+        )
+
+    stream = response['body']
+    parts = []
+    pending = []
+    last_flush = None
+    try:
+        for event in stream:
+            text = parse_stream_delta(event)
+            if not text:
+                continue
+            parts.append(text)
+            pending.append(text)
+            # 最初の差分はすぐに送り、以降は flush_interval ごとにまとめて送る
+            now = time.monotonic()
+            if last_flush is None:
+                trace.mark("first_delta")
+            if last_flush is None or now - last_flush >= flush_interval:
+                on_delta("".join(pending))
+                pending = []
+                last_flush = now
+        if pending:
+            on_delta("".join(pending))
+    finally:
+        # 途中で送信に失敗した場合もストリームを閉じて生成を打ち切る
+        stream.close()
+        trace.mark("stream_end")
+
+    if not parts:
+        raise Exception("No response content from the model")
+    response_text = "".join(parts)
+    trace.size("bedrock_response_bytes", len(response_text.encode("utf-8")))
+    return response_text
+
+def load_history(body, user_id):
+    """会話履歴と要約を読み込み、(ストア, 会話ID, バージョン, 履歴の開始位置, 履歴, 要約) を返す
+
+    会話履歴をサーバー側に保存する場合、クライアントは会話IDとバージョンだけを送る。
+    ストアからは要約済みより後の発言だけを読むため、履歴は開始位置の発言から始まり、
+    要約の summarizedCount は履歴の先頭からの数になる。
+    conversationHistory を送ってきた場合やストアがない場合は従来どおりで、ストア・会話ID・バージョンは None。
+    """
+    store = get_conversation_store()
+    if store is not None and user_id and 'conversationHistory' not in body:
+        conversation_id = body.get('conversationId') or store.new_conversation_id()
+        expected_version = int(body.get('version', 0))
+        with observability.current().stage("history_load"):
+            conversation_history, context_summary = store.load_expected(user_id, conversation_id, expected_version)
+        history_offset = context_summary.get('summarizedCount', 0)
+        if context_summary:
+            context_summary = dict(context_summary, summarizedCount=0)
+        return store, conversation_id, expected_version, history_offset, conversation_history, context_summary
+    # 要約はクライアントが前回の応答の contextSummary を送り返す
+    return None, None, None, 0, body.get('conversationHistory', []), body.get('contextSummary')
+
+def save_history(store, user_id, conversation_id, expected_version, history_offset, messages, assistant_response, context_summary):
+    """応答を会話履歴に加えて保存し、クライアントに返す項目を返す"""
+    messages.append({
+        "role": "assistant",
+        "content": assistant_response
+    })
+    if store is None:
+        return {
+            "response": assistant_response,
+            "conversationHistory": messages,
+            "contextSummary": context_summary
+        }
+    # 新しいやりとりだけを追記し、応答にも新しいターンだけを返す
+    # 要約済みの発言数は履歴の開始位置を足して会話全体での数に戻す
+    if context_summary:
+        context_summary = dict(context_summary, summarizedCount=history_offset + context_summary['summarizedCount'])
+    with observability.current().stage("history_save"):
+        version = store.append(
+            user_id, conversation_id, expected_version, history_offset + len(messages) - 2, messages[-2:], context_summary
+        )
+    return {
+        "response": assistant_response,
+        "conversationId": conversation_id,
+        "version": version
+    }
 
 def lambda_handler(event, context):
+    trace = observability.start_trace("chat", context)
+    status_code = 500
     try:
-        # コンテキストから実行リージョンを取得し、クライアントを初期化
-        global bedrock_client
-        if bedrock_client is None:
-            region = extract_region_from_arn(context.invoked_function_arn)
-            bedrock_client = boto3.client('bedrock-runtime', region_name=region)
-            print(f"Initialized Bedrock client in region: {region}")
-        
-        print("Received event:", json.dumps(event))
+        client = bedrock_client
         
         # Cognitoで認証されたユーザー情報を取得
         user_info = None
         if 'requestContext' in event and 'authorizer' in event['requestContext']:
             user_info = event['requestContext']['authorizer']['claims']
-            print(f"Authenticated user: {user_info.get('email') or user_info.get('cognito:username')}")
+            observability.debug("Authenticated user", sub=user_info.get('sub'))
         
         # リクエストボディの解析
-        body = json.loads(event['body'])
-        message = body['message']
-        conversation_history = body.get('conversationHistory', [])
+        with trace.stage("body_parse"):
+            body = json.loads(event['body'])
+            message = body['message']
+        trace.size("request_bytes", len(event['body']))
+        trace.payload("event", lambda: dict(event, body=body))
+        trace.set(model=MODEL_ID)
         
-        print("Processing message:", message)
-        print("Using model:", MODEL_ID)
+        user_id = user_info.get('sub') if user_info else None
+        store, conversation_id, expected_version, history_offset, conversation_history, context_summary = load_history(body, user_id)
         
-        # 会話履歴を使用
-        messages = conversation_history.copy()
+        # 会話履歴を使用し、ユーザーメッセージを追加
+        messages = build_messages(conversation_history, message)
         
-        # ユーザーメッセージを追加
-        messages.append({
-            "role": "user",
-            "content": message
-        })
-        
-        # Nova Liteモデル用のリクエストペイロードを構築
-        # 会話履歴を含める
-        bedrock_messages = []
-        for msg in messages:
-            if msg["role"] == "user":
-                bedrock_messages.append({
-                    "role": "user",
-                    "content": [{"text": msg["content"]}]
-                })
-            elif msg["role"] == "assistant":
-                bedrock_messages.append({
-                    "role": "assistant", 
-                    "content": [{"text": msg["content"]}]
-                })
+        # トークン予算を超える古いやりとりは要約にまとめる
+        recent_messages, summary, context_summary = fit_context(client, messages, context_summary)
+        trace.set(messageCount=len(messages), sentMessageCount=len(recent_messages))
         
-        # invoke_model用のリクエストペイロード
-        request_payload = {
-            "messages": bedrock_messages,
-            "inferenceConfig": {
-                "maxTokens": 512,
-                "stopSequences": [],
-                "temperature": 0.7,
-                "topP": 0.9
-            }
-        }
+        # アシスタントの応答を取得（同じ会話の応答がキャッシュにあればそれを使う）
+        assistant_response, cache_info = cached_chat(client, recent_messages, summary)
         
-        print("Calling Bedrock invoke_model API with payload:", json.dumps(request_payload))
-        
-        # invoke_model APIを呼び出し
-        response = bedrock_client.invoke_model(
-            modelId=MODEL_ID,
-            body=json.dumps(request_payload),
-            contentType="application/json"
-        )
-        
-        # レスポンスを解析
-        response_body = json.loads(response['body'].read())
-        print("Bedrock response:", json.dumps(response_body, default=str))
-        
-        # 応答の検証
-        if not response_body.get('output') or not response_body['output'].get('message') or not response_body['output']['message'].get('content'):
-            raise Exception("No response content from the model")
-        
-        # アシスタントの応答を取得
-        assistant_response = response_body['output']['message']['content'][0]['text']
-        
-        # アシスタントの応答を会話履歴に追加
-        messages.append({
-            "role": "assistant",
-            "content": assistant_response
-        })
+        # アシスタントの応答を会話履歴に追加して保存
+        result = {"success": True, **save_history(
+            store, user_id, conversation_id, expected_version, history_offset, messages, assistant_response, context_summary
+        )}
+        if cache_info is not None:
+            result["cache"] = cache_info
         
         # 成功レスポンスの返却
+        with trace.stage("response_build"):
+            response_body = json.dumps(result)
+        trace.size("response_bytes", len(response_body))
+        status_code = 200
         return {
             "statusCode": 200,
-            "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
-                "Access-Control-Allow-Methods": "OPTIONS,POST"
-            },
+            "headers": CORS_HEADERS,
+            "body": response_body
+        }
+        
+    except ConversationConflictError as conflict:
+        # 別のリクエストが先に追記した場合は最新の履歴とバージョンを返す
+        observability.warning("Conversation conflict", conversationId=conflict.conversation_id, version=conflict.version)
+        status_code = 409
+        
+        return {
+            "statusCode": 409,
+            "headers": CORS_HEADERS,
             "body": json.dumps({
-                "success": True,
-                "response": assistant_response,
-                "conversationHistory": messages
+                "success": False,
+                "error": str(conflict),
+                "conversationId": conflict.conversation_id,
+                "version": conflict.version,
+                "conversationHistory": conflict.messages
             })
         }
         
     except Exception as error:
-        print("Error:", str(error))
+        observability.error("Error handling chat request", error=str(error), errorType=type(error).__name__)
         
         return {
             "statusCode": 500,
-            "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
-                "Access-Control-Allow-Methods": "OPTIONS,POST"
-            },
+            "headers": CORS_HEADERS,
             "body": json.dumps({
                 "success": False,
                 "error": str(error)
             })
         }
+    finally:
+        # 1リクエストにつき1行、ステージごとの時間とサイズを EMF で出力する
+        observability.end_trace(status_code)
+
+def stream_chat_to_connection(connection_id, data, apigateway, context, user_id=None):
+    """WebSocket でチャットの応答を逐次送信する
+
+    chat_delta で差分を送り、最後に chat_done で全文を送る。会話履歴の読み込み・要約・保存は
+    lambda_handler と同じで、user_id（接続のオーソライザーの principalId）があれば会話IDとバージョンで
+    サーバー側の履歴に追記する。他のリクエストが先に追記していた場合は chat_error で最新の履歴を返す。
+    """
+    request_id = data.get('requestId')
+    trace = observability.start_trace("chat_stream", context)
+    status = "error"
+
+    def send(message_type, payload):
+        apigateway.post_to_connection(
+            ConnectionId=connection_id,
+            Data=json.dumps({
+                'type': message_type,
+                'data': {'requestId': request_id, **payload}
+            })
+        )
+
+    try:
+        client = bedrock_client
+        store, conversation_id, expected_version, history_offset, conversation_history, context_summary = load_history(data, user_id)
+        messages = build_messages(conversation_history, data['message'])
+        trace.set(model=MODEL_ID)
+
+        recent_messages, summary, context_summary = fit_context(client, messages, context_summary)
+        trace.set(messageCount=len(messages), sentMessageCount=len(recent_messages))
+        assistant_response = stream_chat(
+            client, recent_messages, lambda text: send('chat_delta', {'text': text}), summary
+        )
+
+        result = save_history(
+            store, user_id, conversation_id, expected_version, history_offset, messages, assistant_response, context_summary
+        )
+        with trace.stage("response_build"):
+            send('chat_done', result)
+        status = "done"
+    except apigateway.exceptions.GoneException:
+        # クライアントが切断した場合は送信をやめる
+        observability.info("Connection is gone, stopped streaming", connectionId=connection_id)
+        status = "gone"
+    except ConversationConflictError as conflict:
+        observability.warning("Conversation conflict", conversationId=conflict.conversation_id, version=conflict.version)
+        status = "conflict"
+        try:
+            send('chat_error', {
+                'error': str(conflict),
+                'conflict': True,
+                'conversationId': conflict.conversation_id,
+                'version': conflict.version,
+                'conversationHistory': conflict.messages
+            })
+        except Exception as send_error:
+            observability.error("Error sending chat_error", connectionId=connection_id, error=str(send_error))
+    except Exception as error:
+        observability.error("Error streaming chat", error=str(error), errorType=type(error).__name__)
+        try:
+            send('chat_error', {'error': str(error)})
+        except Exception as send_error:
+            observability.error("Error sending chat_error", connectionId=connection_id, error=str(send_error))
+    finally:
+        observability.end_trace(status)
 
 # データ永続化のための新しいハンドラー
+def save_items(user_id, data_type, data):
+    """data は1件のオブジェクトかそのリスト（まとめて BatchWriteItem で書く）"""
+    store = get_data_store()
+    if store is None:
+        raise Exception("DATA_TABLE is not configured")
+    return store.save_many(user_id, data_type, data if isinstance(data, list) else [data])
+
+def save_conversation(user_id, data):
+    return save_items(user_id, 'conversation', data)
+
+def save_flowchart(user_id, data):
+    return save_items(user_id, 'flowchart', data)
+
+def save_team_data(user_id, data):
+    return save_items(user_id, 'team', data)
+
 def save_data_handler(event, context):
     try:
         body = json.loads(event['body'])
@@ -172,19 +539,56 @@ def save_data_handler(event, context):
         data_type = body['type']  # 'conversation', 'flowchart', 'team'
         
         if data_type == 'conversation':
-            save_conversation(user_id, body['data'])
+            ids = save_conversation(user_id, body['data'])
         elif data_type == 'flowchart':
-            save_flowchart(user_id, body['data'])
+            ids = save_flowchart(user_id, body['data'])
         elif data_type == 'team':
-            save_team_data(user_id, body['data'])
+            ids = save_team_data(user_id, body['data'])
+        else:
+            return {
+                'statusCode': 400,
+                'headers': CORS_HEADERS,
+                'body': json.dumps({'error': f"Unknown data type: {data_type}"})
+            }
+            
+        return {
+            'statusCode': 200,
+            'headers': CORS_HEADERS,
+            'body': json.dumps({'success': True, 'ids': ids})
+        }
+    except Exception as e:
+        observability.error("Error saving data", error=str(e), errorType=type(e).__name__)
+        return {
+            'statusCode': 500,
+            'headers': CORS_HEADERS,
+            'body': json.dumps({'error': str(e)})
+        }
+
+def load_data_handler(event, context):
+    """保存したデータをまとめて読む（?type=flowchart&ids=a,b。ids を省略するとその種類をすべて返す）"""
+    try:
+        params = event.get('queryStringParameters') or {}
+        user_id = event['requestContext']['authorizer']['claims']['sub']
+        data_type = params['type']
+        store = get_data_store()
+        if store is None:
+            raise Exception("DATA_TABLE is not configured")
+        
+        if params.get('ids'):
+            items = store.load_many(user_id, data_type, [item_id for item_id in params['ids'].split(',') if item_id])
+        else:
+            items = store.load_all(user_id, data_type)
             
         return {
             'statusCode': 200,
-            'body': json.dumps({'success': True})
+            'headers': CORS_HEADERS,
+            'body': json.dumps({'success': True, 'items': items})
         }
     except Exception as e:
+        observability.error("Error loading data", error=str(e), errorType=type(e).__name__)
         return {
             'statusCode': 500,
+            'headers': CORS_HEADERS,
             'body': json.dumps({'error': str(e)})
         }
 
@@ -0,0 +1,183 @@
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from botocore.exceptions import ClientError
+import observability
+
+# 短い発言に使う小さいモデル（未設定なら常に MODEL_ID）と、その対象にする送信トークン数の上限
+ROUTER_SMALL_MODEL_ID = os.environ.get("ROUTER_SMALL_MODEL_ID", "")
+ROUTER_SMALL_MAX_TOKENS = int(os.environ.get("ROUTER_SMALL_MAX_TOKENS", "300"))
+
+# 他に呼べるリージョン（カンマ区切り）。us. などのクロスリージョン推論プロファイルはどのリージョンからも呼べる
+ROUTER_REGIONS = [region.strip() for region in os.environ.get("ROUTER_REGIONS", "").split(",") if region.strip()]
+
+# 遅延の記録（直近 ROUTER_WINDOW 件）。ROUTER_MIN_SAMPLES 件たまるまでは p95 を使わない
+ROUTER_WINDOW = int(os.environ.get("ROUTER_WINDOW", "100"))
+ROUTER_MIN_SAMPLES = int(os.environ.get("ROUTER_MIN_SAMPLES", "10"))
+# 他の宛先の p95 が優先の宛先の p95 × この比率より小さければそちらに切り替える
+ROUTER_SWITCH_RATIO = float(os.environ.get("ROUTER_SWITCH_RATIO", "0.8"))
+# スロットリングなどで失敗した宛先を後回しにする時間（秒）
+ROUTER_COOLDOWN = float(os.environ.get("ROUTER_COOLDOWN", "30"))
+
+# ヘッジ（最初の呼び出しが p95 × 倍率を過ぎても返らなければ別の宛先にも送り、先に返った方を使う）
+HEDGE_REQUESTS = os.environ.get("HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_P95_MULTIPLIER = float(os.environ.get("HEDGE_P95_MULTIPLIER", "1.0"))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "0.5"))
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", "3.0"))
+
+# 別の宛先で再試行すべきエラー
+RETRYABLE_ERRORS = [
+    "ThrottlingException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+    "InternalServerException",
+    "ModelTimeoutException"
+]
+
+class Target:
+    """呼び出し先（モデルとリージョンの組）"""
+
+    def __init__(self, model_id, region):
+        self.model_id = model_id
+        self.region = region
+        self.key = f"{region}/{model_id}"
+
+class LatencyTracker:
+    """宛先ごとに直近の応答時間と失敗による待機期限を持つ（ウォームなインスタンス内で共有）"""
+
+    def __init__(self, window=None, min_samples=None, cooldown=None):
+        self.window = window or ROUTER_WINDOW
+        self.min_samples = min_samples or ROUTER_MIN_SAMPLES
+        self.cooldown = ROUTER_COOLDOWN if cooldown is None else cooldown
+        self.latencies = {}
+        self.cooling_until = {}
+        self.lock = threading.Lock()
+
+    def record(self, key, seconds):
+        with self.lock:
+            self.latencies.setdefault(key, deque(maxlen=self.window)).append(seconds)
+            self.cooling_until.pop(key, None)
+
+    def record_failure(self, key):
+        with self.lock:
+            self.cooling_until[key] = time.monotonic() + self.cooldown
+
+    def cooling(self, key):
+        return self.cooling_until.get(key, 0) > time.monotonic()
+
+    def p95(self, key):
+        """サンプルが足りなければ None"""
+        with self.lock:
+            samples = sorted(self.latencies.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+def is_retryable(error):
+    return isinstance(error, ClientError) and error.response.get("Error", {}).get("Code") in RETRYABLE_ERRORS
+
+class ModelRouter:
+    """送信トークン数と記録した遅延から呼び出し先を選び、必要ならヘッジして invoke_model を呼ぶ
+
+    client_for(region) はリージョンごとの bedrock-runtime クライアントを返す関数。
+    """
+
+    def __init__(self, client_for, model_id, region, small_model_id=None, small_max_tokens=None,
+                 regions=None, hedge=None, tracker=None):
+        self.client_for = client_for
+        self.model_id = model_id
+        self.regions = [region] + [other for other in (ROUTER_REGIONS if regions is None else regions) if other != region]
+        self.small_model_id = ROUTER_SMALL_MODEL_ID if small_model_id is None else small_model_id
+        self.small_max_tokens = small_max_tokens or ROUTER_SMALL_MAX_TOKENS
+        self.hedge = HEDGE_REQUESTS if hedge is None else hedge
+        self.tracker = tracker or LatencyTracker()
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
+    def rank(self, targets):
+        """設定順を基本に、待機中の宛先を後ろへ回し、p95 が十分に速い宛先があれば前に出す"""
+        available = [target for target in targets if not self.tracker.cooling(target.key)]
+        cooling = [target for target in targets if self.tracker.cooling(target.key)]
+        if len(available) > 1:
+            preferred = self.tracker.p95(available[0].key)
+            if preferred is not None:
+                faster = [
+                    target for target in available[1:]
+                    if (self.tracker.p95(target.key) or float("inf")) < preferred * ROUTER_SWITCH_RATIO
+                ]
+                if faster:
+                    best = min(faster, key=lambda target: self.tracker.p95(target.key))
+                    available.remove(best)
+                    available.insert(0, best)
+        return available + cooling
+
+    def route(self, prompt_tokens):
+        """呼び出し先を優先順に返す（先頭が最初の呼び出し、残りがヘッジや再試行の候補）"""
+        default_targets = self.rank([Target(self.model_id, region) for region in self.regions])
+        if not self.small_model_id or prompt_tokens > self.small_max_tokens:
+            return default_targets
+        small_targets = self.rank([Target(self.small_model_id, region) for region in self.regions])
+        # 小さいモデルがすべて待機中なら通常のモデルを先に使う
+        if all(self.tracker.cooling(target.key) for target in small_targets):
+            return default_targets + small_targets
+        return small_targets + default_targets
+
+    def hedge_delay(self, target):
+        p95 = self.tracker.p95(target.key)
+        if p95 is None:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, p95 * HEDGE_P95_MULTIPLIER)
+
+    def call(self, target, request_body):
+        """1つの宛先を呼び、応答の本文（バイト列）を返す。所要時間と失敗を記録する"""
+        start = time.monotonic()
+        try:
+            response = self.client_for(target.region).invoke_model(
+                modelId=target.model_id,
+                body=request_body,
+                contentType="application/json"
+            )
+            raw_body = response['body'].read()
+        except Exception as error:
+            if is_retryable(error):
+                self.tracker.record_failure(target.key)
+            raise
+        self.tracker.record(target.key, time.monotonic() - start)
+        return raw_body
+
+    def invoke(self, request_body, prompt_tokens):
+        """(応答の本文, 使った宛先, ヘッジしたか) を返す
+
+        ヘッジしない場合も、最初の宛先が再試行すべきエラーで失敗したら次の宛先で1回だけやり直す。
+        ヘッジ中に負けた呼び出しは取り消せないため、結果を捨てて遅延の記録だけに使う。
+        """
+        targets = self.route(prompt_tokens)
+        primary, backups = targets[0], targets[1:]
+
+        if not self.hedge or not backups:
+            try:
+                return self.call(primary, request_body), primary, False
+            except Exception as error:
+                if not backups or not is_retryable(error):
+                    raise
+                observability.warning("Retrying Bedrock call on another target", target=primary.key, error=str(error))
+                return self.call(backups[0], request_body), backups[0], False
+
+        futures = {self.executor.submit(self.call, primary, request_body): primary}
+        done, _ = wait(futures, timeout=self.hedge_delay(primary))
+        hedged = False
+        if not done or next(iter(done)).exception() is not None:
+            # 期限を過ぎた、または先に失敗した場合はもう1つの宛先にも送る
+            futures[self.executor.submit(self.call, backups[0], request_body)] = backups[0]
+            hedged = True
+
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result(), futures[future], hedged
+                error = future.exception()
+        raise error
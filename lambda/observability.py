@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import random
+from contextlib import contextmanager
+
+# ログレベル（DEBUG / INFO / WARNING / ERROR）
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_LEVEL = LEVELS.get(os.environ.get("LOG_LEVEL", "INFO").upper(), 20)
+
+# リクエストやモデルの入出力をログに残す割合（0〜1）。残す場合も REDACT_KEYS の値は伏せる
+PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "0"))
+REDACT_KEYS = {
+    key.strip().lower()
+    for key in os.environ.get(
+        "LOG_REDACT_KEYS", "content,text,message,email,authorization,cognito:username,summary"
+    ).split(",")
+    if key.strip()
+}
+
+# CloudWatch 埋め込みメトリクス（EMF）の名前空間
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "BedrockChatbot")
+
+def redact(value):
+    """REDACT_KEYS に含まれるキーの値を長さだけ残して伏せる"""
+    if isinstance(value, dict):
+        return {
+            key: f"[REDACTED len={len(str(item))}]" if str(key).lower() in REDACT_KEYS else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+def log(level, message, **fields):
+    """構造化ログを1行出力する（値が関数の場合は出力するときだけ呼ぶ）"""
+    if LEVELS[level] < LOG_LEVEL:
+        return
+    record = {"level": level, "message": message}
+    for key, value in fields.items():
+        record[key] = value() if callable(value) else value
+    if _current is not None and _current.request_id:
+        record["requestId"] = _current.request_id
+    print(json.dumps(record, ensure_ascii=False, default=str))
+
+def debug(message, **fields):
+    log("DEBUG", message, **fields)
+
+def info(message, **fields):
+    log("INFO", message, **fields)
+
+def warning(message, **fields):
+    log("WARNING", message, **fields)
+
+def error(message, **fields):
+    log("ERROR", message, **fields)
+
+class RequestTrace:
+    """1回の呼び出しのステージごとの時間とサイズを集め、最後に EMF 形式で1行出力する"""
+
+    def __init__(self, handler, context=None):
+        self.handler = handler
+        self.request_id = getattr(context, "aws_request_id", None)
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.sizes = {}
+        self.properties = {}
+        self.payloads = {}
+        self.sampled = PAYLOAD_SAMPLE_RATE > 0 and random.random() < PAYLOAD_SAMPLE_RATE
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            # 同じステージを複数回通った場合は合計する
+            self.timings[name] = self.timings.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def mark(self, name):
+        """呼び出し開始からの経過時間を記録する（最初の差分までの時間など）"""
+        self.timings.setdefault(name, (time.perf_counter() - self.started) * 1000)
+
+    def size(self, name, value):
+        self.sizes[name] = value
+
+    def set(self, **properties):
+        self.properties.update(properties)
+
+    def payload(self, name, build):
+        """サンプリング対象の呼び出しだけ、伏せ字にした入出力を残す（build は必要なときだけ呼ぶ）"""
+        if self.sampled:
+            self.payloads[name] = redact(build())
+
+    def record(self, status):
+        timings = dict(self.timings, total=(time.perf_counter() - self.started) * 1000)
+        metrics = [{"Name": name, "Unit": "Milliseconds"} for name in timings]
+        metrics += [{"Name": name, "Unit": "Bytes"} for name in self.sizes]
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["Handler"]],
+                    "Metrics": metrics
+                }]
+            },
+            "Handler": self.handler,
+            "requestId": self.request_id,
+            "status": status,
+            **{name: round(value, 3) for name, value in timings.items()},
+            **self.sizes,
+            **self.properties
+        }
+        if self.payloads:
+            record["payloads"] = self.payloads
+        return record
+
+    def emit(self, status):
+        print(json.dumps(self.record(status), ensure_ascii=False, default=str))
+
+class NullTrace(RequestTrace):
+    """トレースの外で呼ばれた場合に使う（何も記録しない）"""
+
+    def __init__(self):
+        super().__init__("none")
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def mark(self, name):
+        pass
+
+    def size(self, name, value):
+        pass
+
+    def set(self, **properties):
+        pass
+
+    def payload(self, name, build):
+        pass
+
+_current = None
+_null = NullTrace()
+
+def start_trace(handler, context=None):
+    """呼び出しのトレースを開始する（Lambda は1プロセスで1件ずつ処理するため、現在のトレースを1つ持つ）"""
+    global _current
+    _current = RequestTrace(handler, context)
+    return _current
+
+def end_trace(status):
+    global _current
+    if _current is not None:
+        _current.emit(status)
+        _current = None
+
+def current():
+    return _current or _null
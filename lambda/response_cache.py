@@ -0,0 +1,192 @@
+import os
+import json
+import math
+import time
+import hashlib
+import unicodedata
+from collections import OrderedDict
+import boto3
+import observability
+
+# プロセス内 LRU の件数と有効期間（秒）。DynamoDB の項目も同じ期間で TTL により消える
+# 既定は 0（無効）。チャットは temperature 0.7 でサンプリングするため、キャッシュすると同じ質問に
+# 毎回同じ応答を返すことになる。それでよい場合だけ件数を設定して有効にする
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "0"))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", "86400"))
+
+# 近似一致（埋め込みの類似度）。モデルIDを設定したときだけ、履歴なしの1発言のリクエストに使う
+RESPONSE_CACHE_EMBEDDING_MODEL_ID = os.environ.get("RESPONSE_CACHE_EMBEDDING_MODEL_ID", "")
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get("RESPONSE_CACHE_SIMILARITY", "0.95"))
+RESPONSE_CACHE_EMBEDDING_DIMENSIONS = int(os.environ.get("RESPONSE_CACHE_EMBEDDING_DIMENSIONS", "256"))
+
+def normalize_text(text):
+    """全角・半角や前後・連続する空白の違いを吸収する"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def cache_scope(model_id, request_payload):
+    """モデルID・推論設定・system が同じリクエストを同じ範囲とみなす"""
+    scope = {
+        "model": model_id,
+        "inferenceConfig": request_payload.get("inferenceConfig", {}),
+        "system": [normalize_text(block["text"]) for block in request_payload.get("system", [])]
+    }
+    return hashlib.sha256(json.dumps(scope, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def cache_key(scope, request_payload):
+    """(範囲, 正規化した発言の列) のハッシュ"""
+    messages = [
+        [message["role"], [normalize_text(block["text"]) for block in message["content"]]]
+        for message in request_payload["messages"]
+    ]
+    return hashlib.sha256(json.dumps([scope, messages], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def single_turn_text(request_payload):
+    """履歴なし・要約なしの1発言のリクエストならその本文を返す（近似一致の対象）"""
+    messages = request_payload["messages"]
+    if len(messages) != 1 or request_payload.get("system"):
+        return None
+    return normalize_text(" ".join(block["text"] for block in messages[0]["content"]))
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+class CacheLookup:
+    """get で計算したキーと埋め込みを put で使い回すための入れ物"""
+
+    def __init__(self, scope, key, text=None):
+        self.scope = scope
+        self.key = key
+        self.text = text
+        self.embedding = None
+
+class ResponseCache:
+    """Bedrock の応答キャッシュ
+
+    プロセス内 LRU → DynamoDB（TTL 付き、Lambda のインスタンス間で共有）→ 埋め込みの近似一致
+    の順に探す。近似一致の索引はプロセス内だけに持ち、1発言のリクエストにだけ使う。
+    キャッシュの失敗はチャットを止めないよう、ログに残してミスとして扱う。
+    """
+
+    def __init__(self, table_name=None, client=None, bedrock_client=None,
+                 max_entries=None, ttl=None, embedding_model_id=None, similarity=None):
+        self.table_name = table_name
+        self.client = client or (boto3.client('dynamodb') if table_name else None)
+        self.bedrock_client = bedrock_client
+        self.max_entries = max_entries or RESPONSE_CACHE_SIZE
+        self.ttl = ttl or RESPONSE_CACHE_TTL
+        self.embedding_model_id = RESPONSE_CACHE_EMBEDDING_MODEL_ID if embedding_model_id is None else embedding_model_id
+        self.similarity = similarity or RESPONSE_CACHE_SIMILARITY
+        self.entries = OrderedDict()  # key -> (応答, 期限)
+        self.near_entries = OrderedDict()  # key -> (範囲, 埋め込み, 応答, 期限)
+
+    @staticmethod
+    def lookup(model_id, request_payload):
+        scope = cache_scope(model_id, request_payload)
+        return CacheLookup(scope, cache_key(scope, request_payload), single_turn_text(request_payload))
+
+    def get(self, model_id, request_payload):
+        """(ヒット情報, CacheLookup) を返す。ヒット情報は {"response", "tier", ...}（ミスなら None）"""
+        lookup = self.lookup(model_id, request_payload)
+        scope = lookup.scope
+        now = time.time()
+
+        entry = self.entries.get(lookup.key)
+        if entry and entry[1] > now:
+            self.entries.move_to_end(lookup.key)
+            return {"response": entry[0], "tier": "memory"}, lookup
+
+        response = self.get_shared(lookup.key, now)
+        if response is not None:
+            self.remember(lookup.key, response, now + self.ttl)
+            return {"response": response, "tier": "dynamodb"}, lookup
+
+        if lookup.text and self.embedding_model_id and self.bedrock_client is not None:
+            try:
+                lookup.embedding = self.embed(lookup.text)
+            except Exception as error:
+                observability.warning("Error embedding prompt for response cache", error=str(error))
+                return None, lookup
+            best, best_score = None, 0.0
+            for key, (entry_scope, embedding, response, expires) in self.near_entries.items():
+                if entry_scope != scope or expires <= now:
+                    continue
+                score = cosine_similarity(lookup.embedding, embedding)
+                if score > best_score:
+                    best, best_score = key, score
+            if best is not None and best_score >= self.similarity:
+                self.near_entries.move_to_end(best)
+                return {"response": self.near_entries[best][2], "tier": "semantic", "similarity": round(best_score, 4)}, lookup
+
+        return None, lookup
+
+    def put(self, lookup, response):
+        expires = time.time() + self.ttl
+        self.remember(lookup.key, response, expires)
+        if lookup.embedding is not None:
+            self.near_entries[lookup.key] = (lookup.scope, lookup.embedding, response, expires)
+            self.near_entries.move_to_end(lookup.key)
+            while len(self.near_entries) > self.max_entries:
+                self.near_entries.popitem(last=False)
+        self.put_shared(lookup.key, response, expires)
+
+    def remember(self, key, response, expires):
+        self.entries[key] = (response, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_shared(self, key, now):
+        if not self.table_name:
+            return None
+        try:
+            item = self.client.get_item(
+                TableName=self.table_name,
+                Key={'cacheKey': {'S': key}}
+            ).get('Item')
+        except Exception as error:
+            observability.warning("Error reading response cache", error=str(error))
+            return None
+        # TTL による削除は遅れることがあるので期限も確認する
+        if not item or int(item['expiresAt']['N']) <= now:
+            return None
+        return item['response']['S']
+
+    def put_shared(self, key, response, expires):
+        if not self.table_name:
+            return
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'cacheKey': {'S': key},
+                    'response': {'S': response},
+                    'expiresAt': {'N': str(int(expires))}
+                }
+            )
+        except Exception as error:
+            observability.warning("Error writing response cache", error=str(error))
+
+    def embed(self, text):
+        response = self.bedrock_client.invoke_model(
+            modelId=self.embedding_model_id,
+            body=json.dumps({
+                "inputText": text,
+                "dimensions": RESPONSE_CACHE_EMBEDDING_DIMENSIONS,
+                "normalize": True
+            }),
+            contentType="application/json"
+        )
+        return json.loads(response['body'].read())['embedding']
+
+_cache = None
+
+def get_response_cache(bedrock_client=None):
+    """RESPONSE_CACHE_SIZE が 0 なら None を返す（RESPONSE_CACHE_TABLE が未設定ならプロセス内だけ）"""
+    global _cache
+    if RESPONSE_CACHE_SIZE <= 0:
+        return None
+    if _cache is None:
+        _cache = ResponseCache(os.environ.get('RESPONSE_CACHE_TABLE') or None, bedrock_client=bedrock_client)
+    return _cache
@@ -0,0 +1,189 @@
+import os
+import time
+import boto3
+from dynamodb_batch import batch_write, batch_get
+
+# warm な Lambda 内でチームの接続IDを使い回す時間（秒）。0 でキャッシュしない
+TEAM_CONNECTIONS_CACHE_TTL = float(os.environ.get("TEAM_CONNECTIONS_CACHE_TTL", "5"))
+# 索引の行の有効期間（秒）。切断イベントが届かなかった場合も TTL で消える（WebSocket 接続の上限は2時間）
+TEAM_CONNECTIONS_ROW_TTL = int(os.environ.get("TEAM_CONNECTIONS_ROW_TTL", str(3 * 60 * 60)))
+
+class TeamConnectionIndex:
+    """チーム → 接続ID の索引（TEAM_CONNECTIONS_TABLE、キーは teamId と connectionId）
+
+    接続・切断・チームへの参加・退出のたびに更新し、送信先は teamId の Query 1回で求める。
+    接続の項目（CONNECTIONS_TABLE）には userId と所属チーム（teamIds）も持たせ、
+    切断時に消すべき行を追加の読み込みなしで分かるようにする。
+    ユーザーの所属チームは TEAM_DATA_TABLE の UserTeams インデックス（userId → teamId）から引く。
+    """
+
+    def __init__(self, client=None, table_name=None, connections_table=None, team_table=None, cache_ttl=None):
+        self.client = client or boto3.client('dynamodb')
+        self.table_name = table_name or os.environ['TEAM_CONNECTIONS_TABLE']
+        self.connections_table = connections_table or os.environ['CONNECTIONS_TABLE']
+        self.team_table = team_table or os.environ['TEAM_DATA_TABLE']
+        self.cache_ttl = TEAM_CONNECTIONS_CACHE_TTL if cache_ttl is None else cache_ttl
+        self.cache = {}  # teamId -> (期限, 接続IDのリスト)
+
+    def row(self, team_id, connection_id, user_id):
+        return {
+            'teamId': {'S': team_id},
+            'connectionId': {'S': connection_id},
+            'userId': {'S': user_id},
+            'expiresAt': {'N': str(int(time.time()) + TEAM_CONNECTIONS_ROW_TTL)}
+        }
+
+    def invalidate(self, team_ids):
+        for team_id in team_ids:
+            self.cache.pop(team_id, None)
+
+    def user_teams(self, user_id):
+        teams = []
+        params = {
+            'TableName': self.team_table,
+            'IndexName': 'UserTeams',
+            'KeyConditionExpression': 'userId = :userId',
+            'ExpressionAttributeValues': {':userId': {'S': user_id}},
+            'ProjectionExpression': 'teamId'
+        }
+        while True:
+            response = self.client.query(**params)
+            teams.extend(item['teamId']['S'] for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return teams
+            params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def user_connections(self, user_id):
+        connections = []
+        params = {
+            'TableName': self.connections_table,
+            'IndexName': 'UserConnections',
+            'KeyConditionExpression': 'userId = :userId',
+            'ExpressionAttributeValues': {':userId': {'S': user_id}}
+        }
+        while True:
+            response = self.client.query(**params)
+            connections.extend(item['connectionId']['S'] for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return connections
+            params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def connect(self, connection_id, user_id):
+        """接続の項目を保存し、ユーザーの所属チームすべての索引に接続を加える"""
+        team_ids = self.user_teams(user_id)
+        item = {
+            'connectionId': {'S': connection_id},
+            'userId': {'S': user_id},
+            'timestamp': {'N': str(int(time.time()))},
+            'connected': {'BOOL': True}
+        }
+        if team_ids:
+            item['teamIds'] = {'SS': team_ids}
+        self.client.put_item(TableName=self.connections_table, Item=item)
+        batch_write(self.client, self.table_name, [{'PutRequest': {'Item': self.row(team_id, connection_id, user_id)}} for team_id in team_ids])
+        self.invalidate(team_ids)
+
+    def disconnect(self, connection_id):
+        """接続の項目と、その接続の索引の行を消す"""
+        item = self.client.delete_item(
+            TableName=self.connections_table,
+            Key={'connectionId': {'S': connection_id}},
+            ReturnValues='ALL_OLD'
+        ).get('Attributes', {})
+        team_ids = item.get('teamIds', {}).get('SS', [])
+        batch_write(self.client, self.table_name, [
+            {'DeleteRequest': {'Key': {'teamId': {'S': team_id}, 'connectionId': {'S': connection_id}}}}
+            for team_id in team_ids
+        ])
+        self.invalidate(team_ids)
+
+    def disconnect_many(self, connection_ids):
+        """切れた接続をまとめて消す（所属チームを BatchGetItem で読み、接続の項目と索引の行を BatchWriteItem で消す）"""
+        connection_ids = list(dict.fromkeys(connection_ids))
+        rows = batch_get(
+            self.client,
+            self.connections_table,
+            [{'connectionId': {'S': connection_id}} for connection_id in connection_ids],
+            'connectionId, teamIds'
+        )
+
+        team_ids = set()
+        index_deletes = []
+        for item in rows:
+            for team_id in item.get('teamIds', {}).get('SS', []):
+                team_ids.add(team_id)
+                index_deletes.append({'DeleteRequest': {'Key': {'teamId': {'S': team_id}, 'connectionId': item['connectionId']}}})
+        batch_write(self.client, self.table_name, index_deletes)
+        batch_write(
+            self.client,
+            self.connections_table,
+            [{'DeleteRequest': {'Key': {'connectionId': {'S': connection_id}}}} for connection_id in connection_ids]
+        )
+        self.invalidate(team_ids)
+
+    def join(self, team_id, user_id):
+        """ユーザーの今の接続をチームの索引に加える"""
+        connection_ids = self.user_connections(user_id)
+        batch_write(self.client, self.table_name, [{'PutRequest': {'Item': self.row(team_id, connection_id, user_id)}} for connection_id in connection_ids])
+        for connection_id in connection_ids:
+            self.update_teams(connection_id, 'ADD', team_id)
+        self.invalidate([team_id])
+
+    def leave(self, team_id, user_id):
+        """ユーザーの接続をチームの索引から外す"""
+        connection_ids = self.user_connections(user_id)
+        batch_write(self.client, self.table_name, [
+            {'DeleteRequest': {'Key': {'teamId': {'S': team_id}, 'connectionId': {'S': connection_id}}}}
+            for connection_id in connection_ids
+        ])
+        for connection_id in connection_ids:
+            self.update_teams(connection_id, 'DELETE', team_id)
+        self.invalidate([team_id])
+
+    def update_teams(self, connection_id, action, team_id):
+        try:
+            self.client.update_item(
+                TableName=self.connections_table,
+                Key={'connectionId': {'S': connection_id}},
+                UpdateExpression=f'{action} teamIds :team',
+                ConditionExpression='attribute_exists(connectionId)',
+                ExpressionAttributeValues={':team': {'SS': [team_id]}}
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            # 途中で切断された接続は無視する
+            pass
+
+    def team_connections(self, team_id):
+        """チームの接続IDを返す（索引の Query 1回、ページングあり）"""
+        cached = self.cache.get(team_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        connections = []
+        params = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': 'teamId = :teamId',
+            'ExpressionAttributeValues': {':teamId': {'S': team_id}},
+            'ProjectionExpression': 'connectionId'
+        }
+        while True:
+            response = self.client.query(**params)
+            connections.extend(item['connectionId']['S'] for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        if self.cache_ttl > 0:
+            self.cache[team_id] = (time.monotonic() + self.cache_ttl, connections)
+        return connections
+
+_index = None
+
+def get_team_connection_index(client=None):
+    """TEAM_CONNECTIONS_TABLE が設定されていれば索引を返す（未設定なら None）"""
+    global _index
+    if not os.environ.get('TEAM_CONNECTIONS_TABLE'):
+        return None
+    if _index is None:
+        _index = TeamConnectionIndex(client)
+    return _index
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import threading
+import boto3
+from flowchart_store import merge_ops
+import observability
+
+# バッファの方式（"dynamodb" で Lambda の呼び出し間で共有、"local" はプロセス内だけのテスト用、空ならまとめない）
+UPDATE_BUFFER_BACKEND = os.environ.get("UPDATE_BUFFER_BACKEND", "")
+# チームごとに更新をためる時間（ミリ秒）と、待たずに書き出す件数
+UPDATE_COALESCE_WINDOW_MS = int(os.environ.get("UPDATE_COALESCE_WINDOW_MS", "100"))
+UPDATE_COALESCE_MAX_UPDATES = int(os.environ.get("UPDATE_COALESCE_MAX_UPDATES", "50"))
+# 書き出し役の呼び出しが落ちた場合に、次の呼び出しが役を引き継げるようになるまでの猶予（ミリ秒）
+UPDATE_LEASE_GRACE_MS = 5000
+
+def now_ms():
+    return int(time.time() * 1000)
+
+class DynamoDBUpdateBuffer:
+    """チームごとの更新のバッファ（UPDATE_BUFFER_TABLE、キーは teamId）
+
+    updates に追記し、leaseUntil を条件付きで取れた呼び出しが書き出し役になる。
+    take は updates を空にして lease を外すのを1回の更新で行うため、更新が二重に書き出されることはない。
+    """
+
+    def __init__(self, client=None, table_name=None):
+        self.client = client or boto3.client('dynamodb')
+        self.table_name = table_name or os.environ['UPDATE_BUFFER_TABLE']
+
+    def append(self, team_id, update, lease_ms):
+        """(バッファの件数, 書き出し役になったか) を返す"""
+        response = self.client.update_item(
+            TableName=self.table_name,
+            Key={'teamId': {'S': team_id}},
+            UpdateExpression='SET updates = list_append(if_not_exists(updates, :empty), :new), expiresAt = :expires',
+            ExpressionAttributeValues={
+                ':empty': {'L': []},
+                ':new': {'L': [{'S': json.dumps(update, ensure_ascii=False)}]},
+                ':expires': {'N': str(int(time.time()) + 3600)}
+            },
+            ReturnValues='UPDATED_NEW'
+        )
+        count = len(response['Attributes']['updates']['L'])
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={'teamId': {'S': team_id}},
+                UpdateExpression='SET leaseUntil = :until',
+                ConditionExpression='attribute_not_exists(leaseUntil) OR leaseUntil < :now',
+                ExpressionAttributeValues={':until': {'N': str(now_ms() + lease_ms)}, ':now': {'N': str(now_ms())}}
+            )
+            return count, True
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return count, False
+
+    def take(self, team_id):
+        """たまった更新を取り出して空にする"""
+        response = self.client.update_item(
+            TableName=self.table_name,
+            Key={'teamId': {'S': team_id}},
+            UpdateExpression='SET updates = :empty REMOVE leaseUntil',
+            ExpressionAttributeValues={':empty': {'L': []}},
+            ReturnValues='UPDATED_OLD'
+        )
+        return [json.loads(value['S']) for value in response.get('Attributes', {}).get('updates', {}).get('L', [])]
+
+class LocalUpdateBuffer:
+    """プロセス内だけのバッファ（テストやローカル実行用。DynamoDBUpdateBuffer と同じ動き）"""
+
+    def __init__(self):
+        self.updates = {}
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def append(self, team_id, update, lease_ms):
+        with self.lock:
+            self.updates.setdefault(team_id, []).append(update)
+            leader = self.leases.get(team_id, 0) < now_ms()
+            if leader:
+                self.leases[team_id] = now_ms() + lease_ms
+            return len(self.updates[team_id]), leader
+
+    def take(self, team_id):
+        with self.lock:
+            self.leases.pop(team_id, None)
+            return self.updates.pop(team_id, [])
+
+def merge_updates(updates):
+    """同じフロー図への同じ接続からの更新を1つにまとめる（同じユーザーでも別のタブ・端末の更新はまとめない）
+
+    パッチ同士は操作をつなげて同じ要素への古い操作を捨てる（基準バージョンは古い方）。
+    全体を送る更新は後のものが前のものを置き換える。コメントはそのまま残す。
+    """
+    merged = []
+    positions = {}
+    for update in updates:
+        if update['type'] != 'flowchart_update':
+            merged.append(update)
+            continue
+        data = update['data']
+        key = (data['flowchartId'], update['connectionId'])
+        if key in positions:
+            previous = merged[positions[key]]
+            if 'ops' in data and 'ops' in previous['data']:
+                previous['data'] = dict(
+                    data,
+                    version=min(int(previous['data'].get('version', 0)), int(data.get('version', 0))),
+                    ops=merge_ops(previous['data']['ops'] + data['ops'])
+                )
+                continue
+            if 'ops' not in data:
+                merged[positions[key]] = update
+                continue
+        positions[key] = len(merged)
+        merged.append(update)
+    return merged
+
+class UpdateCoalescer:
+    """チームごとに更新を window の間ためて、まとめて保存・送信する
+
+    最初に lease を取った呼び出しが window だけ待ってからバッファを取り出し、flush(team_id, 更新のリスト)
+    を呼ぶ。それ以外の呼び出しは追記するだけで戻る。max_updates 件たまったら待たずに書き出す。
+    """
+
+    def __init__(self, backend, flush, window_ms=None, max_updates=None):
+        self.backend = backend
+        self.flush = flush
+        self.window_ms = UPDATE_COALESCE_WINDOW_MS if window_ms is None else window_ms
+        self.max_updates = max_updates or UPDATE_COALESCE_MAX_UPDATES
+
+    def submit(self, team_id, update):
+        count, leader = self.backend.append(team_id, update, self.window_ms + UPDATE_LEASE_GRACE_MS)
+        if count < self.max_updates:
+            if not leader:
+                return
+            time.sleep(self.window_ms / 1000)
+        updates = self.backend.take(team_id)
+        if updates:
+            merged = merge_updates(updates)
+            observability.info("Flushing coalesced updates", teamId=team_id, received=len(updates), merged=len(merged))
+            self.flush(team_id, merged)
+
+_coalescer = None
+
+def get_update_coalescer(flush, client=None):
+    """UPDATE_BUFFER_BACKEND が未設定なら None（更新ごとに保存・送信する）"""
+    global _coalescer
+    if not UPDATE_BUFFER_BACKEND:
+        return None
+    if _coalescer is None:
+        backend = LocalUpdateBuffer() if UPDATE_BUFFER_BACKEND == 'local' else DynamoDBUpdateBuffer(client)
+        _coalescer = UpdateCoalescer(backend, flush)
+    return _coalescer
@@ -1,25 +1,52 @@
 import json
 import os
+import uuid
 import boto3
 from datetime import datetime
+from team_connections import get_team_connection_index
+from dynamodb_batch import batch_write
+from broadcast import broadcast, management_client, post
+from flowchart_store import FlowchartConflictError, diff_document, get_flowchart_store
+from update_coalescer import get_update_coalescer
 
 dynamodb = boto3.client('dynamodb')
 apigateway = boto3.client('apigatewaymanagementapi')
 
+def connection_user_id(event):
+    """接続したユーザーのID（オーソライザーが検証した principalId のみ。クライアントが指定した値は使わない）"""
+    authorizer = event['requestContext'].get('authorizer') or {}
+    return authorizer.get('principalId')
+
+def save_connection(connection_id, user_id=None):
+    """接続の項目だけを保存する関数（チームの接続索引を使わない場合）"""
+    item = {
+        'connectionId': {'S': connection_id},
+        'timestamp': {'N': str(int(datetime.now().timestamp()))},
+        'connected': {'BOOL': True}
+    }
+    if user_id:
+        # UserConnections インデックスでユーザーの接続を引けるようにする
+        item['userId'] = {'S': user_id}
+    dynamodb.put_item(TableName=os.environ['CONNECTIONS_TABLE'], Item=item)
+
 def connect_handler(event, context):
     """WebSocket接続時のハンドラー"""
     connection_id = event['requestContext']['connectionId']
     
     try:
-        # 接続情報をDynamoDBに保存
-        dynamodb.put_item(
-            TableName=os.environ['CONNECTIONS_TABLE'],
-            Item={
-                'connectionId': {'S': connection_id},
-                'timestamp': {'N': str(int(datetime.now().timestamp()))},
-                'connected': {'BOOL': True}
-            }
-        )
+        user_id = connection_user_id(event)
+        index = get_team_connection_index(dynamodb)
+        if user_id and index is not None:
+            try:
+                # 接続情報を保存し、所属チームの接続索引に加える
+                index.connect(connection_id, user_id)
+            except Exception as e:
+                # 索引を更新できなくても接続は受け付ける（チームへの送信先は UserConnections から探す）
+                print(f"Error indexing connection {connection_id}: {str(e)}")
+                save_connection(connection_id, user_id)
+        else:
+            # 認証されていない接続はチームの送信先にならない
+            save_connection(connection_id, user_id)
         
         return {
             'statusCode': 200,
@@ -36,13 +63,17 @@ def disconnect_handler(event, context):
     connection_id = event['requestContext']['connectionId']
     
     try:
-        # 接続情報をDynamoDBから削除
-        dynamodb.delete_item(
-            TableName=os.environ['CONNECTIONS_TABLE'],
-            Key={
-                'connectionId': {'S': connection_id}
-            }
-        )
+        index = get_team_connection_index(dynamodb)
+        if index is not None:
+            # 接続情報とチームの接続索引の行をDynamoDBから削除
+            index.disconnect(connection_id)
+        else:
+            dynamodb.delete_item(
+                TableName=os.environ['CONNECTIONS_TABLE'],
+                Key={
+                    'connectionId': {'S': connection_id}
+                }
+            )
         
         return {
             'statusCode': 200,
@@ -66,21 +97,25 @@ def default_handler(event, context):
         message_type = body.get('type')
         data = body.get('data')
         
-        # APIGatewayクライアントの設定
-        apigateway_management = boto3.client(
-            'apigatewaymanagementapi',
-            endpoint_url=f'https://{domain}/{stage}'
-        )
+        # APIGatewayクライアントの設定（エンドポイントごとに使い回す）
+        apigateway_management = management_client(f'https://{domain}/{stage}')
         
         if message_type == 'flowchart_update':
             # フロー図の更新を処理
             handle_flowchart_update(connection_id, data, apigateway_management)
+        elif message_type == 'flowchart_sync':
+            # 遅れたクライアントにスナップショットと足りないパッチを返す
+            handle_flowchart_sync(connection_id, data, apigateway_management)
         elif message_type == 'comment':
             # コメントの追加を処理
             handle_comment(connection_id, data, apigateway_management)
         elif message_type == 'team_action':
             # チーム関連のアクションを処理
             handle_team_action(connection_id, data, apigateway_management)
+        elif message_type == 'chat':
+            # チャットの応答をストリーミングで返す
+            from index import stream_chat_to_connection
+            stream_chat_to_connection(connection_id, data, apigateway_management, context, connection_user_id(event))
         
         return {
             'statusCode': 200,
@@ -93,53 +128,99 @@ def default_handler(event, context):
         }
 
 def handle_flowchart_update(connection_id, data, apigateway):
-    """フロー図の更新を処理する関数"""
+    """フロー図の更新を処理する関数
+
+    data は {flowchartId, teamId, userId, version, ops}（version を基準にしたパッチ）。
+    フロー図全体（flowchart）を送ってきた場合は保存済みのものとの差分をパッチにする。
+    """
     try:
-        # フロー図の更新をDynamoDBに保存
-        dynamodb.put_item(
-            TableName=os.environ['FLOWCHARTS_TABLE'],
-            Item={
-                'flowchartId': {'S': data['flowchartId']},
-                'userId': {'S': data['userId']},
-                'data': {'S': json.dumps(data['flowchart'])},
-                'timestamp': {'N': str(int(datetime.now().timestamp()))}
-            }
-        )
+        if coalesce(connection_id, 'flowchart_update', data, apigateway):
+            return
+        message = apply_flowchart_update(connection_id, data, apigateway)
         
-        # チームメンバーに更新を通知
-        team_connections = get_team_connections(data['teamId'])
-        for conn_id in team_connections:
-            if conn_id != connection_id:  # 送信者以外に通知
-                send_to_connection(apigateway, conn_id, {
-                    'type': 'flowchart_update',
-                    'data': data['flowchart']
-                })
+        # チームメンバーにパッチを通知（送信者以外）
+        if message:
+            broadcast_to_team(apigateway, data['teamId'], message, exclude=connection_id)
     except Exception as e:
         print(f"Error handling flowchart update: {str(e)}")
 
+def apply_flowchart_update(connection_id, data, apigateway):
+    """パッチを追記して送信者に flowchart_ack（競合時は flowchart_conflict）を返す関数
+
+    チームに送るメッセージ（変更がない・競合した場合は None）を返す。
+    """
+    store = get_flowchart_store(dynamodb)
+    flowchart_id = data['flowchartId']
+    if 'ops' in data:
+        base_version = int(data.get('version', 0))
+        ops = data['ops']
+    else:
+        base_version, current = store.load(flowchart_id)
+        ops = diff_document(current, data['flowchart'])
+    
+    if not ops:
+        version = base_version
+    else:
+        try:
+            version = store.append(flowchart_id, data['userId'], base_version, ops, connection_id)
+        except FlowchartConflictError as conflict:
+            # 同じ要素が先に変更されていた場合は、フロー図を作り直すためのデータを送信者に返す
+            post(apigateway, connection_id, json.dumps({
+                'type': 'flowchart_conflict',
+                'data': {'requestId': data.get('requestId'), 'baseVersion': base_version, **conflict.sync}
+            }))
+            return None
+    
+    post(apigateway, connection_id, json.dumps({
+        'type': 'flowchart_ack',
+        'data': {'requestId': data.get('requestId'), 'flowchartId': flowchart_id, 'version': version}
+    }))
+    if not ops:
+        return None
+    return {
+        'type': 'flowchart_patch',
+        'data': {
+            'flowchartId': flowchart_id,
+            'version': version,
+            'userId': data['userId'],
+            'ops': ops
+        }
+    }
+
+def handle_flowchart_sync(connection_id, data, apigateway):
+    """data['version'] から最新に追いつくためのスナップショットとパッチを返す関数"""
+    try:
+        sync = get_flowchart_store(dynamodb).sync(data['flowchartId'], int(data.get('version', 0)))
+        post(apigateway, connection_id, json.dumps({'type': 'flowchart_sync', 'data': sync}))
+    except Exception as e:
+        print(f"Error handling flowchart sync: {str(e)}")
+
+def comment_item(data):
+    return {
+        'nodeId': {'S': data['nodeId']},
+        # 同じ時刻のコメントが同じ ID にならないよう、時刻の後ろに乱数を付ける（時刻順に並ぶ）
+        'commentId': {'S': f"{datetime.now().timestamp():.6f}-{uuid.uuid4().hex[:12]}"},
+        'userId': {'S': data['userId']},
+        'content': {'S': data['content']},
+        'timestamp': {'N': str(int(datetime.now().timestamp()))}
+    }
+
 def handle_comment(connection_id, data, apigateway):
     """コメントの追加を処理する関数"""
     try:
+        if coalesce(connection_id, 'comment', data, apigateway):
+            return
         # コメントをDynamoDBに保存
         dynamodb.put_item(
             TableName=os.environ['COMMENTS_TABLE'],
-            Item={
-                'nodeId': {'S': data['nodeId']},
-                'commentId': {'S': str(datetime.now().timestamp())},
-                'userId': {'S': data['userId']},
-                'content': {'S': data['content']},
-                'timestamp': {'N': str(int(datetime.now().timestamp()))}
-            }
+            Item=comment_item(data)
         )
         
-        # チームメンバーにコメントを通知
-        team_connections = get_team_connections(data['teamId'])
-        for conn_id in team_connections:
-            if conn_id != connection_id:
-                send_to_connection(apigateway, conn_id, {
-                    'type': 'new_comment',
-                    'data': data
-                })
+        # チームメンバーにコメントを通知（送信者以外）
+        broadcast_to_team(apigateway, data['teamId'], {
+            'type': 'new_comment',
+            'data': data
+        }, exclude=connection_id)
     except Exception as e:
         print(f"Error handling comment: {str(e)}")
 
@@ -159,6 +240,9 @@ def handle_team_action(connection_id, data, apigateway):
                     'timestamp': {'N': str(int(datetime.now().timestamp()))}
                 }
             )
+            index = get_team_connection_index(dynamodb)
+            if index is not None:
+                index.join(data['teamId'], data['userId'])
         elif action_type == 'leave_team':
             # チームからの退出を処理
             dynamodb.delete_item(
@@ -168,21 +252,85 @@ def handle_team_action(connection_id, data, apigateway):
                     'userId': {'S': data['userId']}
                 }
             )
+            index = get_team_connection_index(dynamodb)
+            if index is not None:
+                index.leave(data['teamId'], data['userId'])
         
         # チームメンバーに変更を通知
-        team_connections = get_team_connections(data['teamId'])
-        for conn_id in team_connections:
-            send_to_connection(apigateway, conn_id, {
-                'type': 'team_update',
-                'data': data
-            })
+        broadcast_to_team(apigateway, data['teamId'], {
+            'type': 'team_update',
+            'data': data
+        })
     except Exception as e:
         print(f"Error handling team action: {str(e)}")
 
+def coalesce(connection_id, message_type, data, apigateway):
+    """更新をまとめる設定ならチームのバッファに入れて True を返す関数（UPDATE_BUFFER_BACKEND）"""
+    coalescer = get_update_coalescer(flush_team_updates, dynamodb)
+    if coalescer is None:
+        return False
+    coalescer.submit(data['teamId'], {
+        'type': message_type,
+        'connectionId': connection_id,
+        'endpoint': apigateway.meta.endpoint_url,
+        'data': data
+    })
+    return True
+
+def flush_team_updates(team_id, updates):
+    """まとめた更新を保存し、チームへ1回で送信する関数"""
+    apigateway = management_client(updates[-1]['endpoint'])
+    outgoing = []  # (送信元の接続ID, チームに送るメッセージ)
+    comments = []
+    for update in updates:
+        try:
+            if update['type'] == 'flowchart_update':
+                message = apply_flowchart_update(update['connectionId'], update['data'], apigateway)
+                if message:
+                    outgoing.append((update['connectionId'], message))
+            elif update['type'] == 'comment':
+                comments.append({'PutRequest': {'Item': comment_item(update['data'])}})
+                outgoing.append((update['connectionId'], {'type': 'new_comment', 'data': update['data']}))
+        except Exception as e:
+            print(f"Error applying coalesced {update['type']}: {str(e)}")
+    
+    if comments:
+        try:
+            # コメントは BatchWriteItem でまとめて保存する
+            batch_write(dynamodb, os.environ['COMMENTS_TABLE'], comments)
+        except Exception as e:
+            # 保存できなかったコメントは送らない（保存済みのパッチの送信は続ける）
+            print(f"Error saving {len(comments)} coalesced comments for team {team_id}: {str(e)}")
+            outgoing = [(origin, message) for origin, message in outgoing if message['type'] != 'new_comment']
+    if len(outgoing) == 1:
+        broadcast_to_team(apigateway, team_id, outgoing[0][1], exclude=outgoing[0][0])
+    elif outgoing:
+        broadcast_batch(apigateway, team_id, outgoing)
+
+def broadcast_batch(apigateway, team_id, outgoing):
+    """複数のメッセージを batch として1回で送る関数（送信者には自分の分を除いたものを送る）"""
+    senders = set(origin for origin, _ in outgoing)
+    connection_ids = get_team_connections(team_id)
+    broadcast(
+        apigateway, connection_ids, {'type': 'batch', 'data': [message for _, message in outgoing]},
+        exclude=senders, on_gone=remove_connections
+    )
+    for sender in senders & set(connection_ids):
+        messages = [message for origin, message in outgoing if origin != sender]
+        if messages:
+            post(apigateway, sender, json.dumps({'type': 'batch', 'data': messages}))
+
 def get_team_connections(team_id):
-    """チームメンバーの接続IDを取得する関数"""
+    """チームメンバーの接続IDを取得する関数
+
+    チームの接続索引（TEAM_CONNECTIONS_TABLE）があれば1回読む。ない場合はチームメンバーを読み、
+    メンバーごとに UserConnections インデックスを引く。
+    """
     try:
-        # チームメンバーを取得
+        index = get_team_connection_index(dynamodb)
+        if index is not None:
+            return index.team_connections(team_id)
+
         team_members = dynamodb.query(
             TableName=os.environ['TEAM_DATA_TABLE'],
             KeyConditionExpression='teamId = :teamId',
@@ -190,8 +338,6 @@ def get_team_connections(team_id):
                 ':teamId': {'S': team_id}
             }
         )['Items']
-        
-        # メンバーの接続情報を取得
         connections = []
         for member in team_members:
             member_connections = dynamodb.query(
@@ -203,29 +349,25 @@ def get_team_connections(team_id):
                 }
             )['Items']
             connections.extend([conn['connectionId']['S'] for conn in member_connections])
-        
         return connections
     except Exception as e:
         print(f"Error getting team connections: {str(e)}")
         return []
 
-def send_to_connection(apigateway, connection_id, data):
-    """特定の接続にメッセージを送信する関数"""
-    try:
-        apigateway.post_to_connection(
-            ConnectionId=connection_id,
-            Data=json.dumps(data)
-        )
-    except Exception as e:
-        print(f"Error sending message to connection {connection_id}: {str(e)}")
-        if "GoneException" in str(e):
-            # 接続が切れている場合は接続情報を削除
-            try:
-                dynamodb.delete_item(
-                    TableName=os.environ['CONNECTIONS_TABLE'],
-                    Key={
-                        'connectionId': {'S': connection_id}
-                    }
-                )
-            except Exception as del_e:
-                print(f"Error deleting connection: {str(del_e)}") 
\ No newline at end of file
+def remove_connections(connection_ids):
+    """切れた接続の項目を削除する関数（チームの接続索引があれば索引の行も消す）"""
+    index = get_team_connection_index(dynamodb)
+    if index is not None:
+        index.disconnect_many(connection_ids)
+        return
+    batch_write(dynamodb, os.environ['CONNECTIONS_TABLE'], [
+        {'DeleteRequest': {'Key': {'connectionId': {'S': connection_id}}}}
+        for connection_id in dict.fromkeys(connection_ids)
+    ])
+
+def broadcast_to_team(apigateway, team_id, data, exclude=None):
+    """チームの接続に並列でメッセージを送信する関数（切れていた接続は最後にまとめて削除）"""
+    return broadcast(
+        apigateway, get_team_connections(team_id), data,
+        exclude=exclude, on_gone=remove_connections
+    )
@@ -13,6 +13,7 @@ import * as cognito from 'aws-cdk-lib/aws-cognito';
 import * as path from 'path';
 import * as cr from 'aws-cdk-lib/custom-resources';
 import * as logs from 'aws-cdk-lib/aws-logs';
+import * as dynamodb from 'aws-cdk-lib/aws-dynamodb';
 
 export interface BedrockChatbotStackProps extends cdk.StackProps {
   modelId?: string;
@@ -146,19 +147,53 @@ export class BedrockChatbotStack extends cdk.Stack {
       resources: ['*']
     }));
 
+    // 会話履歴テーブル（Cognito の sub + 会話ID）
+    const conversationsTable = new dynamodb.Table(this, 'ConversationsTable', {
+      partitionKey: { name: 'userId', type: dynamodb.AttributeType.STRING },
+      sortKey: { name: 'conversationId', type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
+    // 会話の発言テーブル（"sub#会話ID" + 通し番号、1発言1項目）
+    const conversationTurnsTable = new dynamodb.Table(this, 'ConversationTurnsTable', {
+      partitionKey: { name: 'conversationKey', type: dynamodb.AttributeType.STRING },
+      sortKey: { name: 'seq', type: dynamodb.AttributeType.NUMBER },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
+    // Bedrock の応答キャッシュ（期限切れの項目は TTL で削除）
+    const responseCacheTable = new dynamodb.Table(this, 'ResponseCacheTable', {
+      partitionKey: { name: 'cacheKey', type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: 'expiresAt',
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
     // Lambda function
     const chatFunction = new lambda.Function(this, 'ChatFunction', {
       runtime: lambda.Runtime.PYTHON_3_10,
       handler: 'index.lambda_handler',
-      code: lambda.Code.fromAsset(path.join(__dirname, '../lambda')),
+      code: lambda.Code.fromAsset(path.join(__dirname, '../lambda'), {
+        // 計測用スクリプトはデプロイしない
+        exclude: ['cold_start_benchmark.py'],
+      }),
       timeout: cdk.Duration.seconds(30),
       memorySize: 128,
       role: lambdaRole,
       environment: {
         MODEL_ID: modelId,
+        CONVERSATIONS_TABLE: conversationsTable.tableName,
+        CONVERSATION_TURNS_TABLE: conversationTurnsTable.tableName,
+        RESPONSE_CACHE_TABLE: responseCacheTable.tableName,
       },
     });
 
+    conversationsTable.grantReadWriteData(chatFunction);
+    conversationTurnsTable.grantReadWriteData(chatFunction);
+    responseCacheTable.grantReadWriteData(chatFunction);
+
     // API Gateway with Cognito Authorizer
     const api = new apigateway.RestApi(this, 'ChatbotApi', {
       restApiName: 'Bedrock Chatbot API',
@@ -182,6 +217,57 @@ export class BedrockChatbotStack extends cdk.Stack {
       authorizationType: apigateway.AuthorizationType.COGNITO,
     });
 
+    // 会話・フローチャート・チームのデータ（大きなものは圧縮し、さらに大きなものは S3 に置く）
+    const dataTable = new dynamodb.Table(this, 'DataTable', {
+      partitionKey: { name: 'userId', type: dynamodb.AttributeType.STRING },
+      sortKey: { name: 'dataKey', type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
+    const dataBucket = new s3.Bucket(this, 'DataBucket', {
+      blockPublicAccess: s3.BlockPublicAccess.BLOCK_ALL,
+      encryption: s3.BucketEncryption.S3_MANAGED,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+      autoDeleteObjects: true,
+    });
+
+    const dataFunctionProps = {
+      runtime: lambda.Runtime.PYTHON_3_10,
+      code: lambda.Code.fromAsset(path.join(__dirname, '../lambda'), {
+        exclude: ['cold_start_benchmark.py'],
+      }),
+      timeout: cdk.Duration.seconds(30),
+      memorySize: 256,
+      role: lambdaRole,
+      environment: {
+        MODEL_ID: modelId,
+        DATA_TABLE: dataTable.tableName,
+        DATA_BUCKET: dataBucket.bucketName,
+      },
+    };
+    const saveDataFunction = new lambda.Function(this, 'SaveDataFunction', {
+      ...dataFunctionProps,
+      handler: 'index.save_data_handler',
+    });
+    const loadDataFunction = new lambda.Function(this, 'LoadDataFunction', {
+      ...dataFunctionProps,
+      handler: 'index.load_data_handler',
+    });
+
+    dataTable.grantReadWriteData(lambdaRole);
+    dataBucket.grantReadWrite(lambdaRole);
+
+    const dataResource = api.root.addResource('data');
+    dataResource.addMethod('POST', new apigateway.LambdaIntegration(saveDataFunction), {
+      authorizer,
+      authorizationType: apigateway.AuthorizationType.COGNITO,
+    });
+    dataResource.addMethod('GET', new apigateway.LambdaIntegration(loadDataFunction), {
+      authorizer,
+      authorizationType: apigateway.AuthorizationType.COGNITO,
+    });
+
     // 設定生成用のLambdaロールを作成
     const configGeneratorRole = new iam.Role(this, 'ConfigGeneratorRole', {
       assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),